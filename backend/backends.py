@@ -0,0 +1,100 @@
+import glob
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+# Бэкенды инференса: torch - исходные веса .pt, остальные - экспорт ultralytics
+EXPORT_FORMATS = {
+    "onnx": ".onnx",
+    "openvino": "_openvino_model"
+}
+BACKENDS = ("torch",) + tuple(EXPORT_FORMATS)
+
+# Экспорт одной модели в несколько потоков сразу не нужен: он занимает минуты
+_export_lock = threading.Lock()
+
+
+def _export_key(model_path: str, backend: str, imgsz: int, half: bool) -> str:
+    """Ключ экспорта: веса (по размеру и времени изменения) и параметры экспорта"""
+    stat = os.stat(model_path)
+    payload = f"{os.path.basename(model_path)}:{stat.st_size}:{stat.st_mtime_ns}:{backend}:{imgsz}:{half}"
+    return hashlib.sha256(payload.encode()).hexdigest()[:16]
+
+
+def exported_model_path(model_path: str, backend: str, exports_dir: str, imgsz: int, half: bool = False) -> str:
+    """
+    Путь к весам для бэкенда. Для onnx и openvino веса .pt экспортируются один раз
+    (с динамическим размером пакета) и кэшируются в exports_dir; новые веса или другие
+    параметры экспорта дают новый файл.
+    """
+    if backend == "torch":
+        return model_path
+    if backend not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown inference backend: {backend}")
+    stem = os.path.splitext(os.path.basename(model_path))[0]
+    key = _export_key(model_path, backend, imgsz, half)
+    target = os.path.join(exports_dir, f"{stem}-{key}{EXPORT_FORMATS[backend]}")
+    with _export_lock:
+        if os.path.exists(target):
+            return target
+        os.makedirs(exports_dir, exist_ok=True)
+        # ultralytics пишет результат рядом с весами: экспортируем копию во временной папке
+        work_dir = tempfile.mkdtemp(prefix=f"{stem}-", dir=exports_dir)
+        try:
+            from ultralytics import YOLO
+            weights = os.path.join(work_dir, os.path.basename(model_path))
+            shutil.copyfile(model_path, weights)
+            start = time.time()
+            exported = YOLO(weights).export(format=backend, imgsz=imgsz, half=half, dynamic=True, verbose=False)
+            try:
+                os.replace(exported, target)
+            except OSError:
+                # Другой процесс успел экспортировать ту же модель
+                if not os.path.exists(target):
+                    raise
+            logger.info("Exported %s to %s in %.1fs", os.path.basename(model_path), backend, time.time() - start)
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    return target
+
+
+def tune_runtime(detection_model, backend: str, threads: Optional[int]):
+    """
+    Пересоздает сессию ONNX Runtime или скомпилированную модель OpenVINO с заданным числом
+    потоков внутри операции. ultralytics создает их со значениями по умолчанию при первом
+    предсказании, поэтому вызывается после прогрева.
+    """
+    if backend == "torch" or not threads:
+        return
+    runtime = getattr(getattr(detection_model.model, "predictor", None), "model", None)
+    try:
+        if backend == "onnx":
+            import onnxruntime
+            options = onnxruntime.SessionOptions()
+            options.intra_op_num_threads = threads
+            # Пакет - один граф: параллелизм между операциями только мешает
+            options.inter_op_num_threads = 1
+            options.execution_mode = onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+            options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+            runtime.session = onnxruntime.InferenceSession(
+                detection_model.model_path, options, providers=runtime.session.get_providers()
+            )
+        elif backend == "openvino":
+            import openvino
+            core = openvino.Core()
+            xml_path = glob.glob(os.path.join(detection_model.model_path, "*.xml"))[0]
+            runtime.ov_compiled_model = core.compile_model(
+                core.read_model(xml_path), "CPU",
+                {"INFERENCE_NUM_THREADS": threads, "PERFORMANCE_HINT": getattr(runtime, "inference_mode", "LATENCY")}
+            )
+    except (AttributeError, ImportError, IndexError) as e:
+        logger.warning("Cannot set %s threads to %d, runtime defaults are used: %s", backend, threads, e)
+        return
+    logger.info("%s runtime uses %d intra-op threads", backend, threads)
@@ -0,0 +1,516 @@
+"""
+Воспроизводимый замер производительности конвейера детекции и выгрузки.
+
+Генерирует синтетические PNG и GeoTIFF заданных размеров, подменяет модели детерминированной
+CPU-заглушкой с настраиваемой задержкой и плотностью объектов и прогоняет эндпоинты
+FastAPI-приложения в том же процессе. По каждому этапу считаются p50/p95 задержки,
+изображений и фрагментов в секунду и пиковый RSS; результат сохраняется в JSON
+и может сравниваться с предыдущим прогоном.
+
+Запуск из папки backend:
+    python benchmark.py --sizes 2048,8192 --images 4 --output bench.json --baseline old.json
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from datetime import datetime
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+from PIL import Image
+
+# Папка моделей считается от папки backend, пути аргументов - от исходной
+INVOCATION_DIR = os.getcwd()
+os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+from configfile import config_path, load_config  # noqa: E402
+from inference import SliceBatcher  # noqa: E402
+from registry import ModelEntry, ModelRegistry  # noqa: E402
+
+
+# Классы, которые "находит" заглушка
+STUB_CLASSES = ["car", "truck", "ship", "plane"]
+
+
+class _StubArray:
+    """Обертка numpy-массива с интерфейсом тензора ultralytics (.cpu().numpy())"""
+
+    def __init__(self, array: np.ndarray):
+        self.array = array
+
+    def cpu(self):
+        return self
+
+    def numpy(self) -> np.ndarray:
+        return self.array
+
+
+class _StubBoxes:
+    def __init__(self, boxes: np.ndarray):
+        self.data = _StubArray(boxes)
+
+
+class _StubObb:
+    def __init__(self, boxes: np.ndarray, points: np.ndarray):
+        self.xyxy = _StubArray(boxes[:, :4])
+        self.conf = _StubArray(boxes[:, 4])
+        self.cls = _StubArray(boxes[:, 5])
+        self.xyxyxyxy = _StubArray(points.reshape(-1, 4, 2))
+
+
+class _StubPrediction:
+    def __init__(self, boxes: np.ndarray, points: Optional[np.ndarray]):
+        self.boxes = _StubBoxes(boxes)
+        self.obb = _StubObb(boxes, points) if points is not None else None
+
+
+class StubDetector:
+    """
+    Вызываемая заглушка модели ultralytics.
+
+    Детекции фрагмента зависят только от его содержимого и seed, поэтому прогоны
+    воспроизводимы. Число объектов - пуассоновское со средним density на мегапиксель;
+    каждый вызов спит batch_latency + slice_latency * размер пакета.
+    """
+
+    def __init__(
+            self,
+            density: float = 50.0,
+            batch_latency: float = 0.02,
+            slice_latency: float = 0.005,
+            obb: bool = False,
+            seed: int = 0
+    ):
+        self.density = density
+        self.batch_latency = batch_latency
+        self.slice_latency = slice_latency
+        self.obb = obb
+        self.seed = seed
+        self.slices = 0
+        self._lock = threading.Lock()
+
+    def _predict(self, image: np.ndarray) -> _StubPrediction:
+        height, width = image.shape[:2]
+        rng = np.random.default_rng(zlib.crc32(image[::16, ::16].tobytes()) ^ self.seed)
+        count = rng.poisson(self.density * height * width / 1e6)
+        size = rng.uniform(8, 48, (count, 2))
+        center = rng.uniform(0, 1, (count, 2)) * [width, height]
+        angle = rng.uniform(-np.pi / 2, np.pi / 2, count)
+        conf = rng.uniform(0.05, 1.0, count)
+        cls = rng.integers(0, len(STUB_CLASSES), count)
+
+        # Вершины прямоугольников в порядке xyxyxyxy, для OBB - повернутых на angle
+        offsets = np.array([[1, 1], [-1, 1], [-1, -1], [1, -1]]) * 0.5
+        local = offsets[None] * size[:, None, :]
+        if self.obb:
+            cos, sin = np.cos(angle)[:, None], np.sin(angle)[:, None]
+            local = np.stack([
+                local[..., 0] * cos - local[..., 1] * sin,
+                local[..., 0] * sin + local[..., 1] * cos
+            ], axis=-1)
+        corners = np.clip(local + center[:, None, :], 0, [width, height])
+
+        boxes = np.column_stack([corners.min(axis=1), corners.max(axis=1), conf, cls]).astype(np.float32)
+        points = corners.reshape(-1, 8).astype(np.float32) if self.obb else None
+        return _StubPrediction(boxes, points)
+
+    def __call__(self, images: List[np.ndarray], **kwargs) -> List[_StubPrediction]:
+        time.sleep(self.batch_latency + self.slice_latency * len(images))
+        with self._lock:
+            self.slices += len(images)
+        return [self._predict(image) for image in images]
+
+
+class StubDetectionModel:
+    """Заглушка AutoDetectionModel SAHI с атрибутами, которые использует конвейер"""
+
+    def __init__(self, detector: StubDetector, confidence_threshold: float):
+        self.model = detector
+        self.is_obb = detector.obb
+        self.category_mapping = {str(index): name for index, name in enumerate(STUB_CLASSES)}
+        self.confidence_threshold = confidence_threshold
+        self.device = "cpu"
+
+
+class StubModelRegistry(ModelRegistry):
+    """Реестр, загружающий вместо весов заглушку (общую для всех типов моделей)"""
+
+    def __init__(self, models_config: List[dict], detector: StubDetector, **kwargs):
+        super().__init__(models_config, **kwargs)
+        self.detector = detector
+        self.device = "cpu"
+
+    def _load(self, model_type: str) -> ModelEntry:
+        detection_model = StubDetectionModel(self.detector, self.confidence_floor)
+        batcher = SliceBatcher(detection_model, self.batch_size, device_lock=self.device_lock(self.device))
+        return ModelEntry(self.models_config[model_type], detection_model, batcher, 0)
+
+
+def synthetic_image(width: int, height: int, rng: np.random.Generator, empty_fraction: float = 0.0) -> np.ndarray:
+    """Блочная RGB-текстура; нижняя часть высотой empty_fraction залита одним цветом"""
+    cell = 8
+    small = rng.integers(0, 256, (-(-height // cell), -(-width // cell), 3), dtype=np.uint8)
+    image = np.repeat(np.repeat(small, cell, axis=0), cell, axis=1)[:height, :width]
+    empty_rows = int(height * empty_fraction)
+    if empty_rows:
+        image[height - empty_rows:] = 0
+    return np.ascontiguousarray(image)
+
+
+def write_geotiff(path: str, width: int, height: int, rng: np.random.Generator, empty_fraction: float = 0.0):
+    """Тайловый GeoTIFF в EPSG:3857, записывается полосами, чтобы не держать растр в памяти"""
+    from osgeo import gdal, osr
+
+    driver = gdal.GetDriverByName("GTiff")
+    dataset = driver.Create(
+        path, width, height, 3, gdal.GDT_Byte,
+        options=["TILED=YES", "BLOCKXSIZE=512", "BLOCKYSIZE=512", "COMPRESS=DEFLATE", "BIGTIFF=IF_SAFER"]
+    )
+    dataset.SetGeoTransform([4_000_000.0, 0.5, 0.0, 7_500_000.0, 0.0, -0.5])
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(3857)
+    dataset.SetProjection(srs.ExportToWkt())
+    empty_from = height - int(height * empty_fraction)
+    strip = 1024
+    for y in range(0, height, strip):
+        rows = min(strip, height - y)
+        block = synthetic_image(width, rows, rng)
+        if y + rows > empty_from:
+            block[max(0, empty_from - y):] = 0
+        for band in range(3):
+            dataset.GetRasterBand(band + 1).WriteArray(block[:, :, band], 0, y)
+    dataset.FlushCache()
+    dataset = None
+
+
+def generate_dataset(
+        directory: str,
+        sizes: List[int],
+        count: int,
+        formats: List[str],
+        seed: int,
+        empty_fraction: float
+) -> List[str]:
+    """Синтетические изображения: count штук каждого размера и формата"""
+    rng = np.random.default_rng(seed)
+    paths = []
+    for size in sizes:
+        for index in range(count):
+            for image_format in formats:
+                path = os.path.join(directory, f"synthetic_{size}_{index}.{image_format}")
+                if image_format == "tif":
+                    write_geotiff(path, size, size, rng, empty_fraction)
+                else:
+                    Image.fromarray(synthetic_image(size, size, rng, empty_fraction)).save(path)
+                paths.append(path)
+    return paths
+
+
+class RssSampler:
+    """
+    Пиковый RSS процесса за время замера (опрос /proc/self/statm в фоновом потоке)
+    и RSS в начале замера, от которого считается прирост
+    """
+
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.start = 0
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    @staticmethod
+    def current() -> int:
+        try:
+            with open("/proc/self/statm") as f:
+                return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except (OSError, ValueError):
+            import resource
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, self.current())
+
+    def __enter__(self):
+        self.start = self.peak = self.current()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, self.current())
+
+
+def summarize(latencies: List[float], images: int, slices: int, peak_rss: int, errors: int, start_rss: int = 0) -> dict:
+    total = sum(latencies)
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "p50_ms": round(float(np.percentile(latencies, 50)) * 1000, 2) if latencies else None,
+        "p95_ms": round(float(np.percentile(latencies, 95)) * 1000, 2) if latencies else None,
+        "mean_ms": round(total / len(latencies) * 1000, 2) if latencies else None,
+        "total_seconds": round(total, 3),
+        "images_per_second": round(images / total, 3) if total else None,
+        "slices_per_second": round(slices / total, 1) if total and slices else None,
+        "peak_rss_mb": round(peak_rss / 2 ** 20, 1),
+        "rss_growth_mb": round((peak_rss - start_rss) / 2 ** 20, 1)
+    }
+
+
+class Benchmark:
+    def __init__(self, main, client, detector: StubDetector, repeat: int):
+        self.main = main
+        self.client = client
+        self.detector = detector
+        self.repeat = repeat
+        self.results: Dict[str, dict] = {}
+
+    def measure(self, name: str, calls: List[Callable[[], int]]):
+        """
+        Выполняет calls repeat раз. Каждый вызов возвращает число обработанных
+        изображений; исключение или код ответа не 2xx считается ошибкой
+        """
+        latencies = []
+        images = 0
+        errors = 0
+        slices_before = self.detector.slices
+        with RssSampler() as sampler:
+            for _ in range(self.repeat):
+                for call in calls:
+                    start = time.perf_counter()
+                    try:
+                        images += call()
+                    except Exception as e:
+                        errors += 1
+                        print(f"  {name}: {e}", file=sys.stderr)
+                    latencies.append(time.perf_counter() - start)
+        self.results[name] = summarize(
+            latencies, images, self.detector.slices - slices_before, sampler.peak, errors, sampler.start
+        )
+        print(f"{name:>16}: {self.results[name]}")
+
+    def clear_warm_stores(self):
+        """Очищает все хранилища, из которых детекция может взять готовый результат"""
+        self.main.detection_cache.clear()
+        self.main.geo_tile_store.clear()
+        if self.main.decoded_store is not None:
+            self.main.decoded_store.clear()
+
+    def post(self, url: str, **kwargs):
+        response = self.client.post(url, **kwargs)
+        if response.status_code >= 300:
+            raise RuntimeError(f"{url} -> {response.status_code}: {response.text[:200]}")
+        return response
+
+    def run(self, image_paths: List[str]) -> Dict[str, dict]:
+        contents = {path: open(path, "rb").read() for path in image_paths}
+        uploaded = {}
+
+        def upload(path):
+            def call():
+                response = self.post("/upload-images", files={"files": (os.path.basename(path), contents[path])})
+                uploaded[path] = response.json()["results"][0]["uploaded_path"]
+                return 1
+            return call
+
+        self.measure("upload", [upload(path) for path in image_paths])
+
+        # Декодирование целого изображения в файл: прирост RSS должен зависеть от ширины
+        # изображения (одна полоса строк), а не от его площади
+        decoded_store = self.main.decoded_store
+        pngs = [path for path in image_paths if not path.endswith(".tif")]
+        if decoded_store is not None and pngs:
+            def decode(path):
+                def call():
+                    decoded_store.clear()
+                    decoded_store.open(uploaded[path])
+                    return 1
+                return call
+            self.measure("decode", [decode(path) for path in pngs])
+
+        tiffs = [path for path in image_paths if path.endswith(".tif")]
+        if tiffs:
+            def convert(path):
+                def call():
+                    self.post("/convert/tiff-to-png", files={"files": (os.path.basename(path), contents[path])})
+                    return 1
+                return call
+            self.measure("tiff_convert", [convert(path) for path in tiffs])
+
+        results = {}
+
+        def detect(path, cold):
+            def call():
+                if cold:
+                    self.clear_warm_stores()
+                response = self.post("/detect", json={"image_paths": [uploaded[path]]})
+                results[path] = response.json()["results"][0]
+                return 1
+            return call
+
+        self.measure("detect", [detect(path, True) for path in image_paths])
+        self.measure("detect_cached", [detect(path, False) for path in image_paths])
+
+        def draw(path):
+            def call():
+                self.main.draw_bounding_boxes(uploaded[path], results[path]["detections"])
+                return 1
+            return call
+
+        self.measure("draw", [draw(path) for path in image_paths])
+
+        report = list(results.values())
+        exports = {
+            "export_zip": "/export/images-detect",
+            "export_xlsx": "/export/xlsx-data-detect",
+            "export_csv": "/export/csv-data-detect",
+            "export_geojson": "/export/geojson-data-detect"
+        }
+        for name, url in exports.items():
+            def export(url=url):
+                self.post(url, json=report)
+                return len(report)
+            self.measure(name, [export])
+        return self.results
+
+
+def compare(current: Dict[str, dict], baseline: Dict[str, dict]) -> Dict[str, dict]:
+    """Относительное изменение p50/p95 и пропускной способности к базовому прогону (+ значит больше)"""
+    comparison = {}
+    for name, stats in current.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        comparison[name] = {
+            key: round(stats[key] / base[key] - 1, 3)
+            for key in ("p50_ms", "p95_ms", "images_per_second", "slices_per_second", "peak_rss_mb", "rss_growth_mb")
+            if stats.get(key) and base.get(key)
+        }
+    return comparison
+
+
+def environment() -> dict:
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "commit": commit
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark of the detection and export pipeline with a stub model")
+    parser.add_argument("--sizes", default="1024,4096", help="Image sides in pixels, comma separated")
+    parser.add_argument("--images", type=int, default=2, help="Images of each size and format")
+    parser.add_argument("--formats", default="png,tif", help="Image formats: png, tif")
+    parser.add_argument("--repeat", type=int, default=3, help="Repetitions of every measured call")
+    parser.add_argument("--density", type=float, default=50.0, help="Stub objects per megapixel")
+    parser.add_argument("--batch-latency-ms", type=float, default=20.0, help="Stub latency per model call")
+    parser.add_argument("--slice-latency-ms", type=float, default=5.0, help="Stub latency per slice")
+    parser.add_argument("--obb", action="store_true", help="Stub returns rotated boxes")
+    parser.add_argument("--empty-fraction", type=float, default=0.0, help="Share of every image left uniform")
+    parser.add_argument("--slice-size", type=int, default=512)
+    parser.add_argument("--overlap", type=float, default=0.3)
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--skip-empty-slices", action="store_true")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="benchmark.json", help="Where to write results JSON")
+    parser.add_argument("--baseline", help="Results JSON of an earlier run to compare against")
+    return parser.parse_args(argv)
+
+
+def benchmark_config(work_dir: str) -> str:
+    """
+    Копия config.json, в которой все хранилища (загрузки, каталог, кэши, тайлы,
+    декодированные изображения) лежат во временной папке замера
+    """
+    config = load_config(config_path(INVOCATION_DIR))
+    config.setdefault("storage", {})["data_dir"] = os.path.join(work_dir, "data")
+    config.setdefault("cache", {})["dir"] = os.path.join(work_dir, "cache")
+    path = os.path.join(work_dir, "config.json")
+    with open(path, "w") as f:
+        json.dump(config, f, ensure_ascii=False, indent=2)
+    return path
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    work_dir = tempfile.mkdtemp(prefix="benchmark_")
+    # Приложение читает конфигурацию при импорте, поэтому путь задается до него
+    os.environ["DETECTION_API_CONFIG"] = benchmark_config(work_dir)
+    from fastapi.testclient import TestClient
+    import pipeline
+
+    detector = StubDetector(
+        density=args.density,
+        batch_latency=args.batch_latency_ms / 1000,
+        slice_latency=args.slice_latency_ms / 1000,
+        obb=args.obb,
+        seed=args.seed
+    )
+    # Реестр подменяется до импорта приложения, которое берет его из конвейера
+    pipeline.model_registry = StubModelRegistry(
+        pipeline.config['models'],
+        detector,
+        batch_size=args.batch_size,
+        warmup_size=args.slice_size
+    )
+    import main as app_module
+    app_module.save_detect_settings({
+        **app_module.current_detect_settings(),
+        "slice_size": args.slice_size,
+        "overlap_ratio": args.overlap,
+        "batch_size": args.batch_size,
+        "skip_empty_slices": args.skip_empty_slices
+    })
+
+    image_paths = generate_dataset(
+        work_dir,
+        [int(size) for size in args.sizes.split(",")],
+        args.images,
+        args.formats.split(","),
+        args.seed,
+        args.empty_fraction
+    )
+    print(f"Generated {len(image_paths)} images in {work_dir}")
+
+    with TestClient(app_module.app) as client:
+        results = Benchmark(app_module, client, detector, args.repeat).run(image_paths)
+
+    report = {
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "environment": environment(),
+        "params": vars(args),
+        "endpoints": results
+    }
+    if args.baseline:
+        with open(os.path.join(INVOCATION_DIR, args.baseline)) as f:
+            report["comparison"] = compare(results, json.load(f)["endpoints"])
+        for name, change in report["comparison"].items():
+            print(f"{name:>16}: " + ", ".join(f"{key} {value:+.1%}" for key, value in change.items()))
+
+    output_path = os.path.join(INVOCATION_DIR, args.output)
+    with open(output_path, "w") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"Results saved to {output_path}")
+
+
+if __name__ == "__main__":
+    main()
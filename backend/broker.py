@@ -0,0 +1,293 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    job_id TEXT,
+    image_path TEXT NOT NULL,
+    model_type TEXT NOT NULL,
+    options TEXT NOT NULL,
+    group_key TEXT NOT NULL,
+    status TEXT NOT NULL,
+    worker_id TEXT,
+    lease_until REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    result TEXT,
+    error TEXT,
+    created_at REAL NOT NULL,
+    finished_at REAL
+);
+CREATE INDEX IF NOT EXISTS tasks_status ON tasks (status, id);
+CREATE INDEX IF NOT EXISTS tasks_job_id ON tasks (job_id);
+
+CREATE TABLE IF NOT EXISTS workers (
+    worker_id TEXT PRIMARY KEY,
+    host TEXT NOT NULL,
+    pid INTEGER NOT NULL,
+    models TEXT,
+    started_at REAL NOT NULL,
+    last_seen REAL NOT NULL,
+    tasks_done INTEGER NOT NULL DEFAULT 0,
+    tasks_failed INTEGER NOT NULL DEFAULT 0
+);
+"""
+
+# Статусы задач, после которых задача больше не меняется
+FINISHED_STATUSES = ("done", "failed", "cancelled")
+
+
+class TaskCancelled(Exception):
+    """Задача снята с очереди брокера до выполнения"""
+
+
+class TaskBroker:
+    """
+    Очередь задач детекции для отдельных процессов-обработчиков в SQLite.
+
+    Задача - одно изображение с параметрами детекции. Обработчик забирает задачи
+    с арендой на lease_seconds и продлевает ее, пока считает; задачи обработчика,
+    который завершился или пропал, по истечении аренды возвращаются в очередь
+    (не больше max_attempts раз). База лежит в общем хранилище данных (WAL), поэтому
+    обработчики могут запускаться и останавливаться в любой момент, в том числе
+    на других машинах с тем же хранилищем.
+    """
+
+    def __init__(self, db_path: str, lease_seconds: float = 60, max_attempts: int = 3):
+        self.db_path = db_path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        # Соединение SQLite нельзя делить между потоками, у каждого потока свое
+        self._local = threading.local()
+        with self._connect() as connection:
+            connection.executescript(SCHEMA)
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            # Транзакции открываются явно: выдача задач должна быть атомарной между процессами
+            connection = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            connection.row_factory = sqlite3.Row
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    @staticmethod
+    def group_key(model_type: str, options: dict) -> str:
+        """Задачи с одинаковой моделью и параметрами обработчик считает одним пакетом"""
+        payload = json.dumps({"model_type": model_type, **options}, sort_keys=True)
+        return hashlib.sha256(payload.encode()).hexdigest()[:16]
+
+    def submit(self, image_path: str, model_type: str, options: dict, job_id: Optional[str] = None) -> int:
+        connection = self._connect()
+        cursor = connection.execute(
+            """
+            INSERT INTO tasks (job_id, image_path, model_type, options, group_key, status, created_at)
+            VALUES (?, ?, ?, ?, ?, 'queued', ?)
+            """,
+            (job_id, image_path, model_type, json.dumps(options), self.group_key(model_type, options), time.time())
+        )
+        return cursor.lastrowid
+
+    def _requeue_expired(self, connection: sqlite3.Connection, now: float):
+        """Возвращает в очередь задачи с истекшей арендой; после max_attempts попыток - ошибка"""
+        connection.execute(
+            """
+            UPDATE tasks SET status = 'failed', error = 'Worker lost: too many attempts', finished_at = ?
+            WHERE status = 'running' AND lease_until < ? AND attempts >= ?
+            """,
+            (now, now, self.max_attempts)
+        )
+        expired = connection.execute(
+            "UPDATE tasks SET status = 'queued', worker_id = NULL WHERE status = 'running' AND lease_until < ?",
+            (now,)
+        ).rowcount
+        if expired:
+            logger.warning("Requeued %d tasks of lost workers", expired)
+
+    def claim(self, worker_id: str, max_tasks: int = 1, model_types: Optional[List[str]] = None) -> List[dict]:
+        """
+        Выдает обработчику до max_tasks задач одной группы (модель и параметры), начиная
+        с самой старой; None в model_types - любые модели
+        """
+        connection = self._connect()
+        now = time.time()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            self._requeue_expired(connection, now)
+            model_filter, params = "", []
+            if model_types:
+                model_filter = f"AND model_type IN ({','.join('?' * len(model_types))})"
+                params = list(model_types)
+            first = connection.execute(
+                f"SELECT group_key FROM tasks WHERE status = 'queued' {model_filter} ORDER BY id LIMIT 1", params
+            ).fetchone()
+            if first is None:
+                connection.execute("COMMIT")
+                return []
+            rows = connection.execute(
+                "SELECT * FROM tasks WHERE status = 'queued' AND group_key = ? ORDER BY id LIMIT ?",
+                (first["group_key"], max_tasks)
+            ).fetchall()
+            connection.executemany(
+                """
+                UPDATE tasks SET status = 'running', worker_id = ?, lease_until = ?, attempts = attempts + 1
+                WHERE id = ?
+                """,
+                [(worker_id, now + self.lease_seconds, row["id"]) for row in rows]
+            )
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        return [self._task_dict(row) for row in rows]
+
+    @staticmethod
+    def _task_dict(row: sqlite3.Row) -> dict:
+        task = dict(row)
+        task["options"] = json.loads(task["options"])
+        if task["result"] is not None:
+            task["result"] = json.loads(task["result"])
+        return task
+
+    def heartbeat(self, worker_id: str, task_ids: List[int], models: Optional[List[str]] = None):
+        """Продлевает аренду задач обработчика и отмечает, что он жив"""
+        connection = self._connect()
+        now = time.time()
+        connection.execute(
+            """
+            INSERT INTO workers (worker_id, host, pid, models, started_at, last_seen)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT (worker_id) DO UPDATE SET last_seen = excluded.last_seen
+            """,
+            (worker_id, socket.gethostname(), os.getpid(), json.dumps(models), now, now)
+        )
+        if task_ids:
+            connection.execute(
+                f"""
+                UPDATE tasks SET lease_until = ?
+                WHERE worker_id = ? AND status = 'running' AND id IN ({','.join('?' * len(task_ids))})
+                """,
+                [now + self.lease_seconds, worker_id, *task_ids]
+            )
+
+    def _finish(self, task_id: int, worker_id: str, status: str, result: Optional[dict], error: Optional[str]):
+        # Результат обработчика, чья аренда уже передана другому, не записывается
+        connection = self._connect()
+        updated = connection.execute(
+            """
+            UPDATE tasks SET status = ?, result = ?, error = ?, finished_at = ?
+            WHERE id = ? AND worker_id = ? AND status = 'running'
+            """,
+            (
+                status, json.dumps(result, ensure_ascii=False) if result is not None else None,
+                error, time.time(), task_id, worker_id
+            )
+        ).rowcount
+        if updated:
+            counter = "tasks_done" if status == "done" else "tasks_failed"
+            connection.execute(f"UPDATE workers SET {counter} = {counter} + 1 WHERE worker_id = ?", (worker_id,))
+        return updated > 0
+
+    def complete(self, task_id: int, worker_id: str, result: dict) -> bool:
+        return self._finish(task_id, worker_id, "done", result, None)
+
+    def fail(self, task_id: int, worker_id: str, error: str) -> bool:
+        return self._finish(task_id, worker_id, "failed", None, error)
+
+    def finished(self, task_ids: List[int]) -> List[dict]:
+        """Завершенные задачи из task_ids"""
+        if not task_ids:
+            return []
+        rows = self._connect().execute(
+            f"""
+            SELECT * FROM tasks
+            WHERE id IN ({','.join('?' * len(task_ids))}) AND status IN ('done', 'failed', 'cancelled')
+            """,
+            task_ids
+        ).fetchall()
+        return [self._task_dict(row) for row in rows]
+
+    def cancel_job(self, job_id: str) -> int:
+        """Снимает с очереди еще не выданные изображения задачи API; выполняемые досчитываются"""
+        return self._connect().execute(
+            "UPDATE tasks SET status = 'cancelled', finished_at = ? WHERE job_id = ? AND status = 'queued'",
+            (time.time(), job_id)
+        ).rowcount
+
+    def remove_finished(self, older_than_seconds: float = 3600) -> int:
+        """Удаляет завершенные задачи: их результаты уже переданы в API и каталог"""
+        return self._connect().execute(
+            "DELETE FROM tasks WHERE status IN ('done', 'failed', 'cancelled') AND finished_at < ?",
+            (time.time() - older_than_seconds,)
+        ).rowcount
+
+    def stats(self) -> dict:
+        """Число задач по статусам и обработчики, отметившиеся за время аренды"""
+        connection = self._connect()
+        counts = {status: 0 for status in ("queued", "running", *FINISHED_STATUSES)}
+        for row in connection.execute("SELECT status, COUNT(*) AS count FROM tasks GROUP BY status"):
+            counts[row["status"]] = row["count"]
+        workers = connection.execute(
+            "SELECT * FROM workers WHERE last_seen >= ? ORDER BY started_at",
+            (time.time() - self.lease_seconds,)
+        ).fetchall()
+        return {
+            "tasks": counts,
+            "workers": [{**dict(worker), "models": json.loads(worker["models"] or "null")} for worker in workers]
+        }
+
+
+class BrokerClient:
+    """
+    Сторона API: ставит изображения в очередь брокера и ждет результаты.
+
+    Все ожидающие задачи проверяются одним запросом раз в poll_interval секунд,
+    а не отдельным опросом на каждое изображение. run_io - выполнение блокирующих
+    вызовов SQLite вне цикла событий.
+    """
+
+    def __init__(self, broker: TaskBroker, run_io: Callable, poll_interval: float = 0.2):
+        self.broker = broker
+        self.run_io = run_io
+        self.poll_interval = poll_interval
+        self._waiting: Dict[int, asyncio.Future] = {}
+        self._poller = None
+
+    async def detect(self, image_path: str, model_type: str, options: dict, job_id: Optional[str] = None) -> dict:
+        task_id = await self.run_io(self.broker.submit, image_path, model_type, options, job_id)
+        future = asyncio.get_running_loop().create_future()
+        self._waiting[task_id] = future
+        if self._poller is None or self._poller.done():
+            self._poller = asyncio.create_task(self._poll())
+        return await future
+
+    async def _poll(self):
+        while self._waiting:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                tasks = await self.run_io(self.broker.finished, list(self._waiting))
+            except Exception as e:
+                logger.exception("Broker poll failed: %s", e)
+                continue
+            for task in tasks:
+                future = self._waiting.pop(task["id"], None)
+                if future is None or future.done():
+                    continue
+                if task["status"] == "done":
+                    future.set_result(task["result"])
+                elif task["status"] == "cancelled":
+                    future.set_exception(TaskCancelled(f"Task {task['id']} was cancelled"))
+                else:
+                    future.set_exception(Exception(task["error"]))
@@ -0,0 +1,174 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+from inference import RawDetections
+
+
+# Размер блока при хешировании файлов
+HASH_CHUNK_SIZE = 4 * 2 ** 20
+
+# Уже посчитанные хеши: путь -> (размер, mtime, хеш)
+_file_hashes: Dict[str, Tuple[int, float, str]] = {}
+_file_hashes_lock = threading.Lock()
+
+
+def file_content_hash(path: str) -> str:
+    """SHA-256 содержимого файла; повторно файл не читается, пока не изменился"""
+    stat = os.stat(path)
+    with _file_hashes_lock:
+        known = _file_hashes.get(path)
+    if known is not None and known[0] == stat.st_size and known[1] == stat.st_mtime:
+        return known[2]
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    content_hash = digest.hexdigest()
+    with _file_hashes_lock:
+        _file_hashes[path] = (stat.st_size, stat.st_mtime, content_hash)
+    return content_hash
+
+
+def remember_file_hash(path: str, content_hash: str):
+    """Запоминает хеш, уже посчитанный при загрузке файла"""
+    stat = os.stat(path)
+    with _file_hashes_lock:
+        _file_hashes[path] = (stat.st_size, stat.st_mtime, content_hash)
+
+
+class DetectionCache:
+    """
+    Кэш сырых детекций, адресуемый содержимым изображения.
+
+    Ключ - хеш содержимого изображения, файл весов модели и параметры нарезки.
+    Хранятся необъединенные детекции с минимальным порогом модели, поэтому
+    запрос с другим confidence_threshold отвечается из кэша фильтрацией.
+    Перед диском стоит LRU в памяти; при превышении max_disk_mb удаляются
+    самые давно использованные файлы.
+    """
+
+    def __init__(self, cache_dir: str, memory_items: int = 256, max_disk_mb: float = 2048):
+        self.cache_dir = cache_dir
+        self.memory_items = memory_items
+        self.max_disk_bytes = max_disk_mb * 2 ** 20
+        os.makedirs(cache_dir, exist_ok=True)
+        self._memory: "OrderedDict[str, RawDetections]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self._disk_bytes = sum(
+            entry.stat().st_size for entry in os.scandir(cache_dir) if entry.name.endswith(".npz")
+        )
+
+    @staticmethod
+    def make_key(image_hash: str, model_weights: str, **params) -> str:
+        payload = json.dumps({"image": image_hash, "model": model_weights, **params}, sort_keys=True)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.npz")
+
+    def _remember(self, key: str, raw: RawDetections):
+        self._memory[key] = raw
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_items:
+            self._memory.popitem(last=False)
+
+    def get(self, key: str) -> Optional[RawDetections]:
+        with self._lock:
+            raw = self._memory.get(key)
+            if raw is not None:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return raw
+        path = self._path(key)
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                points = data["points"] if data["has_points"] else None
+                skipped = data["skipped"] if "skipped" in data.files else None
+                slice_count = int(data["slice_count"]) if "slice_count" in data.files else 0
+                raw = RawDetections(data["boxes"], points, data["full_shape"].tolist(), slice_count, skipped)
+            # Время доступа нужно для вытеснения с диска
+            os.utime(path)
+        except (FileNotFoundError, OSError, KeyError, ValueError):
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+            self._remember(key, raw)
+        return raw
+
+    def put(self, key: str, raw: RawDetections):
+        path = self._path(key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(
+                f,
+                boxes=raw.boxes,
+                points=raw.points if raw.points is not None else np.zeros((0, 8), dtype=np.float32),
+                has_points=np.array(raw.points is not None),
+                full_shape=np.array(raw.full_shape),
+                slice_count=np.array(raw.slice_count),
+                skipped=raw.skipped
+            )
+        size = os.path.getsize(tmp_path)
+        try:
+            size -= os.path.getsize(path)
+        except FileNotFoundError:
+            pass
+        os.replace(tmp_path, path)
+        with self._lock:
+            self._remember(key, raw)
+            self._disk_bytes += size
+            over_budget = self._disk_bytes > self.max_disk_bytes
+        if over_budget:
+            self._evict_disk()
+
+    def _evict_disk(self):
+        """Удаляет самые давно использованные файлы, пока кэш не уложится в 90% бюджета"""
+        entries = sorted(
+            (entry for entry in os.scandir(self.cache_dir) if entry.name.endswith(".npz")),
+            key=lambda entry: entry.stat().st_mtime
+        )
+        total = sum(entry.stat().st_size for entry in entries)
+        target = self.max_disk_bytes * 0.9
+        for entry in entries:
+            if total <= target:
+                break
+            try:
+                size = entry.stat().st_size
+                os.remove(entry.path)
+            except FileNotFoundError:
+                continue
+            total -= size
+            with self._lock:
+                self._memory.pop(entry.name[:-len(".npz")], None)
+        with self._lock:
+            self._disk_bytes = total
+
+    def clear(self):
+        """Удаляет все сохраненные детекции (память и диск)"""
+        with self._lock:
+            self._memory.clear()
+            for entry in os.scandir(self.cache_dir):
+                if entry.name.endswith(".npz"):
+                    os.remove(entry.path)
+            self._disk_bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            requests = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / requests, 3) if requests else None,
+                "memory_items": len(self._memory),
+                "disk_mb": round(self._disk_bytes / 2 ** 20, 1)
+            }
@@ -0,0 +1,392 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import List, Optional, Tuple
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS uploads (
+    path TEXT PRIMARY KEY,
+    content_hash TEXT NOT NULL,
+    original_filename TEXT NOT NULL,
+    size_bytes INTEGER NOT NULL,
+    width INTEGER,
+    height INTEGER,
+    bands INTEGER,
+    geotransform TEXT,
+    projection TEXT,
+    created_at REAL NOT NULL,
+    last_access REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS uploads_content_hash ON uploads (content_hash);
+CREATE INDEX IF NOT EXISTS uploads_last_access ON uploads (last_access);
+
+CREATE TABLE IF NOT EXISTS detection_runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    image_path TEXT NOT NULL,
+    content_hash TEXT,
+    model_type TEXT NOT NULL,
+    confidence_threshold REAL NOT NULL,
+    detection_count INTEGER NOT NULL,
+    result TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS detection_runs_image_path ON detection_runs (image_path, created_at);
+CREATE INDEX IF NOT EXISTS detection_runs_content_hash ON detection_runs (content_hash, created_at);
+
+CREATE TABLE IF NOT EXISTS settings (
+    name TEXT PRIMARY KEY,
+    value TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    cancel_requested INTEGER NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL,
+    finished_at REAL,
+    heartbeat_at REAL NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS job_images (
+    job_id TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    image_path TEXT NOT NULL,
+    status TEXT NOT NULL,
+    error TEXT,
+    PRIMARY KEY (job_id, position)
+);
+
+CREATE TABLE IF NOT EXISTS job_events (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    job_id TEXT NOT NULL,
+    event TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS job_events_job_id ON job_events (job_id, id);
+"""
+
+
+class Catalog:
+    """
+    Каталог загрузок и запусков детекции в SQLite.
+
+    Хранит исходные имена, хеши содержимого и метаданные растров загруженных файлов,
+    сохраненные результаты детекции, настройки детекции API и состояние фоновых задач
+    с их событиями. База лежит рядом с данными, поэтому каталог переживает перезапуск
+    и общий для нескольких процессов uvicorn (WAL).
+    Загрузки, к которым не обращались дольше ttl_hours, удаляются вместе с файлами.
+    """
+
+    def __init__(self, db_path: str, ttl_hours: Optional[float] = 72):
+        self.db_path = db_path
+        self.ttl_seconds = ttl_hours * 3600 if ttl_hours else None
+        # Соединение SQLite нельзя делить между потоками, у каждого потока свое
+        self._local = threading.local()
+        with self._connect() as connection:
+            connection.executescript(SCHEMA)
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.db_path, timeout=30)
+            connection.row_factory = sqlite3.Row
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def add_upload(
+            self,
+            path: str,
+            content_hash: str,
+            original_filename: str,
+            size_bytes: int,
+            raster_info: Optional[dict] = None
+    ):
+        """Регистрирует загруженный файл; повторная загрузка того же содержимого обновляет запись"""
+        raster_info = raster_info or {}
+        geotransform = raster_info.get("geotransform")
+        now = time.time()
+        with self._connect() as connection:
+            connection.execute(
+                """
+                INSERT INTO uploads (path, content_hash, original_filename, size_bytes, width, height, bands,
+                                     geotransform, projection, created_at, last_access)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (path) DO UPDATE SET
+                    original_filename = excluded.original_filename,
+                    last_access = excluded.last_access
+                """,
+                (
+                    path, content_hash, original_filename, size_bytes,
+                    raster_info.get("width"), raster_info.get("height"), raster_info.get("bands"),
+                    json.dumps(geotransform) if geotransform is not None else None,
+                    raster_info.get("projection"), now, now
+                )
+            )
+
+    @staticmethod
+    def _upload_dict(row: sqlite3.Row) -> dict:
+        upload = dict(row)
+        if upload["geotransform"] is not None:
+            upload["geotransform"] = json.loads(upload["geotransform"])
+        return upload
+
+    def get_upload(self, path: str) -> Optional[dict]:
+        row = self._connect().execute("SELECT * FROM uploads WHERE path = ?", (path,)).fetchone()
+        return self._upload_dict(row) if row is not None else None
+
+    def upload_by_hash(self, content_hash: str) -> Optional[dict]:
+        row = self._connect().execute(
+            "SELECT * FROM uploads WHERE content_hash = ? ORDER BY last_access DESC LIMIT 1", (content_hash,)
+        ).fetchone()
+        return self._upload_dict(row) if row is not None else None
+
+    def original_filename(self, path: str) -> Optional[str]:
+        row = self._connect().execute("SELECT original_filename FROM uploads WHERE path = ?", (path,)).fetchone()
+        return row["original_filename"] if row is not None else None
+
+    def touch(self, paths: List[str]):
+        """Отмечает обращение к загрузкам, отодвигая их удаление по TTL"""
+        now = time.time()
+        with self._connect() as connection:
+            connection.executemany("UPDATE uploads SET last_access = ? WHERE path = ?", [(now, path) for path in paths])
+
+    def add_run(
+            self,
+            image_path: str,
+            content_hash: Optional[str],
+            model_type: str,
+            confidence_threshold: float,
+            result: dict
+    ) -> int:
+        """Сохраняет результат детекции изображения, возвращает id запуска"""
+        with self._connect() as connection:
+            cursor = connection.execute(
+                """
+                INSERT INTO detection_runs (image_path, content_hash, model_type, confidence_threshold,
+                                            detection_count, result, created_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                """,
+                (
+                    image_path, content_hash, model_type, confidence_threshold,
+                    len(result["detections"]), json.dumps(result, ensure_ascii=False), time.time()
+                )
+            )
+            return cursor.lastrowid
+
+    @staticmethod
+    def _run_dict(row: Optional[sqlite3.Row]) -> Optional[dict]:
+        if row is None:
+            return None
+        run = dict(row)
+        run["result"] = json.loads(run["result"])
+        return run
+
+    def get_run(self, run_id: int) -> Optional[dict]:
+        row = self._connect().execute("SELECT * FROM detection_runs WHERE id = ?", (run_id,)).fetchone()
+        return self._run_dict(row)
+
+    def latest_run_by_hash(self, content_hash: str) -> Optional[dict]:
+        """Последний запуск детекции по содержимому изображения (тот же хеш, что и у тайлов)"""
+        row = self._connect().execute(
+            "SELECT * FROM detection_runs WHERE content_hash = ? ORDER BY created_at DESC, id DESC LIMIT 1", (content_hash,)
+        ).fetchone()
+        return self._run_dict(row)
+
+    def expire(self, now: Optional[float] = None) -> List[dict]:
+        """
+        Удаляет из каталога загрузки, к которым не обращались дольше TTL, их запуски детекции
+        и все запуски старше TTL.
+        Возвращает удаленные записи; файлы на диске удаляет вызывающий.
+        """
+        if self.ttl_seconds is None:
+            return []
+        cutoff = (now or time.time()) - self.ttl_seconds
+        connection = self._connect()
+        # Блокировка на запись сразу, чтобы два процесса не удаляли одно и то же
+        with connection:
+            connection.execute("BEGIN IMMEDIATE")
+            rows = connection.execute("SELECT * FROM uploads WHERE last_access < ?", (cutoff,)).fetchall()
+            paths = [(row["path"],) for row in rows]
+            connection.executemany("DELETE FROM detection_runs WHERE image_path = ?", paths)
+            connection.executemany("DELETE FROM uploads WHERE path = ?", paths)
+            # Запуски по файлам вне каталога (пути из /detect) тоже живут не дольше TTL
+            connection.execute("DELETE FROM detection_runs WHERE created_at < ?", (cutoff,))
+        return [self._upload_dict(row) for row in rows]
+
+    def get_settings(self, name: str) -> Optional[dict]:
+        row = self._connect().execute("SELECT value FROM settings WHERE name = ?", (name,)).fetchone()
+        return json.loads(row["value"]) if row is not None else None
+
+    def put_settings(self, name: str, value: dict):
+        with self._connect() as connection:
+            connection.execute(
+                """
+                INSERT INTO settings (name, value, updated_at) VALUES (?, ?, ?)
+                ON CONFLICT (name) DO UPDATE SET value = excluded.value, updated_at = excluded.updated_at
+                """,
+                (name, json.dumps(value, ensure_ascii=False), time.time())
+            )
+
+    def add_job(self, job_id: str, image_paths: List[str], created_at: float):
+        with self._connect() as connection:
+            connection.execute(
+                "INSERT INTO jobs (id, status, created_at, heartbeat_at) VALUES (?, 'queued', ?, ?)",
+                (job_id, created_at, created_at)
+            )
+            connection.executemany(
+                "INSERT INTO job_images (job_id, position, image_path, status) VALUES (?, ?, ?, 'queued')",
+                [(job_id, position, image_path) for position, image_path in enumerate(image_paths)]
+            )
+
+    def delete_job(self, job_id: str):
+        with self._connect() as connection:
+            self._delete_jobs(connection, [(job_id,)])
+
+    @staticmethod
+    def _delete_jobs(connection: sqlite3.Connection, job_ids: List[tuple]):
+        connection.executemany("DELETE FROM job_events WHERE job_id = ?", job_ids)
+        connection.executemany("DELETE FROM job_images WHERE job_id = ?", job_ids)
+        connection.executemany("DELETE FROM jobs WHERE id = ?", job_ids)
+
+    def set_job_status(self, job_id: str, status: str):
+        with self._connect() as connection:
+            connection.execute("UPDATE jobs SET status = ? WHERE id = ?", (status, job_id))
+
+    def set_job_image(
+            self,
+            job_id: str,
+            position: int,
+            status: str,
+            error: Optional[str] = None,
+            event: Optional[dict] = None
+    ):
+        """Меняет состояние изображения задачи и, если передано, добавляет событие - одной транзакцией"""
+        with self._connect() as connection:
+            connection.execute(
+                "UPDATE job_images SET status = ?, error = ? WHERE job_id = ? AND position = ?",
+                (status, error, job_id, position)
+            )
+            if event is not None:
+                self._add_job_event(connection, job_id, event)
+
+    def cancel_queued_job_images(self, job_id: str):
+        with self._connect() as connection:
+            connection.execute(
+                "UPDATE job_images SET status = 'cancelled' WHERE job_id = ? AND status = 'queued'", (job_id,)
+            )
+
+    def finish_job(self, job_id: str, status: str, finished_at: float, event: dict):
+        with self._connect() as connection:
+            connection.execute(
+                "UPDATE jobs SET status = ?, finished_at = ? WHERE id = ?", (status, finished_at, job_id)
+            )
+            self._add_job_event(connection, job_id, event)
+
+    @staticmethod
+    def _add_job_event(connection: sqlite3.Connection, job_id: str, event: dict):
+        connection.execute(
+            "INSERT INTO job_events (job_id, event) VALUES (?, ?)", (job_id, json.dumps(event, ensure_ascii=False))
+        )
+
+    def add_job_event(self, job_id: str, event: dict):
+        with self._connect() as connection:
+            self._add_job_event(connection, job_id, event)
+
+    def job_events(self, job_id: str, after_id: int = 0) -> List[Tuple[int, dict]]:
+        """События задачи с id больше after_id в порядке публикации"""
+        rows = self._connect().execute(
+            "SELECT id, event FROM job_events WHERE job_id = ? AND id > ? ORDER BY id", (job_id, after_id)
+        ).fetchall()
+        return [(row["id"], json.loads(row["event"])) for row in rows]
+
+    def get_job(self, job_id: str) -> Optional[dict]:
+        """Задача с состоянием изображений по порядку image_paths"""
+        connection = self._connect()
+        row = connection.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        job["images"] = [
+            dict(image) for image in connection.execute(
+                "SELECT image_path, status, error FROM job_images WHERE job_id = ? ORDER BY position", (job_id,)
+            )
+        ]
+        return job
+
+    def job_state(self, job_id: str) -> Optional[sqlite3.Row]:
+        """Завершение и последний сигнал процесса задачи без списка изображений"""
+        return self._connect().execute(
+            "SELECT finished_at, heartbeat_at FROM jobs WHERE id = ?", (job_id,)
+        ).fetchone()
+
+    def request_job_cancel(self, job_id: str) -> bool:
+        """Отмечает задачу для отмены процессом, который ее выполняет; False, если задачи нет"""
+        with self._connect() as connection:
+            cursor = connection.execute("UPDATE jobs SET cancel_requested = 1 WHERE id = ?", (job_id,))
+            return cursor.rowcount > 0
+
+    def heartbeat_jobs(self, job_ids: List[str]) -> List[str]:
+        """
+        Отмечает, что процесс еще выполняет задачи job_ids.
+        Возвращает те из них, отмену которых запросили (в том числе другие процессы)
+        """
+        if not job_ids:
+            return []
+        now = time.time()
+        with self._connect() as connection:
+            connection.executemany("UPDATE jobs SET heartbeat_at = ? WHERE id = ?", [(now, job_id) for job_id in job_ids])
+            rows = connection.execute(
+                f"SELECT id FROM jobs WHERE cancel_requested = 1 AND id IN ({','.join('?' * len(job_ids))})", job_ids
+            ).fetchall()
+        return [row["id"] for row in rows]
+
+    def fail_stale_job(self, job_id: str, cutoff: float) -> bool:
+        """
+        Завершает со статусом failed задачу, процесс которой не подавал сигнал с cutoff
+        (остановлен или перезапущен). True только для вызова, который ее завершил
+        """
+        with self._connect() as connection:
+            cursor = connection.execute(
+                """
+                UPDATE jobs SET status = 'failed', finished_at = ?
+                WHERE id = ? AND finished_at IS NULL AND heartbeat_at < ?
+                """,
+                (time.time(), job_id, cutoff)
+            )
+            if cursor.rowcount == 0:
+                return False
+            connection.execute(
+                """
+                UPDATE job_images SET status = 'error', error = 'Job was interrupted'
+                WHERE job_id = ? AND status IN ('queued', 'running')
+                """,
+                (job_id,)
+            )
+        return True
+
+    def expire_jobs(self, cutoff: float) -> int:
+        """Удаляет задачи, завершенные до cutoff, и задачи, процесс которых пропал до cutoff"""
+        connection = self._connect()
+        with connection:
+            connection.execute("BEGIN IMMEDIATE")
+            job_ids = [tuple(row) for row in connection.execute(
+                "SELECT id FROM jobs WHERE finished_at < ? OR (finished_at IS NULL AND heartbeat_at < ?)",
+                (cutoff, cutoff)
+            )]
+            self._delete_jobs(connection, job_ids)
+        return len(job_ids)
+
+    def stats(self) -> dict:
+        connection = self._connect()
+        uploads, size = connection.execute("SELECT COUNT(*), COALESCE(SUM(size_bytes), 0) FROM uploads").fetchone()
+        runs = connection.execute("SELECT COUNT(*) FROM detection_runs").fetchone()[0]
+        return {
+            "uploads": uploads,
+            "uploads_bytes": size,
+            "detection_runs": runs,
+            "db_bytes": os.path.getsize(self.db_path)
+        }
@@ -0,0 +1,211 @@
+"""
+Сравнение бэкендов инференса одной модели: точность относительно эталона и пропускная способность.
+
+Загружает модель из config.json в каждом бэкенде (первый - эталон, обычно torch), прогоняет
+одни и те же фрагменты изображений и сопоставляет детекции с эталонными по классу и IoU.
+По каждому бэкенду считаются доля совпавших объектов (recall/precision относительно эталона),
+средний IoU совпавших рамок, расхождение уверенности, время загрузки, задержка пакета
+и фрагментов в секунду. Результат сохраняется в JSON; код возврата 1, если какой-то
+бэкенд не прошел проверку точности.
+
+Запуск из папки backend:
+    python compare_backends.py --model visible --backends torch,onnx,openvino --images a.tif b.png
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from typing import List, Optional
+
+import numpy as np
+
+# Пути из config.json (модели, экспорт) считаются от папки backend, пути аргументов - от исходной
+INVOCATION_DIR = os.getcwd()
+os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+from configfile import config_path, load_config  # noqa: E402
+from inference import run_model_batch  # noqa: E402
+from raster import open_image_source  # noqa: E402
+from registry import ModelRegistry  # noqa: E402
+
+
+def load_slices(image_paths: List[str], slice_size: int, limit: int) -> List[np.ndarray]:
+    """Первые limit фрагментов изображений без перекрытия; без изображений - синтетические"""
+    slices = []
+    for image_path in image_paths:
+        source = open_image_source(os.path.join(INVOCATION_DIR, image_path))
+        try:
+            for y in range(0, max(1, source.height - slice_size + 1), slice_size):
+                for x in range(0, max(1, source.width - slice_size + 1), slice_size):
+                    if len(slices) >= limit:
+                        return slices
+                    x2, y2 = min(x + slice_size, source.width), min(y + slice_size, source.height)
+                    slices.append(source.read(x, y, x2, y2))
+        finally:
+            source.close()
+    if not slices:
+        print("No images given: synthetic slices measure throughput only, parity is meaningless")
+        rng = np.random.default_rng(0)
+        slices = [rng.integers(0, 256, (slice_size, slice_size, 3), dtype=np.uint8) for _ in range(limit)]
+    return slices
+
+
+def box_iou(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """Попарный IoU рамок xyxy: (N, 4) x (M, 4) -> (N, M)"""
+    x1 = np.maximum(a[:, None, 0], b[None, :, 0])
+    y1 = np.maximum(a[:, None, 1], b[None, :, 1])
+    x2 = np.minimum(a[:, None, 2], b[None, :, 2])
+    y2 = np.minimum(a[:, None, 3], b[None, :, 3])
+    intersection = np.clip(x2 - x1, 0, None) * np.clip(y2 - y1, 0, None)
+    area_a = (a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1])
+    area_b = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+    return intersection / np.maximum(area_a[:, None] + area_b[None, :] - intersection, 1e-9)
+
+
+def match_predictions(reference: np.ndarray, candidate: np.ndarray, iou_threshold: float):
+    """
+    Жадное сопоставление детекций (x1, y1, x2, y2, conf, cls) одного фрагмента по убыванию
+    уверенности эталона; возвращает пары (IoU, разница уверенности) совпавших объектов
+    """
+    if len(reference) == 0 or len(candidate) == 0:
+        return []
+    iou = box_iou(reference[:, :4], candidate[:, :4])
+    iou[reference[:, None, 5] != candidate[None, :, 5]] = 0
+    pairs = []
+    used = np.zeros(len(candidate), dtype=bool)
+    for i in np.argsort(-reference[:, 4]):
+        row = np.where(used, 0, iou[i])
+        j = int(np.argmax(row))
+        if row[j] >= iou_threshold:
+            used[j] = True
+            pairs.append((float(row[j]), abs(float(reference[i, 4] - candidate[j, 4]))))
+    return pairs
+
+
+def parity(
+        reference: List[np.ndarray],
+        candidate: List[np.ndarray],
+        confidence: float,
+        iou_threshold: float
+) -> dict:
+    """Совпадение детекций бэкенда с эталоном на тех же фрагментах"""
+    reference = [boxes[boxes[:, 4] >= confidence] for boxes in reference]
+    candidate = [boxes[boxes[:, 4] >= confidence] for boxes in candidate]
+    pairs = [pair for ref, cand in zip(reference, candidate) for pair in match_predictions(ref, cand, iou_threshold)]
+    reference_count = sum(len(boxes) for boxes in reference)
+    candidate_count = sum(len(boxes) for boxes in candidate)
+    return {
+        "reference_objects": reference_count,
+        "objects": candidate_count,
+        "matched": len(pairs),
+        "recall": round(len(pairs) / reference_count, 4) if reference_count else 1.0,
+        "precision": round(len(pairs) / candidate_count, 4) if candidate_count else 1.0,
+        "mean_iou": round(float(np.mean([iou for iou, _ in pairs])), 4) if pairs else None,
+        "mean_confidence_delta": round(float(np.mean([delta for _, delta in pairs])), 4) if pairs else None,
+        "max_confidence_delta": round(float(np.max([delta for _, delta in pairs])), 4) if pairs else None
+    }
+
+
+def measure(detection_model, slices: List[np.ndarray], batch_size: int, repeat: int):
+    """Предсказания первого прохода и задержки пакетов всех проходов"""
+    predictions = None
+    latencies = []
+    for _ in range(repeat):
+        current = []
+        for start in range(0, len(slices), batch_size):
+            batch_start = time.perf_counter()
+            current.extend(run_model_batch(detection_model, slices[start:start + batch_size]))
+            latencies.append(time.perf_counter() - batch_start)
+        if predictions is None:
+            predictions = [boxes for boxes, _ in current]
+    total = sum(latencies)
+    return predictions, {
+        "batches": len(latencies),
+        "p50_batch_ms": round(float(np.percentile(latencies, 50)) * 1000, 2),
+        "p95_batch_ms": round(float(np.percentile(latencies, 95)) * 1000, 2),
+        "slices_per_second": round(len(slices) * repeat / total, 1)
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Accuracy parity and throughput of inference backends")
+    parser.add_argument("--model", default="visible", help="Model type from config.json")
+    parser.add_argument(
+        "--backends", default="torch,onnx,openvino", help="Backends to compare, the first is the reference"
+    )
+    parser.add_argument("--images", nargs="*", default=[], help="Images to cut slices from")
+    parser.add_argument("--slices", type=int, default=64, help="Number of slices")
+    parser.add_argument("--slice-size", type=int, default=512)
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--repeat", type=int, default=3, help="Passes over the slices")
+    parser.add_argument("--threads", type=int, help="Intra-op threads for onnx/openvino (default: from config)")
+    parser.add_argument("--half", action="store_true", help="Use fp16 for every backend")
+    parser.add_argument("--confidence", type=float, default=0.25, help="Threshold applied before matching")
+    parser.add_argument("--iou", type=float, default=0.5, help="IoU to count two boxes as one object")
+    parser.add_argument("--min-recall", type=float, default=0.98)
+    parser.add_argument("--min-precision", type=float, default=0.98)
+    parser.add_argument("--max-confidence-delta", type=float, default=0.02, help="Allowed mean confidence delta")
+    parser.add_argument("--output", default="backends.json", help="Where to write results JSON")
+    return parser.parse_args(argv)
+
+
+def check(result: dict, args) -> Optional[str]:
+    """Причина непрохождения проверки точности или None"""
+    if result["recall"] < args.min_recall:
+        return f"recall {result['recall']} < {args.min_recall}"
+    if result["precision"] < args.min_precision:
+        return f"precision {result['precision']} < {args.min_precision}"
+    if result["mean_confidence_delta"] is not None and result["mean_confidence_delta"] > args.max_confidence_delta:
+        return f"mean confidence delta {result['mean_confidence_delta']} > {args.max_confidence_delta}"
+    return None
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    # Та же конфигурация, что у API: DETECTION_API_CONFIG или config.json в корне проекта
+    config = load_config(config_path(INVOCATION_DIR))
+    models_config = [dict(model) for model in config['models']]
+    for model in models_config:
+        if args.threads:
+            model['threads'] = args.threads
+        if args.half:
+            model['half'] = True
+    registry = ModelRegistry(
+        models_config,
+        confidence_floor=config.get('inference', {}).get('confidence_floor', 0.05),
+        warmup_size=args.slice_size,
+        exports_dir=config.get('inference', {}).get('exports_dir')
+    )
+    slices = load_slices(args.images, args.slice_size, args.slices)
+    print(f"{len(slices)} slices of {args.slice_size}px, device {registry.resolve_device()}")
+
+    report = {"model": args.model, "slices": len(slices), "params": vars(args), "backends": {}}
+    reference = None
+    failed = False
+    for backend in args.backends.split(","):
+        start = time.perf_counter()
+        detection_model = registry.load_detection_model(args.model, backend)
+        load_seconds = time.perf_counter() - start
+        predictions, stats = measure(detection_model, slices, args.batch_size, args.repeat)
+        result = {"load_seconds": round(load_seconds, 2), **stats}
+        if reference is None:
+            reference = predictions
+            result["reference"] = True
+        else:
+            result.update(parity(reference, predictions, args.confidence, args.iou))
+            result["failure"] = check(result, args)
+            failed = failed or result["failure"] is not None
+        report["backends"][backend] = result
+        print(f"{backend:>10}: " + ", ".join(f"{key} {value}" for key, value in result.items()))
+        del detection_model
+
+    output_path = os.path.join(INVOCATION_DIR, args.output)
+    with open(output_path, "w") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"Results saved to {output_path}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,28 @@
+"""
+Расположение config.json, общее для API, процессов-обработчиков и утилит замеров,
+чтобы все они читали одну и ту же конфигурацию.
+"""
+import json
+import os
+from typing import Optional
+
+# config.json лежит в корне проекта
+DEFAULT_CONFIG_PATH = os.path.normpath(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "config.json")
+)
+
+
+def config_path(base_dir: Optional[str] = None) -> str:
+    """
+    Путь к config.json: из переменной окружения DETECTION_API_CONFIG (относительный
+    считается от base_dir, по умолчанию от текущей папки) или config.json в корне проекта
+    """
+    path = os.environ.get("DETECTION_API_CONFIG")
+    if not path:
+        return DEFAULT_CONFIG_PATH
+    return os.path.abspath(os.path.join(base_dir or os.getcwd(), path))
+
+
+def load_config(path: str) -> dict:
+    with open(path, 'r') as config_file:
+        return json.load(config_file)
@@ -0,0 +1,185 @@
+import asyncio
+import functools
+import logging
+import os
+import shutil
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
+
+from osgeo import gdal
+
+from raster import byte_rgb_options
+
+gdal.UseExceptions()
+
+logger = logging.getLogger(__name__)
+
+# Форматы результата: драйвер GDAL, расширение, MIME-тип и расширение world-файла
+CONVERT_FORMATS = {
+    "png": ("PNG", ".png", "image/png", ".pgw"),
+    "webp": ("WEBP", ".webp", "image/webp", ".wld"),
+    "jpeg": ("JPEG", ".jpg", "image/jpeg", ".jgw")
+}
+
+
+def write_world_file(path: str, geotransform: List[float]):
+    """World-файл: размер пикселя, повороты и координаты центра левого верхнего пикселя"""
+    x0, dx, rx, y0, ry, dy = geotransform
+    with open(path, "w") as f:
+        for value in (dx, ry, rx, dy, x0 + (dx + rx) / 2, y0 + (ry + dy) / 2):
+            f.write(f"{value}\n")
+
+
+def creation_options(output_format: str, quality: int) -> List[str]:
+    """
+    Параметры драйвера: PNG - быстрое deflate-сжатие (у PNG нет LZW), WEBP и JPEG - качество;
+    WEBP на 100 сохраняется без потерь
+    """
+    if output_format == "png":
+        return ["ZLEVEL=1"]
+    if output_format == "webp":
+        return ["LOSSLESS=YES"] if quality >= 100 else [f"QUALITY={quality}"]
+    return [f"QUALITY={quality}"]
+
+
+class RasterConverter:
+    """
+    Пакетная конвертация растров (TIFF) в PNG, WEBP или JPEG.
+
+    Файлы конвертируются параллельно в собственном пуле потоков (GDAL отпускает GIL),
+    каждый с threads потоками декодирования GeoTIFF, так что потоки пула вместе
+    занимают примерно все ядра. Результаты пакета лежат в своей папке output_dir
+    и удаляются remove_expired через ttl_minutes после создания.
+    """
+
+    def __init__(self, output_dir: str, workers: int = 2, ttl_minutes: float = 60):
+        self.output_dir = output_dir
+        self.workers = workers
+        self.threads = max(1, (os.cpu_count() or 1) // workers)
+        self.ttl_seconds = ttl_minutes * 60
+        self.pool = ThreadPoolExecutor(workers, thread_name_prefix="convert")
+        os.makedirs(output_dir, exist_ok=True)
+
+    def batch_dir(self, batch_id: str) -> str:
+        return os.path.join(self.output_dir, batch_id)
+
+    def new_batch(self) -> str:
+        batch_id = uuid.uuid4().hex
+        os.makedirs(self.batch_dir(batch_id))
+        return batch_id
+
+    def output_path(self, batch_id: str, filename: str) -> Optional[str]:
+        """Путь к файлу результата пакета или None, если его нет"""
+        path = os.path.join(self.batch_dir(os.path.basename(batch_id)), os.path.basename(filename))
+        return path if os.path.isfile(path) else None
+
+    def convert(
+            self,
+            source_path: str,
+            output_path: str,
+            output_format: str = "png",
+            scale: float = 1.0,
+            quality: int = 90,
+            save_georeference: bool = False
+    ) -> Tuple[dict, Optional[str]]:
+        """
+        Конвертирует один растр (блокирующий вызов); scale < 1 уменьшает изображение.
+        Возвращает размеры результата и путь world-файла, если он записан
+        """
+        driver, _, _, world_extension = CONVERT_FORMATS[output_format]
+        source = gdal.Open(source_path, gdal.GA_ReadOnly)
+        png_native = (
+                output_format == "png" and source.RasterCount <= 4 and
+                source.GetRasterBand(1).DataType in (gdal.GDT_Byte, gdal.GDT_UInt16)
+        )
+        # PNG сохраняет исходные каналы и 16 бит, остальное приводится к 8-битному RGB
+        kwargs = {} if png_native else byte_rgb_options(source)
+        if scale != 1.0:
+            kwargs["width"] = max(1, round(source.RasterXSize * scale))
+            kwargs["height"] = max(1, round(source.RasterYSize * scale))
+            kwargs["resampleAlg"] = "average"
+        options = gdal.TranslateOptions(
+            format=driver,
+            creationOptions=creation_options(output_format, quality),
+            **kwargs
+        )
+        # Многопоточное декодирование блоков GeoTIFF, только для потока этого файла
+        gdal.SetThreadLocalConfigOption("GDAL_NUM_THREADS", str(self.threads))
+        try:
+            output = gdal.Translate(output_path, source, options=options)
+        finally:
+            gdal.SetThreadLocalConfigOption("GDAL_NUM_THREADS", None)
+        geotransform = output.GetGeoTransform(can_return_null=True)
+        info = {"width": output.RasterXSize, "height": output.RasterYSize}
+        output = None
+        source = None
+
+        world_path = None
+        if save_georeference and geotransform is not None:
+            world_path = os.path.splitext(output_path)[0] + world_extension
+            write_world_file(world_path, geotransform)
+        # Служебный файл GDAL с метаданными в пакет не попадает
+        aux_path = f"{output_path}.aux.xml"
+        if os.path.exists(aux_path):
+            os.remove(aux_path)
+        return info, world_path
+
+    async def convert_many(self, sources: List[Tuple[str, str]], batch_id: str, **options) -> List[dict]:
+        """
+        Конвертирует пары (путь, исходное имя) параллельно; результат и ошибка - по каждому файлу.
+        Одинаковые имена получают номер, чтобы не перезаписать друг друга
+        """
+        extension = CONVERT_FORMATS[options.get("output_format", "png")][1]
+        loop = asyncio.get_running_loop()
+        used_names = set()
+        tasks = []
+        for source_path, filename in sources:
+            stem = os.path.splitext(os.path.basename(filename))[0]
+            name = f"{stem}{extension}"
+            number = 1
+            while name in used_names:
+                name = f"{stem}_{number}{extension}"
+                number += 1
+            used_names.add(name)
+            output_path = os.path.join(self.batch_dir(batch_id), name)
+            tasks.append(loop.run_in_executor(
+                self.pool, functools.partial(self._timed_convert, source_path, output_path, **options)
+            ))
+        outcomes = await asyncio.gather(*tasks, return_exceptions=True)
+
+        results = []
+        for (source_path, filename), outcome in zip(sources, outcomes):
+            if isinstance(outcome, BaseException):
+                logger.warning("Conversion of %s failed: %s", filename, outcome)
+                results.append({"filename": filename, "error": str(outcome)})
+            else:
+                results.append({"filename": filename, **outcome})
+        return results
+
+    def _timed_convert(self, source_path: str, output_path: str, **options) -> dict:
+        start = time.perf_counter()
+        info, world_path = self.convert(source_path, output_path, **options)
+        return {
+            "output": os.path.basename(output_path),
+            "world_file": os.path.basename(world_path) if world_path else None,
+            "size": os.path.getsize(output_path),
+            **info,
+            "seconds": round(time.perf_counter() - start, 3)
+        }
+
+    def remove_expired(self, now: Optional[float] = None) -> int:
+        """Удаляет папки пакетов старше ttl_minutes"""
+        cutoff = (now or time.time()) - self.ttl_seconds
+        removed = 0
+        for entry in os.scandir(self.output_dir):
+            if entry.is_dir() and entry.stat().st_mtime < cutoff:
+                shutil.rmtree(entry.path, ignore_errors=True)
+                removed += 1
+        if removed:
+            logger.info("Removed %d expired conversion batches", removed)
+        return removed
+
+    def shutdown(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
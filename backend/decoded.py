@@ -0,0 +1,299 @@
+import hashlib
+import os
+import threading
+import uuid
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+import numpy as np
+from osgeo import gdal
+from PIL import Image
+
+from metrics import REGISTRY, span
+
+gdal.UseExceptions()
+
+DECODED_IMAGES = REGISTRY.counter("decoded_images_total", "Whole-image decode requests by outcome")
+
+# Строк изображения, декодируемых и записываемых в файл за один шаг
+STRIP_ROWS = 256
+
+
+class _NpyWriter:
+    """Файл .npy, который пишется полосами строк, без массива целиком в памяти"""
+
+    def __init__(self, path: str, shape: Tuple[int, ...], dtype):
+        self.dtype = np.dtype(dtype)
+        self.file = open(path, "wb")
+        np.lib.format.write_array_header_1_0(self.file, {
+            "descr": np.lib.format.dtype_to_descr(self.dtype),
+            "fortran_order": False,
+            "shape": shape
+        })
+
+    def write(self, strip: np.ndarray):
+        self.file.write(np.ascontiguousarray(strip, dtype=self.dtype).tobytes())
+
+    def close(self):
+        self.file.close()
+
+
+def _to_byte(channel: np.ndarray) -> np.ndarray:
+    """16-битные каналы - старший байт, остальное обрезается до 0..255"""
+    if channel.dtype == np.uint16:
+        return (channel >> 8).astype(np.uint8)
+    return np.clip(channel, 0, 255).astype(np.uint8)
+
+
+def _decode_gdal(dataset, array_path: str, mask_path: str) -> bool:
+    """
+    Декодирует растр полосами по STRIP_ROWS строк: в памяти одновременно одна полоса
+    и блоки кэша GDAL, которые сбрасываются после каждой полосы. Палитра раскрывается в RGB,
+    альфа-канал или nodata дают маску. Возвращает, записана ли маска
+    """
+    width, height = dataset.RasterXSize, dataset.RasterYSize
+    bands = [dataset.GetRasterBand(index) for index in range(1, dataset.RasterCount + 1)]
+    alpha = [band for band in bands if band.GetColorInterpretation() == gdal.GCI_AlphaBand]
+    color = [band for band in bands if band.GetColorInterpretation() != gdal.GCI_AlphaBand][:3]
+    if len(color) < 3:
+        color = color[:1] * 3
+    mask_band = None
+    if alpha:
+        mask_band = alpha[0]
+    elif color[0].GetMaskFlags() != gdal.GMF_ALL_VALID:
+        mask_band = color[0].GetMaskBand()
+    palette = None
+    table = color[0].GetRasterColorTable()
+    if table is not None:
+        palette = np.zeros((256, 3), dtype=np.uint8)
+        for index in range(min(table.GetCount(), 256)):
+            palette[index] = table.GetColorEntry(index)[:3]
+
+    array_file = _NpyWriter(array_path, (height, width, 3), np.uint8)
+    mask_file = _NpyWriter(mask_path, (height, width), bool) if mask_band is not None else None
+    try:
+        for top in range(0, height, STRIP_ROWS):
+            rows = min(STRIP_ROWS, height - top)
+            if palette is not None:
+                strip = palette[color[0].ReadAsArray(0, top, width, rows)]
+            else:
+                strip = np.stack([_to_byte(band.ReadAsArray(0, top, width, rows)) for band in color[:3]], axis=-1)
+            array_file.write(strip)
+            if mask_file is not None:
+                mask_file.write(mask_band.ReadAsArray(0, top, width, rows) > 0)
+            # Прочитанные строки больше не нужны, блоки кэша GDAL освобождаются
+            for band in bands:
+                band.FlushCache()
+    finally:
+        array_file.close()
+        if mask_file is not None:
+            mask_file.close()
+    return mask_file is not None
+
+
+def _decode_pil(image_path: str, array_path: str, mask_path: str) -> bool:
+    """
+    Запасной путь для форматов, которые GDAL не читает: PIL декодирует изображение
+    целиком, в файл оно переносится полосами. Возвращает, записана ли маска
+    """
+    with Image.open(image_path) as image:
+        # Прозрачные пиксели считаются отсутствием данных
+        has_mask = image.mode in ("RGBA", "LA", "PA") or "transparency" in image.info
+        if has_mask:
+            rgba = image.convert("RGBA")
+            mask_file = _NpyWriter(mask_path, (rgba.height, rgba.width), bool)
+            mask_file.write(np.asarray(rgba.getchannel("A")) > 0)
+            mask_file.close()
+            rgb = rgba.convert("RGB")
+            rgba = None
+        else:
+            rgb = image.convert("RGB")
+    width, height = rgb.size
+    array_file = _NpyWriter(array_path, (height, width, 3), np.uint8)
+    try:
+        for top in range(0, height, STRIP_ROWS):
+            array_file.write(np.asarray(rgb.crop((0, top, width, min(top + STRIP_ROWS, height)))))
+    finally:
+        array_file.close()
+    return has_mask
+
+
+class DecodedImageStore:
+    """
+    Декодированные изображения в файлах .npy, отображаемых в память (mmap).
+
+    Изображение, которое нельзя читать окнами GDAL (PNG, JPEG и др.), декодируется один раз
+    в несжатый RGB-массив на диске (и маску прозрачности, если она есть): GDAL читает
+    его полосами строк, так что в памяти процесса не бывает всего изображения
+    (кроме форматов, которые GDAL не читает, - их целиком декодирует PIL). Нарезка,
+    уменьшенные копии и отрисовка разметки во всех процессах (uvicorn, обработчики,
+    пул отрисовки) открывают этот файл только для чтения: страницы общие через кэш ОС,
+    а фрагменты - представления массива без копирования. Отображение освобождается,
+    когда пропадает последняя ссылка на массив или его фрагменты.
+
+    Ключ - путь, размер и время изменения файла. В процессе открытыми держатся
+    mapped_items последних изображений; при превышении max_disk_mb удаляются
+    самые давно использованные файлы.
+    """
+
+    def __init__(self, cache_dir: str, max_disk_mb: float = 4096, mapped_items: int = 16):
+        self.cache_dir = cache_dir
+        self.max_disk_bytes = max_disk_mb * 2 ** 20
+        self.mapped_items = mapped_items
+        os.makedirs(cache_dir, exist_ok=True)
+        self._mapped: "OrderedDict[str, Tuple[np.ndarray, Optional[np.ndarray]]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.decoded = 0
+        # Размер хранилища ведется счетчиком, каталог просматривается только при очистке
+        self._disk_bytes = self._scan_disk_bytes()
+
+    @staticmethod
+    def _key(image_path: str) -> str:
+        stat = os.stat(image_path)
+        payload = f"{os.path.realpath(image_path)}:{stat.st_size}:{stat.st_mtime_ns}"
+        return hashlib.sha256(payload.encode()).hexdigest()[:32]
+
+    def _paths(self, key: str) -> Tuple[str, str]:
+        return os.path.join(self.cache_dir, f"{key}.npy"), os.path.join(self.cache_dir, f"{key}.mask.npy")
+
+    def decoded_path(self, image_path: str) -> Optional[str]:
+        """Файл декодированного изображения, если оно уже декодировано, иначе None"""
+        try:
+            array_path, _ = self._paths(self._key(image_path))
+        except FileNotFoundError:
+            return None
+        return array_path if os.path.exists(array_path) else None
+
+    def open(self, image_path: str) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+        """
+        RGB-массив (H, W, 3) и маска пикселей с данными (или None), отображенные в память
+        только для чтения; изображение декодируется, если его еще нет на диске
+        """
+        if not os.path.exists(image_path):
+            raise FileNotFoundError(f"Image not found: {image_path}")
+        key = self._key(image_path)
+        with self._lock:
+            mapped = self._mapped.get(key)
+            if mapped is not None:
+                self._mapped.move_to_end(key)
+                self.hits += 1
+        if mapped is not None:
+            DECODED_IMAGES.inc(result="mapped")
+            return mapped
+
+        array_path, mask_path = self._paths(key)
+        if os.path.exists(array_path):
+            # Время доступа нужно для вытеснения с диска
+            os.utime(array_path)
+            outcome = "hit"
+        else:
+            self._decode(image_path, array_path, mask_path)
+            outcome = "decoded"
+        DECODED_IMAGES.inc(result=outcome)
+        array = np.load(array_path, mmap_mode="r")
+        mask = np.load(mask_path, mmap_mode="r") if os.path.exists(mask_path) else None
+        with self._lock:
+            if outcome == "hit":
+                self.hits += 1
+            else:
+                self.decoded += 1
+            self._mapped[key] = (array, mask)
+            # Вытесненное отображение закрывается, когда у его фрагментов не останется ссылок
+            while len(self._mapped) > self.mapped_items:
+                self._mapped.popitem(last=False)
+        return array, mask
+
+    def _decode(self, image_path: str, array_path: str, mask_path: str):
+        """
+        Декодирует изображение в файл .npy. Файлы появляются под своими именами целиком
+        (os.replace), так что параллельное декодирование того же изображения в другом
+        процессе безопасно
+        """
+        suffix = f".{uuid.uuid4().hex}.tmp"
+        with span("decode"):
+            try:
+                dataset = gdal.Open(image_path, gdal.GA_ReadOnly)
+            except RuntimeError:
+                dataset = None
+            if dataset is not None:
+                has_mask = _decode_gdal(dataset, array_path + suffix, mask_path + suffix)
+                dataset = None
+            else:
+                has_mask = _decode_pil(image_path, array_path + suffix, mask_path + suffix)
+        size = os.path.getsize(array_path + suffix)
+        if has_mask:
+            size += os.path.getsize(mask_path + suffix)
+            os.replace(mask_path + suffix, mask_path)
+        os.replace(array_path + suffix, array_path)
+        with self._lock:
+            self._disk_bytes += size
+
+    def _scan_disk_bytes(self) -> int:
+        return sum(entry.stat().st_size for entry in os.scandir(self.cache_dir) if entry.name.endswith(".npy"))
+
+    def remove_expired(self) -> int:
+        """
+        Удаляет самые давно использованные изображения (вместе с масками),
+        пока хранилище не уложится в 90% бюджета. Счетчик размера уточняется
+        просмотром каталога: в него пишут и другие процессы
+        """
+        total = self._scan_disk_bytes()
+        with self._lock:
+            self._disk_bytes = total
+        if total <= self.max_disk_bytes:
+            return 0
+        entries = sorted(
+            (
+                entry for entry in os.scandir(self.cache_dir)
+                if entry.name.endswith(".npy") and not entry.name.endswith(".mask.npy")
+            ),
+            key=lambda entry: entry.stat().st_mtime
+        )
+        target = self.max_disk_bytes * 0.9
+        removed = 0
+        for entry in entries:
+            if total <= target:
+                break
+            # Открытые отображения остаются действительными и после удаления файла
+            for path in self._paths(entry.name[:-len(".npy")]):
+                try:
+                    size = os.path.getsize(path)
+                    os.remove(path)
+                except FileNotFoundError:
+                    continue
+                total -= size
+            removed += 1
+        with self._lock:
+            self._disk_bytes = total
+        return removed
+
+    def clear(self):
+        """Закрывает отображения процесса и удаляет все декодированные изображения"""
+        with self._lock:
+            self._mapped.clear()
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith(".npy"):
+                os.remove(entry.path)
+        with self._lock:
+            self._disk_bytes = 0
+
+    def mapped_bytes(self) -> int:
+        """Размер изображений, отображенных в память этим процессом"""
+        with self._lock:
+            return sum(array.nbytes for array, _ in self._mapped.values())
+
+    def disk_bytes(self) -> int:
+        with self._lock:
+            return self._disk_bytes
+
+    def stats(self) -> dict:
+        mapped = self.mapped_bytes()
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "decoded": self.decoded,
+                "mapped_items": len(self._mapped),
+                "mapped_mb": round(mapped / 2 ** 20, 1),
+                "disk_mb": round(self._disk_bytes / 2 ** 20, 1)
+            }
@@ -0,0 +1,339 @@
+import asyncio
+import csv
+import io
+import json
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import AsyncIterator, Callable, Iterable, Iterator, List, Optional, Tuple
+from zipfile import ZIP_STORED, ZipFile
+
+import numpy as np
+from osgeo import ogr
+
+from geo import GEOJSON_CRS, GeoReference, detection_corners, polygons_wkb, spatial_reference
+
+
+# Заголовки табличного отчета
+REPORT_HEADER = ['Изображение', 'Объект', 'Вероятность', 'Координаты']
+
+# Сколько строк CSV собирать в один отправляемый кусок
+CSV_CHUNK_ROWS = 1000
+
+
+# Форматы выгрузки через OGR: драйвер и расширение
+OGR_FORMATS = {
+    "gpkg": ("GPKG", ".gpkg"),
+    "shp": ("ESRI Shapefile", "")
+}
+
+ogr.UseExceptions()
+
+
+# Пул процессов для отрисовки; spawn, чтобы не копировать в дочерние процессы модель и потоки
+_render_pool: Optional[ProcessPoolExecutor] = None
+
+
+def get_render_pool() -> ProcessPoolExecutor:
+    global _render_pool
+    if _render_pool is None:
+        _render_pool = ProcessPoolExecutor(
+            max_workers=os.cpu_count(),
+            mp_context=multiprocessing.get_context("spawn")
+        )
+    return _render_pool
+
+
+class _ZipChunkWriter(io.RawIOBase):
+    """Несдвигаемый поток, накапливающий байты архива до следующей отдачи клиенту"""
+
+    def __init__(self):
+        super().__init__()
+        self._chunks = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def take(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+async def stream_annotated_zip(
+        images: List[Tuple[str, List[dict]]],
+        in_flight: Optional[int] = None,
+        decoded_paths: Optional[dict] = None
+) -> AsyncIterator[bytes]:
+    """
+    Размечает изображения в пуле процессов и отдает ZIP-архив по частям:
+    каждое изображение попадает в архив сразу после отрисовки, без записи на диск.
+    Одновременно отрисовывается не больше in_flight изображений (по умолчанию два на процесс).
+    Изображения, которые не удалось разметить, перечисляются в errors.txt.
+    decoded_paths - уже декодированные изображения (путь -> файл .npy), процессы
+    отрисовки читают их пиксели без повторного декодирования.
+    """
+    # Отрисовка (PIL) нужна только для архива, модуль импортируется при первой выгрузке
+    from render import render_annotated_image
+
+    loop = asyncio.get_running_loop()
+    pool = get_render_pool()
+    if in_flight is None:
+        in_flight = 2 * (os.cpu_count() or 1)
+
+    writer = _ZipChunkWriter()
+    errors = []
+    # Изображения уже сжаты, повторное сжатие только тратит процессор
+    with ZipFile(writer, "w", compression=ZIP_STORED) as zip_file:
+        pending = {}
+        queue = iter(images)
+
+        def schedule():
+            for image_path, detections in queue:
+                future = loop.run_in_executor(
+                    pool, render_annotated_image, image_path, detections, (decoded_paths or {}).get(image_path)
+                )
+                pending[future] = image_path
+                if len(pending) >= in_flight:
+                    break
+
+        schedule()
+        while pending:
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                image_path = pending.pop(future)
+                try:
+                    filename, content = future.result()
+                except FileNotFoundError:
+                    errors.append(f"File not found: {image_path}")
+                    continue
+                except Exception as e:
+                    errors.append(f"Failed to draw bounding boxes for {image_path}: {str(e)}")
+                    continue
+                zip_file.writestr(filename, content)
+                yield writer.take()
+            schedule()
+
+        if errors:
+            zip_file.writestr("errors.txt", "\n".join(errors))
+    yield writer.take()
+
+
+def iter_report_rows(results: Iterable, image_name: Callable[[str], str]) -> Iterator[list]:
+    """Строки отчета по детекциям, по одной на объект, без накопления в памяти"""
+    for result in results:
+        name = image_name(result.image_path)
+        for detect_object in result.detections:
+            yield [
+                name,
+                detect_object['type'],
+                round(float(detect_object['confidence']), 2),
+                str(detect_object['bbox'])
+            ]
+
+
+def write_xlsx_report(results: List, image_name: Callable[[str], str], filepath: str) -> int:
+    """
+    Пишет отчет XLSX в режиме write-only: строки сразу уходят во временный поток openpyxl,
+    ширины столбцов считаются предварительным проходом по данным, а ячейки с одинаковым
+    изображением объединяются по мере записи. Возвращает число строк с объектами.
+    """
+    from openpyxl import Workbook
+    from openpyxl.cell import WriteOnlyCell
+    from openpyxl.styles import Alignment
+    from openpyxl.utils import get_column_letter
+
+    # Ширины нужно задать до первой строки, поэтому сначала проходим по данным
+    widths = [len(title) for title in REPORT_HEADER]
+    rows_count = 0
+    for row in iter_report_rows(results, image_name):
+        rows_count += 1
+        for index, value in enumerate(row):
+            widths[index] = max(widths[index], len(str(value)))
+
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet('Detection')
+    for index, width in enumerate(widths, start=1):
+        ws.column_dimensions[get_column_letter(index)].width = width + 2
+
+    if rows_count:
+        ws.append(REPORT_HEADER)  # Записываем заголовки
+
+        center = Alignment(horizontal='center', vertical='center')
+        current_image = None
+        start_row = 2  # Первая строка данных (после заголовка)
+        row_num = 1
+        for row in iter_report_rows(results, image_name):
+            row_num += 1
+            if row[0] != current_image:
+                # Если значение изменилось, объединяем предыдущую группу
+                if current_image is not None and row_num - 1 > start_row:
+                    ws.merged_cells.add(f"A{start_row}:A{row_num - 1}")
+                current_image = row[0]
+                start_row = row_num
+                # Текст объединенной ячейки берется из первой, ее и центрируем
+                cell = WriteOnlyCell(ws, value=row[0])
+                cell.alignment = center
+                row[0] = cell
+            else:
+                row[0] = None
+            ws.append(row)
+
+        # Объединяем последнюю группу
+        if row_num > start_row:
+            ws.merged_cells.add(f"A{start_row}:A{row_num}")
+
+    wb.save(filepath)
+    return rows_count
+
+
+def stream_csv_report(results: List, image_name: Callable[[str], str]) -> Iterator[str]:
+    """Отдает отчет CSV кусками по CSV_CHUNK_ROWS строк"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    # BOM, чтобы Excel правильно определил кодировку кириллицы
+    buffer.write('\ufeff')
+    writer.writerow(REPORT_HEADER)
+    for index, row in enumerate(iter_report_rows(results, image_name), start=1):
+        writer.writerow(row)
+        if index % CSV_CHUNK_ROWS == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def detection_feature(image: str, detect_object: dict, ring: List[List[float]]) -> dict:
+    """GeoJSON-объект детекции с контуром ring (вершины рамки без замыкающей точки)"""
+    return {
+        "type": "Feature",
+        "geometry": {
+            "type": "Polygon",
+            "coordinates": [ring + ring[:1]]
+        },
+        "properties": {
+            "image": image,
+            "type": detect_object['type'],
+            "confidence": round(float(detect_object['confidence']), 4),
+            "verified": detect_object.get('verified')
+        }
+    }
+
+
+def report_geometry(
+        result,
+        georeference: Callable[[str], Optional[GeoReference]],
+        target: Optional[str] = None
+) -> Tuple[np.ndarray, Optional[str]]:
+    """
+    Вершины рамок детекций изображения (N, 4, 2) и их система координат: для изображений
+    с привязкой - мировые координаты (в target, если задан), иначе пиксели и None
+    """
+    corners = detection_corners(result.detections)
+    reference = georeference(result.image_path)
+    if reference is None:
+        return corners, None
+    return reference.to_world(corners, target), reference.crs(target)
+
+
+def stream_geojson_report(
+        results: List,
+        image_name: Callable[[str], str],
+        georeference: Callable[[str], Optional[GeoReference]]
+) -> Iterator[str]:
+    """
+    Отдает FeatureCollection по одному объекту, не собирая документ в памяти.
+    Детекции изображений с системой координат пересчитываются в EPSG:4326 (RFC 7946).
+    Изображения без нее (пиксели или условная привязка по размеру пикселя) в GeoJSON
+    не попадают: их имена перечислены в поле not_georeferenced, а выгрузить их
+    можно в CSV/XLSX или в отдельный слой GeoPackage/Shapefile
+    """
+    yield '{"type": "FeatureCollection", "features": ['
+    separator = ''
+    skipped = []
+    for result in results:
+        if not result.detections:
+            continue
+        name = image_name(result.image_path)
+        rings, crs = report_geometry(result, georeference, GEOJSON_CRS)
+        if crs is None:
+            skipped.append(name)
+            continue
+        for detect_object, ring in zip(result.detections, rings.tolist()):
+            yield separator + json.dumps(detection_feature(name, detect_object, ring), ensure_ascii=False)
+            separator = ','
+    yield '], "not_georeferenced": ' + json.dumps(skipped, ensure_ascii=False)
+    if skipped:
+        note = "Detections of these images have no coordinate system and are not included"
+        yield ', "note": ' + json.dumps(note)
+    yield '}'
+
+
+def _create_report_layer(datasource, name: str, crs: Optional[str]):
+    layer = datasource.CreateLayer(
+        name,
+        srs=spatial_reference(crs) if crs is not None else None,
+        geom_type=ogr.wkbPolygon
+    )
+    layer.CreateField(ogr.FieldDefn("image", ogr.OFTString))
+    layer.CreateField(ogr.FieldDefn("type", ogr.OFTString))
+    layer.CreateField(ogr.FieldDefn("confidence", ogr.OFTReal))
+    layer.CreateField(ogr.FieldDefn("verified", ogr.OFTInteger))
+    return layer
+
+
+def write_ogr_report(
+        results: List,
+        image_name: Callable[[str], str],
+        georeference: Callable[[str], Optional[GeoReference]],
+        filepath: str,
+        output_format: str = "gpkg",
+        target: Optional[str] = None
+) -> int:
+    """
+    Пишет детекции в GeoPackage или Shapefile (filepath - файл или папка для shp).
+
+    Слои разбиваются по системе координат: для каждой своя "detections..." (при заданном
+    target все изображения с привязкой попадают в один слой), детекции изображений без
+    привязки - в слой detections_pixel в пиксельных координатах. Геометрия собирается
+    в WKB массивно по изображению, запись идет в одной транзакции, если драйвер ее
+    поддерживает. Возвращает число записанных объектов.
+    """
+    driver_name, _ = OGR_FORMATS[output_format]
+    datasource = ogr.GetDriverByName(driver_name).CreateDataSource(filepath)
+    transaction = datasource.TestCapability(ogr.ODsCTransactions)
+    if transaction:
+        datasource.StartTransaction()
+    layers = {}
+    count = 0
+    for result in results:
+        if not result.detections:
+            continue
+        corners, crs = report_geometry(result, georeference, target)
+        layer = layers.get(crs)
+        if layer is None:
+            if crs is None:
+                name = "detections_pixel"
+            else:
+                name = "detections" if not any(key is not None for key in layers) else f"detections_{len(layers) + 1}"
+            layer = layers[crs] = _create_report_layer(datasource, name, crs)
+        definition = layer.GetLayerDefn()
+        name = image_name(result.image_path)
+        for detect_object, wkb in zip(result.detections, polygons_wkb(corners)):
+            feature = ogr.Feature(definition)
+            feature.SetField("image", name)
+            feature.SetField("type", detect_object['type'])
+            feature.SetField("confidence", float(detect_object['confidence']))
+            if detect_object.get('verified') is not None:
+                feature.SetField("verified", int(bool(detect_object['verified'])))
+            feature.SetGeometryDirectly(ogr.CreateGeometryFromWkb(wkb))
+            layer.CreateFeature(feature)
+            count += 1
+    if transaction:
+        datasource.CommitTransaction()
+    datasource = None
+    return count
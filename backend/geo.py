@@ -0,0 +1,160 @@
+import math
+from typing import List, Optional
+
+import numpy as np
+from osgeo import osr
+
+osr.UseExceptions()
+
+# Система координат экспорта GeoJSON по умолчанию (RFC 7946)
+GEOJSON_CRS = "EPSG:4326"
+
+
+def spatial_reference(definition: str) -> osr.SpatialReference:
+    """Система координат из WKT, "EPSG:code" или PROJ-строки; порядок осей всегда x, y"""
+    srs = osr.SpatialReference()
+    srs.SetFromUserInput(definition)
+    srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    return srs
+
+
+def ground_sample_distance(geotransform: Optional[List[float]], projection: Optional[str]) -> Optional[float]:
+    """
+    Размер пикселя на местности в метрах (среднее геометрическое по осям) или None,
+    если у растра нет системы координат. Для географических систем градусы пересчитываются
+    в метры на широте верхнего края растра
+    """
+    if geotransform is None or not projection:
+        return None
+    _, dx, rx, y0, ry, dy = geotransform
+    size_x, size_y = math.hypot(dx, ry), math.hypot(rx, dy)
+    srs = spatial_reference(projection)
+    if srs.IsGeographic():
+        size_x *= 111320.0 * math.cos(math.radians(y0))
+        size_y *= 110540.0
+    elif srs.IsProjected():
+        size_x *= srs.GetLinearUnits()
+        size_y *= srs.GetLinearUnits()
+    else:
+        return None
+    return math.sqrt(size_x * size_y) or None
+
+
+class GeoReference:
+    """
+    Привязка изображения: аффинное преобразование GDAL из пикселей в координаты
+    и, если известна, система координат растра (WKT).
+    """
+
+    def __init__(self, geotransform: List[float], projection: Optional[str] = None):
+        self.geotransform = [float(value) for value in geotransform]
+        self.projection = projection or None
+        self._transforms = {}
+
+    @classmethod
+    def from_pixel_size(cls, pixel_size: float) -> "GeoReference":
+        """Условная привязка без системы координат: метры от левого верхнего угла"""
+        return cls([0.0, pixel_size, 0.0, 0.0, 0.0, -pixel_size])
+
+    def pixel_to_world(self, points: np.ndarray) -> np.ndarray:
+        """Точки (..., 2) в пикселях -> координаты растра, одним матричным проходом"""
+        x0, dx, rx, y0, ry, dy = self.geotransform
+        matrix = np.array([[dx, ry], [rx, dy]])
+        return points.astype(np.float64) @ matrix + [x0, y0]
+
+    def world_to_pixel(self, points: np.ndarray) -> np.ndarray:
+        """Координаты растра (..., 2) -> точки в пикселях (обратное к pixel_to_world)"""
+        x0, dx, rx, y0, ry, dy = self.geotransform
+        inverse = np.linalg.inv(np.array([[dx, ry], [rx, dy]]))
+        return (points.astype(np.float64) - [x0, y0]) @ inverse
+
+    def _transform(self, target: str):
+        transform = self._transforms.get(target)
+        if transform is None:
+            transform = osr.CoordinateTransformation(spatial_reference(self.projection), spatial_reference(target))
+            self._transforms[target] = transform
+        return transform
+
+    def to_world(self, points: np.ndarray, target: Optional[str] = None) -> np.ndarray:
+        """
+        Точки (..., 2) в пикселях -> координаты растра или, если задан target
+        и у растра есть система координат, координаты в target
+        """
+        world = self.pixel_to_world(points)
+        if target is None or self.projection is None:
+            return world
+        flat = world.reshape(-1, 2)
+        if len(flat) == 0:
+            return world
+        transformed = np.array(self._transform(target).TransformPoints(flat.tolist()))[:, :2]
+        return transformed.reshape(world.shape)
+
+    def crs(self, target: Optional[str] = None) -> Optional[str]:
+        """Система координат результата to_world с тем же target"""
+        if self.projection is None:
+            return None
+        return target or self.projection
+
+
+def detection_corners(detections: List[dict]) -> np.ndarray:
+    """
+    Вершины рамок детекций (N, 4, 2) в пикселях: повернутые рамки (rbox) в порядке
+    rbox_corners, обычные - по часовой стрелке от левого верхнего угла
+    """
+    corners = np.empty((len(detections), 4, 2), dtype=np.float64)
+    rotated = np.array([bool(detection.get('rbox')) for detection in detections], dtype=bool)
+    if rotated.any():
+        rbox = np.array([detection['rbox'] for detection, flag in zip(detections, rotated) if flag], dtype=np.float64)
+        cx, cy, w, h, angle = rbox.T
+        cos, sin = np.cos(angle), np.sin(angle)
+        half_w = np.stack([w / 2 * cos, w / 2 * sin], axis=-1)
+        half_h = np.stack([-h / 2 * sin, h / 2 * cos], axis=-1)
+        center = np.stack([cx, cy], axis=-1)
+        corners[rotated] = np.stack([
+            center + half_w + half_h,
+            center + half_w - half_h,
+            center - half_w - half_h,
+            center - half_w + half_h
+        ], axis=1)
+    if not rotated.all():
+        bbox = np.array([detection['bbox'] for detection, flag in zip(detections, rotated) if not flag], dtype=np.float64)
+        x, y, w, h = bbox.T
+        corners[~rotated] = np.stack([
+            np.stack([x, y], axis=-1),
+            np.stack([x + w, y], axis=-1),
+            np.stack([x + w, y + h], axis=-1),
+            np.stack([x, y + h], axis=-1)
+        ], axis=1)
+    return corners
+
+
+def georeference_detections(detections: List[dict], georeference: GeoReference, target: Optional[str] = None):
+    """Добавляет к детекциям их контур в мировых координатах (поле world_polygon)"""
+    if not detections:
+        return
+    world = georeference.to_world(detection_corners(detections), target)
+    for detection, polygon in zip(detections, world.tolist()):
+        detection["world_polygon"] = polygon
+
+
+# WKB полигона с одним кольцом из пяти точек (little endian)
+_POLYGON_WKB = np.dtype([
+    ("byte_order", "u1"),
+    ("geometry_type", "<u4"),
+    ("rings", "<u4"),
+    ("points", "<u4"),
+    ("coords", "<f8", (10,))
+])
+
+
+def polygons_wkb(corners: np.ndarray) -> List[bytes]:
+    """Четырехугольники (N, 4, 2) -> WKB полигонов, собранные одним проходом numpy"""
+    records = np.zeros(len(corners), dtype=_POLYGON_WKB)
+    records["byte_order"] = 1
+    records["geometry_type"] = 3
+    records["rings"] = 1
+    records["points"] = 5
+    records["coords"] = np.concatenate([corners, corners[:, :1]], axis=1).reshape(-1, 10)
+    data = records.tobytes()
+    size = _POLYGON_WKB.itemsize
+    return [data[offset:offset + size] for offset in range(0, len(data), size)]
@@ -0,0 +1,407 @@
+import hashlib
+import math
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from geo import GeoReference, spatial_reference
+from inference import RawDetections
+from raster import open_image_source, resize_image
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS geo_tiles (
+    crs TEXT NOT NULL,
+    model_key TEXT NOT NULL,
+    tile_x INTEGER NOT NULL,
+    tile_y INTEGER NOT NULL,
+    complete INTEGER NOT NULL,
+    signature BLOB NOT NULL,
+    detections BLOB NOT NULL,
+    image_path TEXT NOT NULL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (crs, model_key, tile_x, tile_y)
+);
+CREATE INDEX IF NOT EXISTS geo_tiles_updated_at ON geo_tiles (updated_at);
+"""
+
+# Нижняя граница контраста тайла при сравнении: у однородных тайлов не усиливается шум
+CONTRAST_FLOOR = 8.0
+
+# Метров в градусе для тайлов в географических системах координат
+METERS_PER_DEGREE = 111320.0
+
+# Детекция в хранилище: вершины рамки в координатах растра (8), уверенность, класс
+DETECTION_COLUMNS = 10
+
+TileKey = Tuple[int, int]
+
+
+def crs_key(projection: str) -> str:
+    """Ключ системы координат: код EPSG (или другого реестра), если он есть в WKT, иначе хеш WKT"""
+    srs = spatial_reference(projection)
+    authority, code = srs.GetAuthorityName(None), srs.GetAuthorityCode(None)
+    if authority and code:
+        return f"{authority}:{code}"
+    return hashlib.sha256(srs.ExportToWkt().encode()).hexdigest()[:16]
+
+
+def _normalize(signature: np.ndarray) -> np.ndarray:
+    values = signature.astype(np.float32)
+    return (values - values.mean()) / max(float(values.std()), CONTRAST_FLOOR)
+
+
+def _nearest_difference(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """Разность каждого пикселя b с ближайшим по значению пикселем окрестности 3x3 в a"""
+    height, width = b.shape
+    padded = np.pad(a, 1, mode="edge")
+    difference = np.full(b.shape, np.inf, dtype=np.float32)
+    for dy in range(3):
+        for dx in range(3):
+            difference = np.minimum(difference, np.abs(padded[dy:dy + height, dx:dx + width] - b))
+    return difference
+
+
+def signature_difference(previous: np.ndarray, current: np.ndarray) -> float:
+    """
+    Наибольшее различие уменьшенных копий тайла в единицах их контраста.
+    Яркость и контраст копий выравниваются, а пиксели сравниваются с окрестностью 3x3,
+    так что другая освещенность и сдвиг ортофото на пиксель копии изменением не считаются;
+    появившийся и пропавший объект - считаются
+    """
+    a, b = _normalize(previous), _normalize(current)
+    return float(max(_nearest_difference(a, b).max(), _nearest_difference(b, a).max()))
+
+
+class TilePlan:
+    """
+    Тайлы географической сетки, которые покрывает растр, и решение по каждому.
+    tiles - прямоугольник тайла в пикселях растра (x1, y1, x2, y2), complete - тайлы,
+    целиком покрытые данными растра, signatures - уменьшенные копии тайлов,
+    reused - тайлы, детекции которых берутся из хранилища (stored), остальные пересчитываются
+    """
+
+    def __init__(self, crs: str, model_key: str, georeference: GeoReference, tile_size: float, full_shape: List[int]):
+        self.crs = crs
+        self.model_key = model_key
+        self.georeference = georeference
+        # Сторона тайла в единицах системы координат растра
+        self.tile_size = tile_size
+        self.full_shape = full_shape
+        self.tiles: Dict[TileKey, Tuple[int, int, int, int]] = {}
+        self.complete = set()
+        self.signatures: Dict[TileKey, np.ndarray] = {}
+        self.reused = set()
+        self.stored: Dict[TileKey, np.ndarray] = {}
+
+    @property
+    def recomputed(self) -> List[TileKey]:
+        return [key for key in self.tiles if key not in self.reused]
+
+    def regions(self) -> np.ndarray:
+        """Прямоугольники пересчитываемых тайлов (K, 4) для detect_images_batched"""
+        return np.array([self.tiles[key] for key in self.recomputed], dtype=np.int64).reshape(-1, 4)
+
+    def tile_keys(self, pixels: np.ndarray) -> np.ndarray:
+        """Тайлы (N, 2), в которые попадают точки (N, 2) в пикселях растра"""
+        return np.floor(self.georeference.pixel_to_world(pixels) / self.tile_size).astype(np.int64)
+
+    def to_dict(self) -> dict:
+        return {
+            "crs": self.crs,
+            "tile_size": self.tile_size,
+            "reused": sorted(list(key) for key in self.reused),
+            "recomputed": sorted(list(key) for key in self.recomputed)
+        }
+
+
+def _detection_quads(raw: RawDetections) -> np.ndarray:
+    """Вершины рамок сырых детекций (N, 4, 2) в пикселях"""
+    if raw.points is not None:
+        return raw.points.reshape(-1, 4, 2).astype(np.float64)
+    x1, y1, x2, y2 = raw.boxes[:, :4].astype(np.float64).T
+    return np.stack([
+        np.stack([x1, y1], axis=-1),
+        np.stack([x2, y1], axis=-1),
+        np.stack([x2, y2], axis=-1),
+        np.stack([x1, y2], axis=-1)
+    ], axis=1)
+
+
+class GeoTileStore:
+    """
+    Детекции повторных съемок одних и тех же участков в географической сетке тайлов (SQLite).
+
+    Сетка задается системой координат растра и стороной тайла tile_size_m, поэтому ортофото
+    разных вылетов в одной системе координат делят одни и те же тайлы. По каждому тайлу
+    хранятся сырые детекции с центром в нем (в координатах растра) и уменьшенная копия тайла
+    thumb_size x thumb_size. Тайлы нового растра сравниваются с сохраненными по этим копиям:
+    при различии не больше change_threshold детекции переносятся из хранилища, остальные
+    тайлы пересчитываются моделью. Тайлы на краю растра и с пикселями без данных
+    пересчитываются всегда. Тайлы, которые не использовались ttl_days дней, удаляются.
+    """
+
+    def __init__(
+            self,
+            db_path: str,
+            tile_size_m: float = 64.0,
+            thumb_size: int = 32,
+            change_threshold: float = 1.0,
+            ttl_days: Optional[float] = 90
+    ):
+        self.db_path = db_path
+        self.tile_size_m = tile_size_m
+        self.thumb_size = thumb_size
+        self.change_threshold = change_threshold
+        self.ttl_seconds = ttl_days * 86400 if ttl_days else None
+        self._stats_lock = threading.Lock()
+        self.tiles_reused = 0
+        self.tiles_recomputed = 0
+        # Соединение SQLite нельзя делить между потоками, у каждого потока свое
+        self._local = threading.local()
+        with self._connect() as connection:
+            connection.executescript(SCHEMA)
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.db_path, timeout=30)
+            connection.row_factory = sqlite3.Row
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def tile_size(self, projection: str) -> Optional[float]:
+        """Сторона тайла в единицах системы координат; None для систем без единиц на местности"""
+        srs = spatial_reference(projection)
+        if srs.IsGeographic():
+            return self.tile_size_m / METERS_PER_DEGREE
+        if srs.IsProjected():
+            return self.tile_size_m / srs.GetLinearUnits()
+        return None
+
+    def plan(self, image_path: str, georeference: GeoReference, model_key: str) -> Optional[TilePlan]:
+        """
+        Тайлы растра и решение по каждому (блокирующий вызов);
+        None, если у растра нет системы координат
+        """
+        if georeference.projection is None:
+            return None
+        tile_size = self.tile_size(georeference.projection)
+        if tile_size is None:
+            return None
+        source = open_image_source(image_path)
+        try:
+            plan = TilePlan(
+                crs_key(georeference.projection), model_key, georeference, tile_size, [source.height, source.width]
+            )
+            self._split(plan)
+            self._sign(plan, source)
+        finally:
+            source.close()
+
+        for key, (complete, signature, detections) in self._load(plan).items():
+            current = plan.signatures.get(key)
+            if (
+                    complete and key in plan.complete and signature.shape == current.shape and
+                    signature_difference(signature, current) <= self.change_threshold
+            ):
+                plan.reused.add(key)
+                plan.stored[key] = detections
+        with self._stats_lock:
+            self.tiles_reused += len(plan.reused)
+            self.tiles_recomputed += len(plan.tiles) - len(plan.reused)
+        return plan
+
+    @staticmethod
+    def _split(plan: TilePlan):
+        """Тайлы сетки, пересекающие растр, и их прямоугольники в пикселях"""
+        height, width = plan.full_shape
+        corners = np.array([[0, 0], [width, 0], [width, height], [0, height]], dtype=np.float64)
+        world = plan.georeference.pixel_to_world(corners)
+        first = np.floor(world.min(axis=0) / plan.tile_size).astype(np.int64)
+        last = np.floor(world.max(axis=0) / plan.tile_size).astype(np.int64)
+        tile_x, tile_y = np.meshgrid(
+            np.arange(first[0], last[0] + 1), np.arange(first[1], last[1] + 1), indexing="ij"
+        )
+        keys = np.stack([tile_x.ravel(), tile_y.ravel()], axis=1)
+        offsets = np.array([[0, 0], [1, 0], [1, 1], [0, 1]])
+        pixels = plan.georeference.world_to_pixel((keys[:, None, :] + offsets) * plan.tile_size)
+        # Округление убирает погрешность на границах тайлов, совпадающих с краем растра
+        pixels = np.round(pixels, 6)
+        lower = np.floor(pixels.min(axis=1)).astype(np.int64)
+        upper = np.ceil(pixels.max(axis=1)).astype(np.int64)
+        clipped_lower = np.maximum(lower, 0)
+        clipped_upper = np.minimum(upper, [width, height])
+        inside = (clipped_lower < clipped_upper).all(axis=1)
+        complete = (lower >= 0).all(axis=1) & (upper <= [width, height]).all(axis=1)
+        for key, x1y1, x2y2, is_complete in zip(
+                keys[inside].tolist(), clipped_lower[inside].tolist(),
+                clipped_upper[inside].tolist(), complete[inside].tolist()
+        ):
+            key = tuple(key)
+            plan.tiles[key] = (*x1y1, *x2y2)
+            if is_complete:
+                plan.complete.add(key)
+
+    def _sign(self, plan: TilePlan, source):
+        """Уменьшенные копии тайлов из одного чтения обзора растра, по thumb_size пикселей на тайл"""
+        height, width = plan.full_shape
+        _, dx, rx, _, ry, dy = plan.georeference.geotransform
+        tile_pixels = plan.tile_size / math.sqrt(math.hypot(dx, ry) * math.hypot(rx, dy))
+        max_side = max(1, min(max(width, height), math.ceil(max(width, height) * self.thumb_size / tile_pixels)))
+        overview, scale = source.read_overview(max_side)
+        mask = source.read_overview_mask(max_side)
+        for key, (x1, y1, x2, y2) in plan.tiles.items():
+            window = (
+                slice(int(y1 / scale), max(int(y1 / scale) + 1, int(np.ceil(y2 / scale)))),
+                slice(int(x1 / scale), max(int(x1 / scale) + 1, int(np.ceil(x2 / scale))))
+            )
+            if mask is not None and not mask[window].all():
+                plan.complete.discard(key)
+            thumb = resize_image(np.ascontiguousarray(overview[window]), (self.thumb_size, self.thumb_size))
+            plan.signatures[key] = np.round(thumb.mean(axis=2)).astype(np.uint8)
+
+    def _load(self, plan: TilePlan) -> Dict[TileKey, Tuple[bool, np.ndarray, np.ndarray]]:
+        """Сохраненные тайлы плана: (целиком покрыт, уменьшенная копия, детекции (K, 10))"""
+        keys = np.array(list(plan.tiles), dtype=np.int64).reshape(-1, 2)
+        if len(keys) == 0:
+            return {}
+        rows = self._connect().execute(
+            """
+            SELECT tile_x, tile_y, complete, signature, detections FROM geo_tiles
+            WHERE crs = ? AND model_key = ? AND tile_x BETWEEN ? AND ? AND tile_y BETWEEN ? AND ?
+            """,
+            (
+                plan.crs, plan.model_key,
+                int(keys[:, 0].min()), int(keys[:, 0].max()), int(keys[:, 1].min()), int(keys[:, 1].max())
+            )
+        ).fetchall()
+        stored = {}
+        for row in rows:
+            key = (row["tile_x"], row["tile_y"])
+            if key not in plan.tiles:
+                continue
+            signature = np.frombuffer(row["signature"], dtype=np.uint8)
+            side = math.isqrt(len(signature))
+            stored[key] = (
+                bool(row["complete"]),
+                signature.reshape(side, side),
+                np.frombuffer(row["detections"], dtype=np.float64).reshape(-1, DETECTION_COLUMNS)
+            )
+        return stored
+
+    def combine(self, plan: TilePlan, raw: Optional[RawDetections], is_obb: bool) -> RawDetections:
+        """
+        Сырые детекции всего растра: найденные моделью с центром в пересчитанных тайлах
+        и перенесенные из хранилища для остальных. raw - None, если модель не считала ничего
+        """
+        if raw is not None and not plan.reused:
+            return raw
+        if raw is not None:
+            is_obb = raw.points is not None
+        boxes_parts, points_parts = [], []
+        if raw is not None and len(raw.boxes):
+            centers = (raw.boxes[:, :2] + raw.boxes[:, 2:4]) / 2
+            keep = np.array([tuple(key) not in plan.reused for key in plan.tile_keys(centers).tolist()], dtype=bool)
+            boxes_parts.append(raw.boxes[keep])
+            if raw.points is not None:
+                points_parts.append(raw.points[keep])
+
+        stored = [plan.stored[key] for key in plan.reused if len(plan.stored[key])]
+        if stored:
+            carried = np.concatenate(stored)
+            quads = plan.georeference.world_to_pixel(carried[:, :8].reshape(-1, 4, 2))
+            height, width = plan.full_shape
+            lower = np.clip(quads.min(axis=1), 0, [width, height])
+            upper = np.clip(quads.max(axis=1), 0, [width, height])
+            boxes = np.column_stack([lower, upper, carried[:, 8:]]).astype(np.float32)
+            valid = (boxes[:, 0] < boxes[:, 2]) & (boxes[:, 1] < boxes[:, 3])
+            boxes_parts.append(boxes[valid])
+            if is_obb:
+                points_parts.append(quads.reshape(-1, 8).astype(np.float32)[valid])
+
+        boxes = np.concatenate(boxes_parts) if boxes_parts else np.zeros((0, 6), dtype=np.float32)
+        points = None
+        if is_obb:
+            points = np.concatenate(points_parts) if points_parts else np.zeros((0, 8), dtype=np.float32)
+        if raw is None:
+            return RawDetections(boxes, points, plan.full_shape)
+        return RawDetections(boxes, points, plan.full_shape, raw.slice_count, raw.skipped)
+
+    def save(self, plan: TilePlan, raw: RawDetections, image_path: str):
+        """
+        Сохраняет пересчитанные тайлы: уменьшенную копию и детекции с центром в тайле.
+        Тайл, целиком покрытый прошлой съемкой, не заменяется неполным;
+        у перенесенных тайлов обновляется только время использования
+        """
+        by_tile: Dict[TileKey, List[np.ndarray]] = {}
+        if len(raw.boxes):
+            quads = _detection_quads(raw)
+            world = plan.georeference.pixel_to_world(quads).reshape(-1, 8)
+            rows = np.column_stack([world, raw.boxes[:, 4:6].astype(np.float64)])
+            centers = (raw.boxes[:, :2] + raw.boxes[:, 2:4]) / 2
+            for key, row in zip(plan.tile_keys(centers).tolist(), rows):
+                by_tile.setdefault(tuple(key), []).append(row)
+
+        now = time.time()
+        empty = np.zeros((0, DETECTION_COLUMNS), dtype=np.float64)
+        records = [
+            (
+                plan.crs, plan.model_key, key[0], key[1], int(key in plan.complete),
+                plan.signatures[key].tobytes(),
+                (np.array(by_tile[key], dtype=np.float64) if key in by_tile else empty).tobytes(),
+                image_path, now
+            )
+            for key in plan.recomputed
+        ]
+        with self._connect() as connection:
+            connection.executemany(
+                """
+                INSERT INTO geo_tiles (crs, model_key, tile_x, tile_y, complete, signature, detections,
+                                       image_path, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (crs, model_key, tile_x, tile_y) DO UPDATE SET
+                    complete = excluded.complete,
+                    signature = excluded.signature,
+                    detections = excluded.detections,
+                    image_path = excluded.image_path,
+                    updated_at = excluded.updated_at
+                WHERE excluded.complete >= geo_tiles.complete
+                """,
+                records
+            )
+            connection.executemany(
+                "UPDATE geo_tiles SET updated_at = ? WHERE crs = ? AND model_key = ? AND tile_x = ? AND tile_y = ?",
+                [(now, plan.crs, plan.model_key, key[0], key[1]) for key in plan.reused]
+            )
+
+    def remove_expired(self, now: Optional[float] = None) -> int:
+        """Удаляет тайлы, не использовавшиеся дольше ttl_days"""
+        if self.ttl_seconds is None:
+            return 0
+        with self._connect() as connection:
+            return connection.execute(
+                "DELETE FROM geo_tiles WHERE updated_at < ?", ((now or time.time()) - self.ttl_seconds,)
+            ).rowcount
+
+    def clear(self):
+        """Удаляет все сохраненные тайлы"""
+        with self._connect() as connection:
+            connection.execute("DELETE FROM geo_tiles")
+
+    def planned_counts(self) -> dict:
+        """Тайлы, перенесенные и пересчитанные этим процессом с запуска (без запроса к базе)"""
+        with self._stats_lock:
+            return {"reused": self.tiles_reused, "recomputed": self.tiles_recomputed}
+
+    def stored_tiles(self) -> int:
+        """Число сохраненных тайлов; запрос к базе, вызывается вне цикла событий"""
+        return self._connect().execute("SELECT COUNT(*) FROM geo_tiles").fetchone()[0]
+
+    def db_bytes(self) -> int:
+        return os.path.getsize(self.db_path)
@@ -0,0 +1,418 @@
+import itertools
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from postprocess import MergedDetections, merge_detections
+from metrics import record_batch, record_stage
+from raster import GdalWindowSource, open_image_source, order_slices_by_blocks, resize_image
+from scheduler import PRIORITY_BULK, PRIORITY_INTERACTIVE
+from slicefilter import SKIP_UNCHANGED, SliceFilter
+from slicing import SlicePlan
+
+
+# Результат модели для одного фрагмента: боксы (N, 6) [x1, y1, x2, y2, conf, cls]
+# и, для OBB-моделей, вершины повернутых рамок (N, 8)
+SlicePrediction = Tuple[np.ndarray, Optional[np.ndarray]]
+
+
+class _SliceTask:
+    """Фрагмент изображения, ожидающий инференса"""
+
+    __slots__ = ("image", "future")
+
+    def __init__(self, image: np.ndarray):
+        self.image = image
+        self.future = Future()
+
+
+def run_model_batch(detection_model, images: List[np.ndarray]) -> List[SlicePrediction]:
+    """Прогоняет пакет RGB-фрагментов через ultralytics модель за один вызов"""
+    model = detection_model.model
+    # YOLO ожидает BGR
+    images_bgr = [np.ascontiguousarray(image[:, :, ::-1]) for image in images]
+    predictions = model(
+        images_bgr,
+        conf=detection_model.confidence_threshold,
+        device=detection_model.device,
+        verbose=False
+    )
+
+    results = []
+    for prediction in predictions:
+        obb = getattr(prediction, "obb", None)
+        if obb is not None:
+            boxes = np.concatenate([
+                obb.xyxy.cpu().numpy(),
+                obb.conf.cpu().numpy()[:, None],
+                obb.cls.cpu().numpy()[:, None]
+            ], axis=1)
+            points = obb.xyxyxyxy.cpu().numpy().reshape(-1, 8)
+            results.append((boxes, points))
+        else:
+            results.append((prediction.boxes.data.cpu().numpy(), None))
+    return results
+
+
+class SliceBatcher:
+    """
+    Пакетный движок инференса по фрагментам.
+
+    Фрагменты всех изображений (в том числе из одновременно выполняющихся запросов)
+    складываются в общую очередь с приоритетами, а рабочий поток собирает из них пакеты
+    размером до batch_size и прогоняет каждый пакет через модель за один проход.
+    Интерактивные фрагменты попадают в пакеты раньше фрагментов фоновых задач.
+    device_lock, общий для моделей одного устройства, не дает им считать одновременно.
+    """
+
+    def __init__(
+            self,
+            detection_model,
+            batch_size: int = 8,
+            max_wait: float = 0.01,
+            device_lock: Optional[threading.Lock] = None
+    ):
+        self.detection_model = detection_model
+        self.batch_size = batch_size
+        # Сколько ждать догрузки пакета, прежде чем запускать неполный
+        self.max_wait = max_wait
+        self._queue = queue.PriorityQueue()
+        # Порядковый номер сохраняет FIFO внутри одного приоритета
+        self._sequence = itertools.count()
+        self._model_lock = device_lock or threading.Lock()
+        # Скользящее среднее времени инференса одного фрагмента
+        self.seconds_per_slice = 0.0
+        self._worker = threading.Thread(target=self._run, name="slice-batcher", daemon=True)
+        self._worker.start()
+
+    def stop(self):
+        """Останавливает рабочий поток после обработки уже поставленных фрагментов"""
+        # Сигнал остановки идет после фрагментов любого приоритета
+        self._queue.put((PRIORITY_BULK + 1, next(self._sequence), None))
+
+    def submit(self, image: np.ndarray, priority: int = PRIORITY_INTERACTIVE) -> Future:
+        """Ставит фрагмент в очередь, результат - SlicePrediction в координатах фрагмента"""
+        task = _SliceTask(image)
+        self._queue.put((priority, next(self._sequence), task))
+        return task.future
+
+    def _collect_batch(self) -> Optional[List[_SliceTask]]:
+        item = self._queue.get()
+        if item[2] is None:
+            return None
+        batch = [item[2]]
+        while len(batch) < self.batch_size:
+            try:
+                item = self._queue.get(timeout=self.max_wait)
+            except queue.Empty:
+                break
+            if item[2] is None:
+                # Дообрабатываем собранное и останавливаемся на следующем круге
+                self._queue.put(item)
+                break
+            batch.append(item[2])
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect_batch()
+            if batch is None:
+                return
+            batch = [task for task in batch if task.future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            start = time.perf_counter()
+            try:
+                with self._model_lock:
+                    predictions = run_model_batch(self.detection_model, [task.image for task in batch])
+            except Exception as e:
+                for task in batch:
+                    task.future.set_exception(e)
+                continue
+            batch_seconds = time.perf_counter() - start
+            record_batch(len(batch), batch_seconds)
+            elapsed = batch_seconds / len(batch)
+            if self.seconds_per_slice:
+                self.seconds_per_slice = 0.9 * self.seconds_per_slice + 0.1 * elapsed
+            else:
+                self.seconds_per_slice = elapsed
+            for task, prediction in zip(batch, predictions):
+                task.future.set_result(prediction)
+
+
+class RawDetections:
+    """
+    Необъединенные детекции всех фрагментов изображения в его координатах,
+    полученные с минимальным порогом модели: boxes (N, 6), points (N, 8) или None.
+    slice_count - число фрагментов нарезки, skipped (K, 5) [x1, y1, x2, y2, причина] -
+    фрагменты, пропущенные фильтром без инференса
+    """
+
+    __slots__ = ("boxes", "points", "full_shape", "slice_count", "skipped")
+
+    def __init__(
+            self,
+            boxes: np.ndarray,
+            points: Optional[np.ndarray],
+            full_shape: List[int],
+            slice_count: int = 0,
+            skipped: Optional[np.ndarray] = None
+    ):
+        self.boxes = boxes
+        self.points = points
+        self.full_shape = full_shape
+        self.slice_count = slice_count
+        self.skipped = skipped if skipped is not None else np.zeros((0, 5), dtype=np.int32)
+
+
+def _shift_prediction(
+        prediction: SlicePrediction,
+        offset: Tuple[int, int],
+        full_shape: List[int],
+        scale: float = 1.0
+) -> SlicePrediction:
+    """Переводит боксы фрагмента (или уменьшенной копии с масштабом scale) в координаты исходного изображения"""
+    boxes, points = prediction
+    shift_x, shift_y = offset
+    height, width = full_shape
+    boxes = boxes.astype(np.float32, copy=True)
+    boxes[:, :4] *= scale
+    boxes[:, [0, 2]] = np.clip(boxes[:, [0, 2]] + shift_x, 0, width)
+    boxes[:, [1, 3]] = np.clip(boxes[:, [1, 3]] + shift_y, 0, height)
+    valid = (boxes[:, 0] < boxes[:, 2]) & (boxes[:, 1] < boxes[:, 3])
+    if points is not None:
+        points = points.astype(np.float32, copy=True) * scale
+        points[:, 0::2] += shift_x
+        points[:, 1::2] += shift_y
+        points = points[valid]
+    return boxes[valid], points
+
+
+def _intersects_any(regions: np.ndarray, x1: int, y1: int, x2: int, y2: int) -> bool:
+    """Пересекает ли прямоугольник хотя бы одну из областей (K, 4)"""
+    return bool(np.any(
+        (regions[:, 0] < x2) & (x1 < regions[:, 2]) & (regions[:, 1] < y2) & (y1 < regions[:, 3])
+    ))
+
+
+def detections_from_raw(
+        raw: RawDetections,
+        category_mapping: dict,
+        is_obb: bool,
+        confidence_threshold: float = 0.0
+) -> List[dict]:
+    """Применяет порог запроса к сырым детекциям, объединяет дубликаты и форматирует ответ"""
+    # Модель работает с минимальным порогом, порог запроса применяется здесь
+    merged = merge_detections(raw.boxes, raw.points if is_obb else None, confidence_threshold)
+    return format_detections(merged, category_mapping)
+
+
+def format_detections(merged: MergedDetections, category_mapping: dict) -> List[dict]:
+    """Форматирует результаты детекции в формат ответа API"""
+    xywh = merged.boxes.astype(np.float64)
+    xywh[:, 2:] -= xywh[:, :2]
+    names = [category_mapping[str(category_id)] for category_id in merged.classes.tolist()]
+    detections = [
+        {
+            "type": name,
+            "bbox": bbox, # x y w h
+            "confidence": confidence,
+            "verified": None
+        }
+        for name, bbox, confidence in zip(names, xywh.tolist(), merged.scores.astype(np.float64).tolist())
+    ]
+    if merged.rboxes is not None:
+        # Повернутая рамка [cx, cy, w, h, угол в радианах]
+        for detection, rbox in zip(detections, merged.rboxes.astype(np.float64).tolist()):
+            detection["rbox"] = rbox
+    return detections
+
+
+class _ImageState:
+    """Накопленные предсказания одного изображения"""
+
+    __slots__ = ("image_path", "full_shape", "boxes", "points", "error", "slice_count", "skipped")
+
+    def __init__(self, image_path: str):
+        self.image_path = image_path
+        self.full_shape = None
+        self.boxes = []
+        self.points = []
+        self.error = None
+        self.slice_count = 0
+        self.skipped = []
+
+    def raw(self) -> RawDetections:
+        if self.boxes:
+            boxes = np.concatenate(self.boxes)
+        else:
+            boxes = np.zeros((0, 6), dtype=np.float32)
+        points = None
+        if self.points and self.points[0] is not None:
+            points = np.concatenate(self.points)
+        skipped = np.array(self.skipped, dtype=np.int32).reshape(-1, 5)
+        return RawDetections(boxes, points, self.full_shape, self.slice_count, skipped)
+
+
+def detect_images_batched(
+        batcher: SliceBatcher,
+        image_paths: List[str],
+        slice_size: int,
+        overlap_ratio: float,
+        max_in_flight: Optional[int] = None,
+        slice_filter: Optional[SliceFilter] = None,
+        timings: Optional[dict] = None,
+        priority: int = PRIORITY_INTERACTIVE,
+        slice_plans: Optional[Dict[str, SlicePlan]] = None,
+        regions: Optional[Dict[str, np.ndarray]] = None
+) -> List[Tuple[str, Optional[RawDetections], Optional[Exception]]]:
+    """
+    Нарезает изображения на фрагменты, отправляет их в общий пакетный движок
+    и собирает результаты обратно по исходным изображениям.
+
+    Фрагменты читаются по одному (TIFF - окнами GDAL), и в очереди одновременно
+    находится не больше max_in_flight фрагментов (по умолчанию два пакета), поэтому
+    пиковая память ограничена размером пакета, а не размером растра. Очередь общая
+    для всех изображений запроса, так что пакеты формируются поперек их границ.
+
+    С slice_filter фрагменты без данных, однородные и с вырожденной гистограммой
+    пропускаются до инференса и перечисляются в RawDetections.skipped.
+
+    Время чтения фрагментов (slice_read) и ожидания модели (inference_wait)
+    учитывается в метриках и, если передан, в словаре timings.
+    priority - приоритет фрагментов в очереди модели (PRIORITY_*).
+    slice_plans - нарезка отдельных изображений (размер, перекрытие и пересчет
+    фрагментов к масштабу модели) вместо общих slice_size и overlap_ratio.
+    regions - области изображений (K, 4) [x1, y1, x2, y2], которые нужно пересчитать:
+    фрагменты вне них не читаются и попадают в skipped с причиной unchanged.
+
+    Возвращает список (путь, сырые детекции, ошибка) в порядке image_paths;
+    порог и объединение применяются потом через detections_from_raw.
+    """
+    # sahi.slicing тянет shapely и заметно удлиняет старт сервера
+    from sahi.slicing import get_slice_bboxes
+
+    if max_in_flight is None:
+        max_in_flight = 2 * batcher.batch_size
+
+    states = []
+    in_flight = deque()
+    # Накопленное время чтения растра и ожидания результатов модели
+    seconds = {"slice_read": 0.0, "inference_wait": 0.0}
+
+    def drain_one():
+        state, offset, scale, future = in_flight.popleft()
+        wait_start = time.perf_counter()
+        try:
+            prediction = future.result()
+        except Exception as e:
+            state.error = state.error or e
+            return
+        finally:
+            seconds["inference_wait"] += time.perf_counter() - wait_start
+        if state.error is None:
+            boxes, points = _shift_prediction(prediction, offset, state.full_shape, scale)
+            state.boxes.append(boxes)
+            state.points.append(points)
+
+    def submit(state, image, offset, scale=1.0):
+        in_flight.append((state, offset, scale, batcher.submit(image, priority)))
+        while len(in_flight) > max_in_flight:
+            drain_one()
+
+    for image_path in image_paths:
+        state = _ImageState(image_path)
+        states.append(state)
+        source = None
+        read_start = time.perf_counter()
+        wait_before = seconds["inference_wait"]
+        try:
+            plan = slice_plans.get(image_path) if slice_plans else None
+            image_slice_size = plan.slice_size if plan is not None else slice_size
+            image_overlap = plan.overlap_ratio if plan is not None else overlap_ratio
+            resample = plan.resample if plan is not None else 1.0
+            source = open_image_source(image_path)
+            state.full_shape = [source.height, source.width]
+            slice_bboxes = get_slice_bboxes(
+                image_height=source.height,
+                image_width=source.width,
+                slice_height=image_slice_size,
+                slice_width=image_slice_size,
+                overlap_height_ratio=image_overlap,
+                overlap_width_ratio=image_overlap
+            )
+            if isinstance(source, GdalWindowSource):
+                slice_bboxes = order_slices_by_blocks(slice_bboxes, source.block_size)
+            state.slice_count = len(slice_bboxes)
+            image_regions = regions.get(image_path) if regions else None
+
+            overview = overview_mask = None
+            scale = 1.0
+            if len(slice_bboxes) > 1 or (slice_filter is not None and slice_filter.use_overview):
+                overview, scale = source.read_overview()
+                if slice_filter is not None and slice_filter.use_overview:
+                    overview_mask = source.read_overview_mask()
+
+            for x1, y1, x2, y2 in slice_bboxes:
+                if image_regions is not None and not _intersects_any(image_regions, x1, y1, x2, y2):
+                    state.skipped.append([x1, y1, x2, y2, SKIP_UNCHANGED])
+                    continue
+                image = None
+                out_size = None
+                if resample != 1.0:
+                    # Фрагмент пересчитывается к масштабу, на котором обучалась модель
+                    out_size = (
+                        max(1, int(round((x2 - x1) / resample))),
+                        max(1, int(round((y2 - y1) / resample)))
+                    )
+                if slice_filter is not None:
+                    if slice_filter.use_overview:
+                        # Оцениваем фрагмент по соответствующему окну уменьшенной копии
+                        window = (
+                            slice(int(y1 / scale), max(int(y1 / scale) + 1, int(np.ceil(y2 / scale)))),
+                            slice(int(x1 / scale), max(int(x1 / scale) + 1, int(np.ceil(x2 / scale))))
+                        )
+                        reason = slice_filter.classify(
+                            overview[window],
+                            overview_mask[window] if overview_mask is not None else None,
+                            step=max(1, int(round(slice_filter.sample_step / scale)))
+                        )
+                    else:
+                        image = source.read(x1, y1, x2, y2)
+                        reason = slice_filter.classify(image, source.read_mask(x1, y1, x2, y2))
+                        if out_size is not None:
+                            image = resize_image(image, out_size)
+                    if reason:
+                        state.skipped.append([x1, y1, x2, y2, reason])
+                        continue
+                if image is None:
+                    image = source.read(x1, y1, x2, y2, out_size)
+                submit(state, image, (x1, y1), resample)
+
+            # Полноразмерный проход для крупных объектов, как perform_standard_pred в SAHI;
+            # если пропущены все фрагменты, изображение пустое и проход не нужен
+            if len(slice_bboxes) > 1 and len(state.skipped) < len(slice_bboxes):
+                submit(state, overview, (0, 0), scale)
+        except Exception as e:
+            state.error = e
+        finally:
+            if source is not None:
+                source.close()
+            # Ожидание модели внутри submit не считается временем чтения
+            seconds["slice_read"] += time.perf_counter() - read_start - (seconds["inference_wait"] - wait_before)
+
+    while in_flight:
+        drain_one()
+
+    for stage, stage_seconds in seconds.items():
+        record_stage(stage, stage_seconds, timings)
+
+    return [
+        (state.image_path, None, state.error) if state.error is not None else (state.image_path, state.raw(), None)
+        for state in states
+    ]
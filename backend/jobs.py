@@ -0,0 +1,310 @@
+import asyncio
+import functools
+import json
+import logging
+import time
+import uuid
+from typing import Awaitable, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+IMAGE_STATUSES = ("queued", "running", "done", "error", "cancelled")
+
+
+class JobQueueFull(Exception):
+    """Очередь задач переполнена"""
+
+
+def job_progress(statuses: List[str]) -> dict:
+    counts = dict.fromkeys(IMAGE_STATUSES, 0)
+    for status in statuses:
+        counts[status] += 1
+    return {"total": len(statuses), **counts}
+
+
+class DetectionJob:
+    """Фоновая задача детекции по списку изображений, выполняемая этим процессом"""
+
+    def __init__(self, image_paths: List[str], options: Optional[dict] = None):
+        self.id = str(uuid.uuid4())
+        self.image_paths = image_paths
+        # Дополнительные аргументы функции детекции (модель, порог, настройки)
+        self.options = options or {}
+        self.status = "queued"
+        self.created_at = time.time()
+        self.finished_at = None
+        # Состояние изображений по их номеру в image_paths: один путь может встретиться дважды
+        self.image_status = ["queued"] * len(image_paths)
+        self.image_errors: List[Optional[str]] = [None] * len(image_paths)
+        self.cancelled = False
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ("completed", "cancelled", "failed")
+
+    def progress(self) -> dict:
+        return job_progress(self.image_status)
+
+
+class JobManager:
+    """
+    Очередь фоновых задач детекции с пулом обработчиков.
+
+    Каждый обработчик берет задачу из ограниченной очереди и запускает детекцию
+    изображений (не более images_in_flight одновременно), публикуя результат
+    каждого изображения сразу после его завершения.
+
+    Состояние задач и их события хранятся в каталоге (store), поэтому задачу видит
+    и отменяет любой процесс сервера, а результаты переживают перезапуск. Выполняет
+    задачу процесс, который ее принял: раз в heartbeat_interval он отмечает в каталоге
+    свои задачи и забирает запросы их отмены. Задача, процесс которой не отмечался
+    дольше stale_after секунд, при обращении к ней завершается как failed.
+    Блокирующие вызовы каталога выполняются через run_io, поток результатов
+    опрашивает каталог раз в poll_interval.
+
+    Синхронная detect_fn выполняется в пуле потоков executor. Асинхронная (детекция
+    в отдельных процессах через брокер) ожидается напрямую и получает id задачи,
+    а cancel_fn(job_id) при отмене снимает ее изображения из внешней очереди.
+    """
+
+    def __init__(
+            self,
+            detect_fn: Callable[..., dict],
+            store,
+            run_io: Callable[..., Awaitable],
+            workers: int = 2,
+            max_queued: int = 16,
+            images_in_flight: int = 4,
+            keep_finished: float = 3600,
+            executor=None,
+            cancel_fn: Optional[Callable[[str], Awaitable]] = None,
+            poll_interval: float = 0.2,
+            heartbeat_interval: float = 1.0,
+            stale_after: float = 30.0
+    ):
+        self.detect_fn = detect_fn
+        self.cancel_fn = cancel_fn
+        self.store = store
+        self.run_io = run_io
+        # Пул потоков для детекции изображений (None - пул по умолчанию)
+        self.executor = executor
+        self.workers = workers
+        self.max_queued = max_queued
+        self.images_in_flight = images_in_flight
+        # Сколько секунд хранить завершенные задачи
+        self.keep_finished = keep_finished
+        self.poll_interval = poll_interval
+        self.heartbeat_interval = heartbeat_interval
+        self.stale_after = stale_after
+        # Незавершенные задачи этого процесса
+        self.jobs: Dict[str, DetectionJob] = {}
+        self._published = asyncio.Condition()
+        self._queue = None
+        self._tasks = []
+
+    def start(self):
+        self._queue = asyncio.Queue(maxsize=self.max_queued)
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._heartbeat_loop()))
+
+    async def submit(self, image_paths: List[str], options: Optional[dict] = None) -> DetectionJob:
+        if self._queue.full():
+            raise JobQueueFull(f"Job queue is full ({self.max_queued} jobs)")
+        job = DetectionJob(image_paths, options)
+        await self.run_io(self.store.add_job, job.id, image_paths, job.created_at)
+        try:
+            self._queue.put_nowait(job)
+        except asyncio.QueueFull:
+            # Очередь заполнили другие запросы, пока задача записывалась в каталог
+            await self.run_io(self.store.delete_job, job.id)
+            raise JobQueueFull(f"Job queue is full ({self.max_queued} jobs)")
+        self.jobs[job.id] = job
+        return job
+
+    def queue_depth(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    async def describe(self, job_id: str) -> Optional[dict]:
+        """Состояние задачи и прогресс по каждому изображению; None, если задачи нет"""
+        job = await self.run_io(self.store.get_job, job_id)
+        if job is None:
+            return None
+        if job["finished_at"] is None and await self._fail_if_stale(job_id, job["heartbeat_at"]):
+            job = await self.run_io(self.store.get_job, job_id)
+        return {
+            "job_id": job["id"],
+            "status": job["status"],
+            "created_at": job["created_at"],
+            "finished_at": job["finished_at"],
+            "cancel_requested": bool(job["cancel_requested"]),
+            "progress": job_progress([image["status"] for image in job["images"]]),
+            "images": job["images"]
+        }
+
+    async def cancel(self, job_id: str) -> Optional[dict]:
+        """
+        Отменяет задачу: изображения, которые еще не начаты, пропускаются. Задачу другого
+        процесса отменяет он сам, получив запрос отмены из каталога
+        """
+        if not await self.run_io(self.store.request_job_cancel, job_id):
+            return None
+        job = self.jobs.get(job_id)
+        if job is not None:
+            await self._cancel_local(job)
+        return await self.describe(job_id)
+
+    async def stream(self, job_id: str, sse: bool = False, encode_result: Optional[Callable[[dict], dict]] = None):
+        """
+        Асинхронно отдает события задачи (NDJSON или SSE) по мере готовности;
+        encode_result - кодировка результата изображения (например, по столбцам)
+        """
+        after_id = 0
+        while True:
+            events = await self.run_io(self.store.job_events, job_id, after_id)
+            for event_id, event in events:
+                after_id = event_id
+                if encode_result is not None and "result" in event:
+                    event = {**event, "result": encode_result(event["result"])}
+                line = json.dumps(event, ensure_ascii=False)
+                yield f"data: {line}\n\n" if sse else f"{line}\n"
+                if event["event"] == "done":
+                    return
+            if events:
+                continue
+            if job_id not in self.jobs:
+                # Задачу выполняет другой процесс: если он пропал, задача завершается здесь
+                state = await self.run_io(self.store.job_state, job_id)
+                if state is None:
+                    return
+                if state["finished_at"] is None:
+                    await self._fail_if_stale(job_id, state["heartbeat_at"])
+            # События этого процесса будят поток сразу, остальные находятся опросом
+            async with self._published:
+                try:
+                    await asyncio.wait_for(self._published.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+
+    def remove_expired(self) -> int:
+        """Удаляет из каталога давно завершенные задачи (блокирующий вызов)"""
+        return self.store.expire_jobs(time.time() - self.keep_finished)
+
+    async def _fail_if_stale(self, job_id: str, heartbeat_at: float) -> bool:
+        if job_id in self.jobs or heartbeat_at >= time.time() - self.stale_after:
+            return False
+        if not await self.run_io(self.store.fail_stale_job, job_id, time.time() - self.stale_after):
+            return False
+        logger.warning("Job %s was interrupted: its server process stopped", job_id)
+        job = await self.run_io(self.store.get_job, job_id)
+        await self.run_io(self.store.add_job_event, job_id, {
+            "event": "done",
+            "status": "failed",
+            "progress": job_progress([image["status"] for image in job["images"]])
+        })
+        return True
+
+    async def _notify(self):
+        async with self._published:
+            self._published.notify_all()
+
+    async def _set_image(
+            self,
+            job: DetectionJob,
+            index: int,
+            status: str,
+            error: Optional[str] = None,
+            event: Optional[dict] = None
+    ):
+        job.image_status[index] = status
+        job.image_errors[index] = error
+        await self.run_io(self.store.set_job_image, job.id, index, status, error, event)
+        if event is not None:
+            await self._notify()
+
+    async def _finish(self, job: DetectionJob, status: str):
+        job.status = status
+        job.finished_at = time.time()
+        await self.run_io(self.store.finish_job, job.id, status, job.finished_at, {
+            "event": "done", "status": status, "progress": job.progress()
+        })
+        self.jobs.pop(job.id, None)
+        await self._notify()
+
+    async def _cancel_local(self, job: DetectionJob):
+        if job.finished or job.cancelled:
+            return
+        job.cancelled = True
+        if self.cancel_fn is not None:
+            await self.cancel_fn(job.id)
+        if job.status == "queued":
+            job.image_status = ["cancelled" if status == "queued" else status for status in job.image_status]
+            await self.run_io(self.store.cancel_queued_job_images, job.id)
+            await self._finish(job, "cancelled")
+
+    async def _heartbeat_loop(self):
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            try:
+                cancel_ids = await self.run_io(self.store.heartbeat_jobs, list(self.jobs))
+                for job_id in cancel_ids:
+                    job = self.jobs.get(job_id)
+                    if job is not None:
+                        await self._cancel_local(job)
+            except Exception as e:
+                logger.exception("Job heartbeat failed: %s", e)
+
+    async def _worker(self):
+        while True:
+            job = await self._queue.get()
+            try:
+                if not job.finished:
+                    await self._run_job(job)
+            except Exception as e:
+                logger.exception("Job %s failed: %s", job.id, e)
+                try:
+                    await self._finish(job, "failed")
+                except Exception as e:
+                    logger.exception("Failed to record job %s failure: %s", job.id, e)
+                    self.jobs.pop(job.id, None)
+            finally:
+                self._queue.task_done()
+
+    async def _run_job(self, job: DetectionJob):
+        job.status = "running"
+        await self.run_io(self.store.set_job_status, job.id, job.status)
+        loop = asyncio.get_running_loop()
+        semaphore = asyncio.Semaphore(self.images_in_flight)
+
+        async def run_image(index: int, image_path: str):
+            async with semaphore:
+                if job.cancelled:
+                    await self._set_image(job, index, "cancelled")
+                    return
+                await self._set_image(job, index, "running")
+                try:
+                    if asyncio.iscoroutinefunction(self.detect_fn):
+                        result = await self.detect_fn(image_path, job_id=job.id, **job.options)
+                    else:
+                        result = await loop.run_in_executor(
+                            self.executor, functools.partial(self.detect_fn, image_path, **job.options)
+                        )
+                except FileNotFoundError:
+                    error = f"File not found: {image_path}"
+                except Exception as e:
+                    error = str(e)
+                else:
+                    await self._set_image(
+                        job, index, "done", event={"event": "result", "index": index, "result": result}
+                    )
+                    return
+                if job.cancelled:
+                    # Изображение снято с очереди при отмене задачи
+                    await self._set_image(job, index, "cancelled")
+                    return
+                await self._set_image(
+                    job, index, "error", error,
+                    event={"event": "error", "index": index, "image_path": image_path, "error": error}
+                )
+
+        await asyncio.gather(*(run_image(index, image_path) for index, image_path in enumerate(job.image_paths)))
+        await self._finish(job, "cancelled" if job.cancelled else "completed")
@@ -1,31 +1,49 @@
-import io
-import json
 import os
+import shutil
 import tempfile
 import uuid
 from datetime import datetime
 from pathlib import Path
-from zipfile import ZipFile
-from openpyxl import Workbook
-from openpyxl.styles import Alignment
 from osgeo import gdal
 
-from fastapi import FastAPI, File, UploadFile, HTTPException, BackgroundTasks, Query, Response
+from fastapi import FastAPI, HTTPException, BackgroundTasks, Query, Header, Response, Depends, Request
 from fastapi.responses import FileResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.background import BackgroundTask
 from pydantic import BaseModel
-from typing import List, Optional
+from typing import List, Optional, Union
 import asyncio
+import functools
 
-from sahi.predict import get_sliced_prediction
-from sahi import AutoDetectionModel
-import torch
-from PIL import Image, ImageDraw, ImageFont
+from broker import BrokerClient, TaskBroker
+from convert import CONVERT_FORMATS, RasterConverter
+from export import (
+    OGR_FORMATS, stream_annotated_zip, stream_csv_report, stream_geojson_report, write_ogr_report, write_xlsx_report
+)
+from jobs import JobManager, JobQueueFull
+from metrics import REGISTRY, span, timed_aiter, timed_iter
+from pipeline import (
+    DEFAULT_SETTINGS, catalog, config, data_dir, decoded_store, detect_objects_batch, detection_cache,
+    geo_tile_store, image_georeference, logger, model_registry, slice_filter_stats
+)
+from scheduler import PRIORITY_BULK, PRIORITY_INTERACTIVE, InferenceScheduler, SchedulerBusy
+from spatialindex import DetectionIndex, DetectionIndexCache
+from raster import read_raster_info
+from tiles import TileStore
+from uploads import UploadStore, UploadTooLarge
+from wire import ENCODINGS, MSGPACK_MEDIA_TYPE, dumps, encode_result, msgpack_available
 
 
 # Модели данных
 class DetectionRequest(BaseModel):
     image_paths: List[str]
+    # Модель и порог для конкретного запроса, по умолчанию - из настроек
+    model_type: Optional[str] = None
+    confidence_threshold: Optional[float] = None
+    # Добавить в ответ длительности этапов обработки
+    include_timings: bool = False
+    # Кодировка ответа: json, columnar или msgpack (детекции по столбцам)
+    encoding: str = "json"
 
 
 class DetectionSettingsRequest(BaseModel):
@@ -35,11 +53,24 @@ class DetectionSettingsRequest(BaseModel):
 class DetectionResult(BaseModel):
     image_path: str
     detections: List[dict]
+    # Сводка по фрагментам, если включен пропуск пустых фрагментов
+    slices: Optional[dict] = None
+    # Нарезка изображения: режим, размер фрагмента, перекрытие и причина отказа от автоматической
+    slice_plan: Optional[dict] = None
+    # Длительности этапов, если запрошены
+    timings: Optional[dict] = None
+    # Система координат world_polygon детекций, если они привязаны
+    crs: Optional[str] = None
+    # id запуска в каталоге: по нему /detections отдает объекты видимой области
+    run_id: Optional[int] = None
+    # Тайлы географической сетки: перенесенные из прошлой съемки и пересчитанные
+    geo_tiles: Optional[dict] = None
 
 
 class DetectionResponse(BaseModel):
     results: List[DetectionResult]
     errors: Optional[List[str]] = None
+    timings: Optional[dict] = None
 
 
 class UploadResponse(BaseModel):
@@ -52,6 +83,25 @@ class ImageMetadata(BaseModel):
     filename: str
 
 
+class RunEdits(BaseModel):
+    """Правки оператора к сохраненному запуску детекции: номера объектов в полном результате"""
+    run_id: int
+    verified: List[int] = []
+    deleted: List[int] = []
+
+
+class RunsExportRequest(BaseModel):
+    runs: List[RunEdits]
+    # Выгружать только отмеченные объекты (как интерфейс)
+    verified_only: bool = True
+
+
+class JobCreateResponse(BaseModel):
+    job_id: str
+    status: str
+    total: int
+
+
 # Инициализация FastAPI приложения
 app = FastAPI(title="Object Detection API")
 
@@ -72,317 +122,599 @@ app.add_middleware(
 
 gdal.UseExceptions()
 
-# Глобальные переменные для модели
-MODEL_PATH = "models/yolo_rgb_weights_obb_301025.pt"
-detection_model = None
-
-# Папки для хранения файлов
-data_dir = tempfile.mkdtemp()
+# Папки для хранения файлов; данные и каталог переживают перезапуск
+# и общие для всех процессов сервера
 UPLOAD_DIR = os.path.join(data_dir, "uploaded_images")
 ANNOTATED_DIR = os.path.join(data_dir, "annotated_images")
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 os.makedirs(ANNOTATED_DIR, exist_ok=True)
-print(f"Data directory: {data_dir}")
 
-detect_settings = DetectionSettingsRequest(settings={
-    "model_type": "visible",
-    "confidence_threshold": 0.5,
-    "slice_size": 512,
-    "overlap_ratio": 0.3,
-    "georeference": False,
-    "pixelSize": 5.0
-})
+# Настройки детекции API (/detect/settings) хранятся в каталоге, общем для всех процессов сервера
+DETECT_SETTINGS_NAME = "detection"
 
-with open('../config.json', 'r') as config_file:
-    config = json.load(config_file)
 
-uploaded_files = {}
+def current_detect_settings() -> dict:
+    """
+    Текущие настройки детекции: сохраненные в каталоге поверх значений по умолчанию
+    (блокирующий вызов). Размер пакета из них применяется к моделям этого процесса,
+    даже если настройки менял другой процесс
+    """
+    settings = {**DEFAULT_SETTINGS, **(catalog.get_settings(DETECT_SETTINGS_NAME) or {})}
+    if model_registry.batch_size != settings['batch_size']:
+        model_registry.set_batch_size(settings['batch_size'])
+    return settings
 
-# Инициализация модели при запуске
-@app.on_event("startup")
-async def startup_event():
-    load_model()
 
+def save_detect_settings(settings: dict):
+    catalog.put_settings(DETECT_SETTINGS_NAME, settings)
+    model_registry.set_batch_size(settings['batch_size'])
 
-# Функция для загрузки модели
-def load_model():
-    global MODEL_PATH
-    global detection_model
-    for model in config['models']:
-        if model['type'] == detect_settings.settings['model_type']:
-            MODEL_PATH = f'models/{model["filename"]}'
-            break
+# Раздельные пулы для интерактивной детекции, фоновых задач и ввода-вывода
+scheduler = InferenceScheduler(**config.get('scheduler', {}))
 
-    try:
-        detection_model = AutoDetectionModel.from_pretrained(
-            model_type="ultralytics",
-            model_path=MODEL_PATH,
-            confidence_threshold=detect_settings.settings["confidence_threshold"],
-            device="cuda:0" if torch.cuda.is_available() else "cpu"
+# Загруженные файлы пишутся на диск прямо из тела запроса, одинаковые по содержимому хранятся один раз
+upload_store = UploadStore(
+    UPLOAD_DIR,
+    max_size_mb=config.get('uploads', {}).get('max_size_mb'),
+    max_request_mb=config.get('uploads', {}).get('max_request_mb'),
+    chunk_size=config.get('uploads', {}).get('chunk_size_kb', 1024) * 1024
+)
+
+def upload_path_by_hash(content_hash: str) -> Optional[str]:
+    upload = catalog.upload_by_hash(content_hash)
+    return upload["path"] if upload is not None else None
+
+
+# Пирамиды тайлов для просмотра загруженных изображений
+tile_store = TileStore(os.path.join(data_dir, "tiles"), resolve=upload_path_by_hash)
+
+# Пакетная конвертация TIFF в собственном пуле потоков
+converter = RasterConverter(os.path.join(data_dir, "converted"), **config.get('convert', {}))
+
+# Пространственные индексы детекций по id запуска для запросов видимой области
+spatial_index_config = config.get('spatial_index', {})
+detection_indexes = DetectionIndexCache(spatial_index_config.get('cache_items', 32))
+
+
+def register_uploads(uploads: List[dict]):
+    """Регистрирует сохраненные файлы в каталоге (блокирующий вызов, выполняется в пуле потоков)"""
+    for upload in uploads:
+        if "error" in upload:
+            continue
+        upload_path = upload["upload_path"]
+        raster_info = None
+        if catalog.get_upload(upload_path) is None:
+            try:
+                raster_info = read_raster_info(upload_path)
+            except RuntimeError:
+                # Не растр или формат, который GDAL не читает
+                pass
+        catalog.add_upload(
+            upload_path, upload["content_hash"], upload["filename"], os.path.getsize(upload_path), raster_info
         )
-        print(f"Model loaded successfully on device: {detection_model.device}")
-    except Exception as e:
-        print(f"Error loading model: {e}")
-        raise
 
 
-# Функция для детекции на одном изображении
-def detect_objects(image_path: str) -> List[dict]:
-    """Выполняет детекцию объектов на изображении с помощью SAHI"""
+# Описание тела загрузки для OpenAPI: эндпоинты читают multipart сами, без UploadFile
+UPLOAD_REQUEST_BODY = {
+    "requestBody": {
+        "required": True,
+        "content": {
+            "multipart/form-data": {
+                "schema": {
+                    "type": "object",
+                    "properties": {"files": {"type": "array", "items": {"type": "string", "format": "binary"}}},
+                    "required": ["files"]
+                }
+            }
+        }
+    }
+}
+
+
+async def receive_uploads(request: Request, **kwargs) -> List[dict]:
+    """
+    Сохраняет файлы поля files из тела запроса по мере его получения. Запрос больше
+    uploads.max_request_mb отклоняется по Content-Length до чтения тела, файл больше
+    uploads.max_size_mb - как только превысит предел (413). Файлы, сохраненные
+    до ошибки, остаются в хранилище и каталоге
+    """
     try:
-        if not os.path.exists(image_path):
-            raise FileNotFoundError(f"Image not found: {image_path}")
-
-        # Выполняем слайсинг-детекцию
-        result = get_sliced_prediction(
-            image_path,
-            detection_model,
-            # slice_height=512,
-            slice_height=detect_settings.settings["slice_size"],
-            # slice_width=512,
-            slice_width=detect_settings.settings["slice_size"],
-            # overlap_height_ratio=0.3,
-            overlap_height_ratio=detect_settings.settings['overlap_ratio'],
-            # overlap_width_ratio=0.3,
-            overlap_width_ratio=detect_settings.settings['overlap_ratio'],
-        )
+        upload_store.check_request_size(request.headers.get("content-length"))
+        reader = upload_store.reader(request.headers.get("content-type"), **kwargs)
+    except UploadTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    # Блоки тела копятся до chunk_size, чтобы не переходить в пул на каждый сетевой пакет
+    buffer = bytearray()
+    try:
+        with span("upload"):
+            async for chunk in request.stream():
+                buffer += chunk
+                if len(buffer) >= upload_store.chunk_size:
+                    await scheduler.run_io(reader.feed, bytes(buffer))
+                    buffer.clear()
+            await scheduler.run_io(reader.feed, bytes(buffer))
+            await scheduler.run_io(reader.finish)
+    except UploadTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    finally:
+        await scheduler.run_io(reader.abort)
+        await scheduler.run_io(register_uploads, reader.results)
+    return reader.results
+
+
+def remove_expired_uploads() -> int:
+    """Удаляет загрузки, к которым давно не обращались: файл, пирамиду тайлов и записи каталога"""
+    expired = catalog.expire()
+    for upload in expired:
+        try:
+            os.remove(upload["path"])
+        except FileNotFoundError:
+            pass
+        tile_store.forget(upload["content_hash"])
+    if expired:
+        logger.info("Removed %d expired uploads", len(expired))
+    return len(expired)
 
-        # Форматируем результаты
-        detections = []
-        for obj in result.object_prediction_list:
-            bbox = obj.bbox.to_xywh()
-            detections.append({
-                "type": obj.category.name,
-                "bbox": [float(bbox[0]), float(bbox[1]), float(bbox[2]), float(bbox[3])], # x y w h
-                "confidence": float(obj.score.value),
-                "verified": None
-            })
 
-        return detections
+async def cleanup_loop(interval: float):
+    while True:
+        try:
+            await scheduler.run_io(remove_expired_uploads)
+            await scheduler.run_io(converter.remove_expired)
+            await scheduler.run_io(geo_tile_store.remove_expired)
+            await scheduler.run_io(job_manager.remove_expired)
+            if decoded_store is not None:
+                await scheduler.run_io(decoded_store.remove_expired)
+            if task_broker is not None:
+                await scheduler.run_io(task_broker.remove_finished)
+        except Exception as e:
+            logger.exception("Upload cleanup failed: %s", e)
+        await asyncio.sleep(interval)
+
 
+# Инициализация модели при запуске
+@app.on_event("startup")
+async def startup_event():
+    # Модели грузятся в фоне: сервер сразу принимает запросы, готовность видна в /health
+    asyncio.create_task(scheduler.run_bulk(load_models))
+    job_manager.start()
+    cleanup_interval = config.get('storage', {}).get('cleanup_interval_minutes', 30) * 60
+    asyncio.create_task(cleanup_loop(cleanup_interval))
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    scheduler.shutdown()
+    converter.shutdown()
+
+
+# Функция для загрузки моделей
+def load_models():
+    """Загружает и прогревает все модели из config.json"""
+    try:
+        model_registry.warm_up()
     except Exception as e:
-        raise Exception(f"Detection failed for {image_path}: {str(e)}")
+        logger.exception("Error loading model: %s", e)
+
+
+# Функция для детекции на одном изображении
+def detect_image_result(
+        image_path: str,
+        settings: dict,
+        model_type: Optional[str] = None,
+        confidence_threshold: Optional[float] = None,
+        include_timings: bool = False,
+        priority: int = PRIORITY_INTERACTIVE
+) -> dict:
+    """Детекция одного изображения, результат в формате ответа (используется фоновыми задачами)"""
+    timings = {} if include_timings else None
+    _, result, error = detect_objects_batch(
+        [image_path], settings, model_type, confidence_threshold, timings, priority
+    )[0]
+    if isinstance(error, FileNotFoundError):
+        raise error
+    if error is not None:
+        raise Exception(f"Detection failed for {image_path}: {str(error)}")
+    if timings is not None:
+        result["timings"] = timings
+    return result
+
+
+def detect_objects(
+        image_path: str,
+        model_type: Optional[str] = None,
+        confidence_threshold: Optional[float] = None
+) -> List[dict]:
+    """Выполняет детекцию объектов на изображении по фрагментам"""
+    return detect_image_result(image_path, current_detect_settings(), model_type, confidence_threshold)["detections"]
 
 
 # Функция для рисования bounding boxes
 def draw_bounding_boxes(image_path: str, detections: List[dict]):
     """Рисует bounding boxes на изображении и сохраняет результат"""
-    try:
-        output_path = os.path.join(ANNOTATED_DIR, os.path.basename(image_path))
-        # Открываем изображение
-        image = Image.open(image_path)
-        draw = ImageDraw.Draw(image)
-
-        # Настройки для рисования
-        colors = ['red', 'green', 'blue', 'yellow', 'purple', 'orange']
-        font = ImageFont.load_default()
-
-        print(detections)
-
-        # Рисуем каждый bounding box
-        for detection in detections:
-            print(detection)
-            bbox = detection['bbox']
-            x, y, w, h = bbox
-            color = 'red'
-
-            # Рисуем прямоугольник
-            draw.rectangle([x, y, x + w, y + h], outline=color, width=2)
-
-            # Добавляем подпись
-            label = f"{detection['type']} {detection['confidence']:.2f}"
-            print(label)
-            text_bbox = draw.textbbox((x, y + h), label, font=font)
-            draw.rectangle(text_bbox, fill=color)
-            draw.text((x, y + h), label, fill='white', font=font)
-
-        # Сохраняем изображение
-        image.save(output_path)
-        print(output_path)
+    # PIL-отрисовка импортируется при первом рисовании, а не при старте
+    from render import render_annotated_image
 
+    decoded_path = decoded_store.decoded_path(image_path) if decoded_store is not None else None
+    try:
+        with span("draw"):
+            filename, content = render_annotated_image(image_path, detections, decoded_path)
+        with open(os.path.join(ANNOTATED_DIR, filename), "wb") as f:
+            f.write(content)
     except Exception as e:
         raise Exception(f"Failed to draw bounding boxes: {str(e)}")
 
 
-# Функция для обработки в отдельном процессе
-def process_detection_formatting(image_path: str, detections: List[dict]) -> dict:
-    """Форматирует результаты детекции для JSON ответа"""
+# Фоновые задачи считаются в процессе API или, в режиме broker, отдельными
+# процессами-обработчиками (worker.py), которые берут изображения из общей очереди
+workers_config = config.get('workers', {})
+task_broker = None
+broker_client = None
+if workers_config.get('mode', 'local') == 'broker':
+    task_broker = TaskBroker(
+        os.path.join(data_dir, workers_config.get('broker_db', 'broker.sqlite3')),
+        lease_seconds=workers_config.get('lease_seconds', 60),
+        max_attempts=workers_config.get('max_attempts', 3)
+    )
+    broker_client = BrokerClient(task_broker, scheduler.run_io, workers_config.get('poll_interval', 0.2))
+
+
+async def detect_image_remote(
+        image_path: str,
+        settings: dict,
+        job_id: Optional[str] = None,
+        model_type: Optional[str] = None,
+        confidence_threshold: Optional[float] = None,
+        include_timings: bool = False
+) -> dict:
+    """Детекция изображения фоновой задачи в процессе-обработчике через брокер"""
+    options = {
+        "confidence_threshold": confidence_threshold,
+        "include_timings": include_timings,
+        # Настройки нарезки задачи передаются обработчику вместе с изображением
+        "settings": settings
+    }
+    return await broker_client.detect(image_path, model_type or settings["model_type"], options, job_id)
+
+
+async def cancel_remote_job(job_id: str):
+    await scheduler.run_io(task_broker.cancel_job, job_id)
+
+
+# Очередь фоновых задач детекции
+if task_broker is not None:
+    # Изображения задачи ставятся в очередь брокера сразу, их разбирают все обработчики
+    job_manager = JobManager(
+        detect_image_remote,
+        catalog,
+        scheduler.run_io,
+        images_in_flight=workers_config.get('images_in_flight', 64),
+        cancel_fn=cancel_remote_job,
+        poll_interval=workers_config.get('poll_interval', 0.2)
+    )
+else:
+    job_manager = JobManager(
+        functools.partial(detect_image_result, priority=PRIORITY_BULK),
+        catalog,
+        scheduler.run_io,
+        executor=scheduler.bulk_pool,
+        poll_interval=workers_config.get('poll_interval', 0.2)
+    )
+
+# Показатели, вычисляемые в момент запроса /metrics
+REGISTRY.gauge("job_queue_depth", "Detection jobs waiting in the queue", lambda: {(): job_manager.queue_depth()})
+if task_broker is not None:
+    REGISTRY.gauge(
+        "broker_tasks", "Detection tasks in the worker broker by status",
+        lambda: {(("status", status),): count for status, count in task_broker.stats()["tasks"].items()}
+    )
+REGISTRY.gauge(
+    "inference_pending", "Interactive detection requests admitted and not finished",
+    lambda: {(): scheduler.stats()["pending"]}
+)
+REGISTRY.gauge("models_loaded", "Models currently held in memory", lambda: {(): len(model_registry.loaded())})
+REGISTRY.gauge(
+    "detection_cache_requests", "Detection cache lookups since start",
+    lambda: {
+        (("result", "hit"),): detection_cache.stats()["hits"],
+        (("result", "miss"),): detection_cache.stats()["misses"]
+    }
+)
+if decoded_store is not None:
+    REGISTRY.gauge(
+        "decoded_mapped_bytes", "Decoded images memory-mapped by this process",
+        lambda: {(): decoded_store.mapped_bytes()}
+    )
+    REGISTRY.gauge(
+        "decoded_disk_bytes", "Size of decoded images on disk as tracked by this process",
+        lambda: {(): decoded_store.disk_bytes()}
+    )
+REGISTRY.gauge(
+    "geo_tiles_planned", "Geo tiles of detected rasters by outcome since start",
+    lambda: {(("outcome", outcome),): count for outcome, count in geo_tile_store.planned_counts().items()}
+)
+REGISTRY.gauge("geo_tiles_stored", "Geo tiles kept for repeat flights", lambda: {(): geo_tile_store.stored_tiles()})
+REGISTRY.gauge("geo_tiles_db_bytes", "Size of the geo tile database", lambda: {(): geo_tile_store.db_bytes()})
+def catalog_gauges() -> dict:
+    """Записи и размеры каталога одним запросом на показатель"""
+    stats = catalog.stats()
     return {
-        "image_path": image_path,
-        "detections": detections
+        "records": {(("table", table),): stats[table] for table in ("uploads", "detection_runs")},
+        "bytes": {(("kind", "uploads"),): stats["uploads_bytes"], (("kind", "db"),): stats["db_bytes"]}
     }
 
 
-def create_world_file(png_path: str, geotransform: tuple):
-    """Создает мировой файл (.pgw) для PNG"""
-    # Проверяем наличие мирового файла
-    world_file = png_path.replace('.png', '.pgw')
-    if geotransform and not os.path.exists(world_file):
-        # Создаем мировой файл вручную если он не создался автоматически
-        with open(world_file, 'w') as f:
-            f.write(f"{geotransform[1]}\n")   # Pixel width (x-scale)
-            f.write(f"{geotransform[4]}\n")   # Rotation parameter (usually 0)
-            f.write(f"{geotransform[2]}\n")   # Rotation parameter (usually 0)
-            f.write(f"{geotransform[5]}\n")   # Pixel height (y-scale, negative)
-            f.write(f"{geotransform[0] + geotransform[1] * 0.5}\n")  # X-coordinate of center
-            f.write(f"{geotransform[3] + geotransform[5] * 0.5}\n")  # Y-coordinate of center
+REGISTRY.gauge(
+    "catalog_records", "Uploads and detection runs kept in the catalog", lambda: catalog_gauges()["records"]
+)
+REGISTRY.gauge(
+    "catalog_bytes", "Size of uploaded files and of the catalog database", lambda: catalog_gauges()["bytes"]
+)
+REGISTRY.gauge(
+    "slices_skipped", "Slices skipped by the empty slice filter since start",
+    lambda: {(("reason", reason),): count for reason, count in slice_filter_stats.stats()["skipped_by_reason"].items()}
+)
 
 
-@app.post("/convert/tiff-to-png")
-async def convert_tiff_to_png(
-        files: List[UploadFile] = File(...),
-        save_georeference: bool = Query(False, description="Сохранять ли геопривязку")
+class ConvertOptions(BaseModel):
+    """Параметры конвертации растров (query-параметры эндпоинтов /convert)"""
+    output_format: str = "png"
+    scale: float = 1.0
+    quality: int = 90
+    save_georeference: bool = False
+
+
+def convert_options(
+        format: str = Query("png", description="Формат результата: png, webp или jpeg"),
+        scale: float = Query(1.0, gt=0, le=1, description="Масштаб результата, меньше 1 - уменьшение"),
+        quality: int = Query(90, ge=1, le=100, description="Качество WEBP/JPEG, 100 - WEBP без потерь"),
+        save_georeference: bool = Query(False, description="Сохранять ли геопривязку (world-файл)")
+) -> ConvertOptions:
+    if format not in CONVERT_FORMATS:
+        raise HTTPException(status_code=400, detail="Unsupported format")
+    return ConvertOptions(output_format=format, scale=scale, quality=quality, save_georeference=save_georeference)
+
+
+async def save_tiff_uploads(request: Request) -> List[dict]:
+    """Сохраняет TIFF-файлы из тела запроса; для остальных - ошибка"""
+    uploads = await receive_uploads(
+        request,
+        suffixes=('.tif', '.tiff'),
+        unsupported_message="Формат файла не поддерживается. Загрузите TIFF файл."
+    )
+    for upload in uploads:
+        if "error" not in upload:
+            tile_store.register(upload["content_hash"], upload["upload_path"])
+    return uploads
+
+
+@app.post("/convert/tiff", openapi_extra=UPLOAD_REQUEST_BODY)
+async def convert_tiffs(
+        request: Request,
+        options: ConvertOptions = Depends(convert_options)
 ):
     """
-    Конвертирует TIFF файл в PNG с возможностью сохранения геопривязки
+    Пакетная конвертация TIFF в PNG, WEBP или JPEG.
 
-    - **file**: TIFF файл для конвертации
-    - **save_georeference**: Сохранять ли геопривязку (по умолчанию False)
+    Файлы конвертируются параллельно вне цикла событий; в ответе по каждому файлу -
+    ссылка на результат (и world-файл) или ошибка. Результаты хранятся ограниченное время
     """
-    file = files[0]
-    # Проверяем что файл TIFF
-    if not file.filename.lower().endswith(('.tif', '.tiff')):
-        raise HTTPException(
-            status_code=400,
-            detail="Формат файла не поддерживается. Загрузите TIFF файл."
+    uploads = await save_tiff_uploads(request)
+    saved = [upload for upload in uploads if "error" not in upload]
+    batch_id = await scheduler.run_io(converter.new_batch)
+    with span("tiff_convert"):
+        converted = await converter.convert_many(
+            [(upload["upload_path"], upload["filename"]) for upload in saved], batch_id, **options.model_dump()
         )
+    for upload, result in zip(saved, converted):
+        upload.update(result)
+        if "error" not in result:
+            upload["url"] = f"/convert/{batch_id}/{result['output']}"
+            if result["world_file"]:
+                upload["world_file_url"] = f"/convert/{batch_id}/{result['world_file']}"
+    return {"batch_id": batch_id, "results": uploads}
+
+
+@app.get("/convert/{batch_id}/{filename}")
+async def get_converted_file(batch_id: str, filename: str):
+    """Файл результата пакетной конвертации"""
+    path = converter.output_path(batch_id, filename)
+    if path is None:
+        raise HTTPException(status_code=404, detail="Converted file not found")
+    media_types = {extension: media_type for _, extension, media_type, _ in CONVERT_FORMATS.values()}
+    return FileResponse(
+        path=path,
+        media_type=media_types.get(os.path.splitext(path)[1], 'text/plain'),
+        filename=os.path.basename(path)
+    )
 
-    # Генерируем уникальное имя файла
-    file_extension = os.path.splitext(file.filename)[1]
-    unique_filename = f"{uuid.uuid4()}{file_extension}"
-    upload_path = os.path.join(UPLOAD_DIR, unique_filename)
 
-    print(file.filename)
+@app.post("/convert/tiff-to-png", openapi_extra=UPLOAD_REQUEST_BODY)
+async def convert_tiff_to_png(
+        request: Request,
+        save_georeference: bool = Query(False, description="Сохранять ли геопривязку")
+):
+    """
+    Конвертирует один TIFF файл в PNG с возможностью сохранения геопривязки
+    (несколько файлов и другие форматы - /convert/tiff)
 
-    # Сохраняем загруженный файл
-    with open(upload_path, "wb") as buffer:
-        content = await file.read()
-        buffer.write(content)
+    - **file**: TIFF файл для конвертации
+    - **save_georeference**: Сохранять ли геопривязку (по умолчанию False)
+    """
+    uploads = await save_tiff_uploads(request)
+    if len(uploads) != 1:
+        raise HTTPException(status_code=400, detail="Передайте один файл или используйте /convert/tiff")
+    upload = uploads[0]
+    if "error" in upload:
+        raise HTTPException(status_code=400, detail=upload["error"])
+
+    logger.debug("Converting %s", upload["filename"])
+    batch_id = await scheduler.run_io(converter.new_batch)
+    with span("tiff_convert"):
+        result = (await converter.convert_many(
+            [(upload["upload_path"], upload["filename"])], batch_id, save_georeference=save_georeference
+        ))[0]
+    if "error" in result:
+        raise HTTPException(status_code=500, detail=f"Ошибка при конвертации: {result['error']}")
+
+    # Папка пакета удаляется после отправки
+    return FileResponse(
+        path=converter.output_path(batch_id, result["output"]),
+        media_type='image/png',
+        headers={'Filepath': upload["upload_path"]},
+        background=BackgroundTask(shutil.rmtree, converter.batch_dir(batch_id), True)
+    )
 
-    uploaded_files[upload_path] = file.filename
 
-    temp_dir = tempfile.mkdtemp()
-    try:
-        dataset = None
-        try:
-            # Открываем исходный TIFF-файл
-            dataset = gdal.Open(upload_path, gdal.GA_ReadOnly)
-            if dataset is None:
-                raise Exception(f"Не удалось открыть файл: {upload_path}")
-        except RuntimeError as e:
-            print(f"Ошибка GDAL: {e}")
-            return HTTPException(
-                status_code=500,
-                detail=f"Ошибка при открытии TIFF файла: {str(e)}"
-                )
-
-        # Получаем геоинформацию
-        geotransform = dataset.GetGeoTransform()
-        projection = dataset.GetProjection()
-        bands_count = dataset.RasterCount
-
-        # Создаем драйвер для PNG
-        driver = gdal.GetDriverByName('PNG')
-        if driver is None:
-            raise Exception("Драйвер PNG не поддерживается")
-
-        # Создаем имя для выходного файла
-        output_filename = file.filename.replace('.tiff', '.png').replace('.tif', '.png')
-        output_png_path = os.path.join(temp_dir, output_filename)
-
-        # Создаем выходной файл
-        png_dataset = driver.CreateCopy(output_png_path, dataset, 0)
-        if png_dataset is None:
-            raise Exception(f"Ошибка при создании PNG-файла: {output_png_path}")
-
-        # Закрываем datasets
-        png_dataset = None
-        dataset = None
-
-        # Создаем мировой файл с геопривязкой только если требуется
-        if save_georeference:
-            create_world_file(output_png_path, geotransform)
-            print(f"Геопривязка сохранена: {output_png_path}")
-        else:
-            print("Геопривязка не сохранена по запросу пользователя")
+def check_encoding(encoding: str, allowed=ENCODINGS):
+    if encoding not in allowed:
+        raise HTTPException(status_code=400, detail=f"Unsupported encoding: {encoding}")
+    if encoding == "msgpack" and not msgpack_available():
+        raise HTTPException(status_code=400, detail="msgpack encoding is not available on the server")
 
-        # Проверяем что файл создан
-        if not os.path.exists(output_png_path):
-            raise HTTPException(
-                status_code=500,
-                detail="Ошибка при создании PNG файла"
-            )
-        headers = {'Filepath': upload_path}
-        return FileResponse(path=output_png_path, media_type='image/png', headers=headers)
 
-    except Exception as e:
-        raise HTTPException(
-            status_code=500,
-            detail=f"Ошибка при конвертации: {str(e)}"
-        )
+def encoded_response(payload: dict, encoding: str) -> Response:
+    """Ответ в кодировке columnar (JSON) или msgpack"""
+    media_type = MSGPACK_MEDIA_TYPE if encoding == "msgpack" else "application/json"
+    return Response(content=dumps(payload, encoding), media_type=media_type)
 
 
 # Оригинальный эндпоинт для детекции по путям
 @app.post("/detect", response_model=DetectionResponse)
 async def detect_objects_endpoint(request: DetectionRequest, background_tasks: BackgroundTasks):
     """Оригинальный эндпоинт для детекции по путям к изображениям"""
+    check_encoding(request.encoding)
     results = []
     errors = []
 
-    # Создаем executor для фоновых задач
-    loop = asyncio.get_event_loop()
-
-    for image_path in request.image_paths:
-        print(image_path)
-        try:
-            # Последовательная детекция на GPU
-            detections = await loop.run_in_executor(
-                None, detect_objects, image_path
+    # Фрагменты всех изображений запроса обрабатываются общими пакетами;
+    # при переполненной очереди запрос отклоняется с оценкой времени ожидания
+    timings = {}
+    settings = await scheduler.run_io(current_detect_settings)
+    try:
+        with span("detect_total", timings):
+            batch_results = await scheduler.run_interactive(
+                detect_objects_batch, request.image_paths, settings, request.model_type,
+                request.confidence_threshold, timings
             )
+    except SchedulerBusy as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+    except KeyError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
-            # # Нанесение результатов
-            # await loop.run_in_executor(
-            #     None, draw_bounding_boxes, image_path, detections
-            # )
+    for image_path, result, error in batch_results:
+        if isinstance(error, FileNotFoundError):
+            errors.append(f"File not found: {image_path}")
+        elif error is not None:
+            errors.append(f"Detection failed for {image_path}: {str(error)}")
+        else:
+            results.append(result)
+
+    if request.encoding != "json":
+        # Столбцы кодируются без модели pydantic: для больших изображений это основная часть ответа
+        binary = request.encoding == "msgpack"
+        return encoded_response({
+            "results": [encode_result(result, binary) for result in results],
+            "errors": errors if errors else None,
+            "timings": timings if request.include_timings else None
+        }, request.encoding)
+    return DetectionResponse(
+        results=results,
+        errors=errors if errors else None,
+        timings=timings if request.include_timings else None
+    )
 
-            # Форматирование в отдельном процессе
-            formatted_result = await loop.run_in_executor(
-                None, process_detection_formatting, image_path, detections
-            )
 
-            results.append(formatted_result)
+@app.post("/jobs/detect", response_model=JobCreateResponse)
+async def create_detect_job(request: DetectionRequest):
+    """Ставит детекцию в очередь и сразу возвращает id задачи"""
+    if len(request.image_paths) == 0:
+        raise HTTPException(status_code=400, detail="No data provided")
+    if request.model_type is not None and request.model_type not in model_registry.models_config:
+        raise HTTPException(status_code=400, detail=f"Unknown model type: {request.model_type}")
+    try:
+        # Задача считается с настройками на момент постановки в очередь
+        job = await job_manager.submit(request.image_paths, {
+            "settings": await scheduler.run_io(current_detect_settings),
+            "model_type": request.model_type,
+            "confidence_threshold": request.confidence_threshold,
+            "include_timings": request.include_timings
+        })
+    except JobQueueFull as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(scheduler.retry_after())})
+    return JobCreateResponse(job_id=job.id, status=job.status, total=len(job.image_paths))
+
+
+async def get_job_or_404(job_id: str) -> dict:
+    job = await job_manager.describe(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+
+@app.get("/workers")
+async def get_workers():
+    """Режим фоновой детекции, очередь брокера и активные процессы-обработчики"""
+    if task_broker is None:
+        return {"mode": "local"}
+    return {"mode": "broker", **(await scheduler.run_io(task_broker.stats))}
+
+
+@app.get("/jobs/{job_id}")
+async def get_detect_job(job_id: str):
+    """Состояние задачи и прогресс по каждому изображению"""
+    return await get_job_or_404(job_id)
+
+
+@app.get("/jobs/{job_id}/results")
+async def stream_detect_job(
+        job_id: str,
+        format: str = Query("ndjson", description="Формат потока: ndjson или sse"),
+        encoding: str = Query("json", description="Кодировка результатов: json или columnar")
+):
+    """Потоково отдает DetectionResult каждого изображения сразу после его обработки"""
+    await get_job_or_404(job_id)
+    if format not in ("ndjson", "sse"):
+        raise HTTPException(status_code=400, detail="Unsupported format")
+    check_encoding(encoding, ("json", "columnar"))
+    sse = format == "sse"
+    return StreamingResponse(
+        job_manager.stream(job_id, sse=sse, encode_result=encode_result if encoding == "columnar" else None),
+        media_type="text/event-stream" if sse else "application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
 
-        except FileNotFoundError:
-            errors.append(f"File not found: {image_path}")
-        except Exception as e:
-            errors.append(str(e))
 
-    return DetectionResponse(results=results, errors=errors if errors else None)
+@app.delete("/jobs/{job_id}")
+async def cancel_detect_job(job_id: str):
+    """
+    Отменяет задачу, уже готовые результаты сохраняются. Задачу, которую выполняет
+    другой процесс сервера, он отменяет сам в течение секунды (cancel_requested)
+    """
+    job = await job_manager.cancel(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
 
 
 # Новый эндпоинт для загрузки изображений
-@app.post("/upload-images", response_model=UploadResponse)
-async def upload_images(files: List[UploadFile] = File(...)):
+@app.post("/upload-images", response_model=UploadResponse, openapi_extra=UPLOAD_REQUEST_BODY)
+async def upload_images(request: Request, background_tasks: BackgroundTasks):
     """Эндпоинт для загрузки изображений через multipart/form-data"""
     results = []
     errors = []
 
-    # Создаем executor для фоновых задач
-    # loop = asyncio.get_event_loop()
-
-    for file in files:
+    # Файлы пишутся на диск блоками прямо из тела запроса, не читаясь в память целиком;
+    # файл с уже загруженным содержимым повторно не записывается
+    for upload in await receive_uploads(request):
         try:
-            # Генерируем уникальное имя файла
-            file_extension = os.path.splitext(file.filename)[1]
-            unique_filename = f"{uuid.uuid4()}{file_extension}"
-            upload_path = os.path.join(UPLOAD_DIR, unique_filename)
-
-            print(file.filename)
-
-            # Сохраняем загруженный файл
-            with open(upload_path, "wb") as buffer:
-                content = await file.read()
-                buffer.write(content)
+            logger.debug("Uploaded %s", upload["filename"])
+            upload_path, content_hash = upload["upload_path"], upload["content_hash"]
 
             # # Последовательная детекция на GPU
             # detections = await loop.run_in_executor(
@@ -396,19 +728,190 @@ async def upload_images(files: List[UploadFile] = File(...)):
 
             # Форматируем результат
             formatted_result = {
-                "original_filename": file.filename,
+                "original_filename": upload["filename"],
                 "uploaded_path": upload_path,
+                "content_hash": content_hash,
+                "duplicate": upload["duplicate"]
             }
 
-            uploaded_files[upload_path] = file.filename
+            # Пирамида тайлов для просмотрщика строится один раз, после ответа
+            tile_store.register(content_hash, upload_path)
+            background_tasks.add_task(tile_store.source, content_hash)
             results.append(formatted_result)
 
         except Exception as e:
-            errors.append(f"Error processing {file.filename}: {str(e)}")
+            errors.append(f"Error processing {upload['filename']}: {str(e)}")
 
     return UploadResponse(results=results, errors=errors if errors else None)
 
 
+# Тайлы адресуются хешем содержимого и никогда не меняются
+TILE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+
+async def tile_response(image_id: str, etag: str, if_none_match: Optional[str], render) -> Response:
+    """Отдает тайл с ETag; повторный запрос с тем же ETag получает 304 без чтения растра"""
+    headers = {"ETag": etag, "Cache-Control": TILE_CACHE_CONTROL}
+    if if_none_match == etag:
+        return Response(status_code=304, headers=headers)
+    try:
+        content = await scheduler.run_io(render)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"Image not found: {image_id}")
+    if content is None:
+        raise HTTPException(status_code=404, detail="Tile not found")
+    return Response(content=content, media_type="image/webp", headers=headers)
+
+
+@app.get("/tiles/{image_id}/info")
+async def get_tiles_info(image_id: str):
+    """Размеры изображения и число уровней пирамиды; при первом запросе строит пирамиду"""
+    try:
+        source = await scheduler.run_io(tile_store.source, image_id)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"Image not found: {image_id}")
+    return source.info()
+
+
+@app.get("/tiles/{image_id}/preview.webp")
+async def get_tiles_preview(image_id: str, if_none_match: Optional[str] = Header(None)):
+    """Уменьшенное изображение целиком: подложка просмотрщика и миниатюра"""
+    return await tile_response(
+        image_id, f'"{image_id}-preview"', if_none_match,
+        lambda: tile_store.preview(image_id)
+    )
+
+
+@app.get("/tiles/{image_id}/{z}/{x}/{y}.webp")
+async def get_tile(image_id: str, z: int, x: int, y: int, if_none_match: Optional[str] = Header(None)):
+    """Тайл уровня z в координатах изображения (уровень max_zoom - исходное разрешение)"""
+    return await tile_response(
+        image_id, f'"{image_id}-{z}-{x}-{y}"', if_none_match,
+        lambda: tile_store.tile(image_id, z, x, y)
+    )
+
+
+def parse_bbox(bbox: Optional[str]) -> Optional[List[float]]:
+    """Область запроса "x1,y1,x2,y2" в пикселях изображения"""
+    if bbox is None:
+        return None
+    try:
+        values = [float(value) for value in bbox.split(",")]
+    except ValueError:
+        values = []
+    if len(values) != 4 or values[0] > values[2] or values[1] > values[3]:
+        raise HTTPException(status_code=400, detail="bbox must be x1,y1,x2,y2 with x1 <= x2 and y1 <= y2")
+    return values
+
+
+def query_detections(
+        image_id: str,
+        run_id: Optional[int],
+        bbox: Optional[List[float]],
+        types: Optional[List[str]],
+        min_conf: Optional[float],
+        offset: int,
+        limit: int
+) -> Optional[dict]:
+    """Страница детекций запуска, отобранных по индексу; None, если запуска нет"""
+    run = catalog.get_run(run_id) if run_id is not None else catalog.latest_run_by_hash(image_id)
+    if run is None or run["content_hash"] != image_id:
+        return None
+    detections = run["result"]["detections"]
+    index = detection_indexes.get(
+        run["id"],
+        lambda: DetectionIndex(detections, spatial_index_config.get('cell_size', 512))
+    )
+    ids = index.query(bbox, types, min_conf)
+    return {
+        "image_id": image_id,
+        "run_id": run["id"],
+        "total": len(ids),
+        "offset": offset,
+        "limit": limit,
+        "types": index.type_counts(),
+        "detections": [{**detections[i], "index": i} for i in ids[offset:offset + limit].tolist()]
+    }
+
+
+@app.get("/detections/{image_id}")
+async def get_detections(
+        image_id: str,
+        bbox: Optional[str] = Query(None, description="Область x1,y1,x2,y2 в пикселях изображения"),
+        type: Optional[str] = Query(None, description="Классы через запятую"),
+        min_conf: Optional[float] = Query(None, ge=0, le=1),
+        run_id: Optional[int] = Query(None, description="Запуск детекции, по умолчанию - последний"),
+        offset: int = Query(0, ge=0),
+        limit: int = Query(1000, ge=1, le=10000),
+        encoding: str = Query("json", description="Кодировка: json, columnar или msgpack")
+):
+    """
+    Детекции изображения (image_id - хеш содержимого, как у тайлов), пересекающие bbox,
+    с фильтром по классу и уверенности; index - номер объекта в полном результате
+    """
+    check_encoding(encoding)
+    types = [name for name in type.split(",") if name] if type else None
+    page = await scheduler.run_io(query_detections, image_id, run_id, parse_bbox(bbox), types, min_conf, offset, limit)
+    if page is None:
+        raise HTTPException(status_code=404, detail=f"No detection run for image: {image_id}")
+    if encoding != "json":
+        return encoded_response(encode_result(page, encoding == "msgpack"), encoding)
+    return page
+
+
+def run_result(run: dict) -> dict:
+    """Сохраненный результат запуска с его id"""
+    return {**run["result"], "run_id": run["id"]}
+
+
+@app.get("/runs/{run_id}")
+async def get_run(
+        run_id: int,
+        encoding: str = Query("json", description="Кодировка: json, columnar или msgpack")
+):
+    """Результат сохраненного запуска детекции"""
+    check_encoding(encoding)
+    run = await scheduler.run_io(catalog.get_run, run_id)
+    if run is None:
+        raise HTTPException(status_code=404, detail=f"Detection run not found: {run_id}")
+    if encoding != "json":
+        return encoded_response(encode_result(run_result(run), encoding == "msgpack"), encoding)
+    return run_result(run)
+
+
+def load_run_results(request: RunsExportRequest) -> List[DetectionResult]:
+    """
+    Результаты сохраненных запусков с правками оператора. Модели собираются без проверки
+    pydantic: данные уже прошли ее при детекции
+    """
+    results = []
+    for edits in request.runs:
+        run = catalog.get_run(edits.run_id)
+        if run is None:
+            raise KeyError(f"Detection run not found: {edits.run_id}")
+        verified = set(edits.verified)
+        deleted = set(edits.deleted)
+        detections = [
+            {**detection, "verified": index in verified}
+            for index, detection in enumerate(run["result"]["detections"])
+            if index not in deleted and (index in verified or not request.verified_only)
+        ]
+        results.append(DetectionResult.model_construct(**{**run_result(run), "detections": detections}))
+    return results
+
+
+async def export_results(request: Union[RunsExportRequest, List[DetectionResult]]) -> List[DetectionResult]:
+    """Результаты для выгрузки: переданные целиком или по id запусков с правками"""
+    if isinstance(request, RunsExportRequest):
+        try:
+            request = await scheduler.run_io(load_run_results, request)
+        except KeyError as e:
+            raise HTTPException(status_code=404, detail=str(e.args[0]))
+    if len(request) == 0:
+        raise HTTPException(status_code=400, detail="No data provided")
+    return request
+
+
 # Эндпоинт для получения размеченных изображений
 @app.get("/annotated-images/{image_name}")
 async def get_annotated_image(image_name: str):
@@ -442,192 +945,229 @@ async def list_annotated_images():
 
 
 @app.post("/export/images-detect")
-async def export_images_detect(request: List[DetectionResult]):
+async def export_images_detect(request: Union[RunsExportRequest, List[DetectionResult]]):
     """Эндпоинт для разметки и отправки изображений"""
-    # Проверяем, что пути переданы
-    if len(request) == 0:
-        raise HTTPException(status_code=400, detail="No data provided")
-
-    results = []
-    errors = []
-
-    # Создаем executor для фоновых задач
-    loop = asyncio.get_event_loop()
-    print(request)
-    for image in request:
-        print(image.image_path)
-        try:
-            # Нанесение результатов
-            await loop.run_in_executor(
-                None, draw_bounding_boxes, image.image_path, image.detections
-            )
-        except FileNotFoundError:
-            errors.append(f"File not found: {image.image_path}")
-        except Exception as e:
-            errors.append(str(e))
+    results = await export_results(request)
 
-    # Создаем буфер в памяти для ZIP-архива
-    zip_buffer = io.BytesIO()
+    # Проверяем, что файл существует и является изображением (по расширению)
+    image_extensions = {'.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tif', '.tiff', '.webp'}
+    images = [
+        (image.image_path, image.detections)
+        for image in results
+        if os.path.isfile(image.image_path) and Path(image.image_path).suffix.lower() in image_extensions
+    ]
 
-    # Счетчик успешно добавленных файлов
-    added_files_count = 0
-
-    # Создаем ZIP-архив и добавляем файлы
-    with ZipFile(zip_buffer, "w") as zip_file:
-        for image in request:
-            file_path = os.path.join(ANNOTATED_DIR, os.path.basename(image.image_path))
-            try:
-                # Проверяем существование файла
-                if not os.path.exists(file_path):
-                    continue
-
-                # Проверяем, что это файл, а не директория
-                if not os.path.isfile(file_path):
-                    continue
-
-                # Проверяем, что файл является изображением (по расширению)
-                image_extensions = {'.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tiff', '.webp'}
-                file_extension = Path(file_path).suffix.lower()
-                if file_extension not in image_extensions:
-                    continue
-
-                # Читаем содержимое файла
-                with open(file_path, "rb") as f:
-                    file_contents = f.read()
-
-                # Получаем только имя файла (без пути)
-                filename = os.path.basename(file_path)
-
-                # Добавляем файл в архив
-                zip_file.writestr(filename, file_contents)
-                added_files_count += 1
-
-            except Exception as e:
-                # Логируем ошибку, но продолжаем обработку других файлов
-                print(f"Error processing file {file_path}: {str(e)}")
-                continue
-
-    # Проверяем, что хотя бы один файл был добавлен
-    if added_files_count == 0:
+    if len(images) == 0:
         raise HTTPException(
             status_code=404,
             detail="No valid image files found from the provided paths"
         )
 
-    # Перемещаем указатель в начало буфера
-    zip_buffer.seek(0)
-
-    # Возвращаем архив как потоковый ответ
+    decoded_paths = {}
+    if decoded_store is not None:
+        decoded_paths = {image_path: decoded_store.decoded_path(image_path) for image_path, _ in images}
+    # Архив отдается по частям по мере отрисовки изображений в пуле процессов. Заголовки уходят
+    # до отрисовки, поэтому в них - число запрошенных изображений; неудавшиеся перечислены
+    # в errors.txt внутри архива
     return StreamingResponse(
-        zip_buffer,
+        timed_aiter("export_zip", stream_annotated_zip(images, decoded_paths=decoded_paths)),
         media_type="application/zip",
         headers={
             "Content-Disposition": "attachment; filename=images.zip",
-            "X-Files-Added": str(added_files_count)
+            "X-Files-Requested": str(len(images))
         }
     )
 
 
+def report_image_name(image_path: str) -> str:
+    """Исходное имя загруженного файла для отчетов"""
+    return catalog.original_filename(image_path) or os.path.basename(image_path)
+
+
+async def report_georeference():
+    """Привязка изображений для отчетов с текущими настройками (читаются один раз на выгрузку)"""
+    settings = await scheduler.run_io(current_detect_settings)
+    return functools.partial(image_georeference, settings=settings)
+
+
+def report_file_name(extension: str) -> str:
+    return f"detection_report_{datetime.now().strftime('%d-%m-%Y_%H:%M')}.{extension}"
+
+
 @app.post("/export/xlsx-data-detect")
-async def export_xlsx_data_detect(request: List[DetectionResult]):
-    """Эндпоинт для разметки и отправки изображений"""
-        # Проверяем, что пути переданы
-    if len(request) == 0:
-        raise HTTPException(status_code=400, detail="No data provided")
+async def export_xlsx_data_detect(request: Union[RunsExportRequest, List[DetectionResult]]):
+    """Эндпоинт для выгрузки таблицы детекций в XLSX"""
+    results = await export_results(request)
 
     # Создаем директорию, если она не существует
     path_data = os.path.join(data_dir, 'csv')
-    if not os.path.exists(path_data):
-        os.makedirs(path_data)
-
-    file_name = f'detection_report_{datetime.now().strftime('%d-%m-%Y_%H:%M')}.xlsx'
-    filepath = os.path.join(path_data, file_name)
-
-    # Создаем новую книгу Excel
-    wb = Workbook()
-    ws = wb.active
-    ws.title = 'Detection'
-
-    dict_list = []
-    for detection in request:
-        for detect_object in detection.detections:
-            detect = {'Изображение': uploaded_files[detection.image_path]}
-            detect['Объект'] = detect_object['type']
-            detect['Вероятность'] = round(float(detect_object['confidence']), 2)
-            detect['Координаты'] = str(detect_object['bbox'])
-            dict_list.append(detect)
-
-    # Записываем данные из списка словарей в Excel
-    if dict_list:
-        header = list(dict_list[0].keys())
-        ws.append(header)  # Записываем заголовки
-
-        for row in dict_list:
-            ws.append([row[col] for col in header])
-
-        # Объединяем ячейки с одинаковыми названиями изображений
-        current_image = None
-        start_row = 2  # Начинаем с первой строки данных (после заголовка)
-
-        for row_num, row in enumerate(ws.iter_rows(min_row=2, max_row=ws.max_row, min_col=1, max_col=1), start=2):
-            cell_value = row[0].value
-
-            if cell_value != current_image:
-                # Если значение изменилось, объединяем предыдущую группу
-                if current_image is not None and (row_num - 1 > start_row):
-                    ws.merge_cells(start_row=start_row, start_column=1, end_row=row_num-1, end_column=1)
-                    # Центрируем текст в объединенной ячейке
-                    ws.cell(row=start_row, column=1).alignment = Alignment(horizontal='center', vertical='center')
-
-                current_image = cell_value
-                start_row = row_num
-
-        # Объединяем последнюю группу
-        if current_image is not None and (ws.max_row >= start_row):
-            ws.merge_cells(start_row=start_row, start_column=1, end_row=ws.max_row, end_column=1)
-            ws.cell(row=start_row, column=1).alignment = Alignment(horizontal='center', vertical='center')
-
-    # Автоматическое изменение ширины столбцов
-    for col in ws.columns:
-        max_length = 0
-        column = col[0].column_letter
-        for cell in col:
-            try:
-                if len(str(cell.value)) > max_length:
-                    max_length = len(cell.value)
-            except:
-                pass
-        adjusted_width = (max_length + 2)
-        ws.column_dimensions[column].width = adjusted_width
+    os.makedirs(path_data, exist_ok=True)
 
-    # Сохраняем файл
-    wb.save(filepath)
+    file_name = report_file_name('xlsx')
+    filepath = os.path.join(path_data, f"{uuid.uuid4()}.xlsx")
 
-    return FileResponse(path=filepath, media_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', headers={'Filename': file_name})
+    with span("export_xlsx"):
+        await scheduler.run_io(write_xlsx_report, results, report_image_name, filepath)
+
+    # Файл удаляется после отправки
+    return FileResponse(
+        path=filepath,
+        media_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+        headers={'Filename': file_name},
+        background=BackgroundTask(os.remove, filepath)
+    )
+
+
+@app.post("/export/csv-data-detect")
+async def export_csv_data_detect(request: Union[RunsExportRequest, List[DetectionResult]]):
+    """Эндпоинт для потоковой выгрузки таблицы детекций в CSV"""
+    results = await export_results(request)
+
+    file_name = report_file_name('csv')
+    return StreamingResponse(
+        timed_iter("export_csv", stream_csv_report(results, report_image_name)),
+        media_type='text/csv; charset=utf-8',
+        headers={'Filename': file_name, 'Content-Disposition': f'attachment; filename="{file_name}"'}
+    )
+
+
+@app.post("/export/geojson-data-detect")
+async def export_geojson_data_detect(request: Union[RunsExportRequest, List[DetectionResult]]):
+    """Эндпоинт для потоковой выгрузки детекций в GeoJSON"""
+    results = await export_results(request)
+
+    file_name = report_file_name('geojson')
+    return StreamingResponse(
+        timed_iter("export_geojson", stream_geojson_report(results, report_image_name, await report_georeference())),
+        media_type='application/geo+json',
+        headers={'Filename': file_name, 'Content-Disposition': f'attachment; filename="{file_name}"'}
+    )
+
+
+def write_ogr_archive(
+        request: List[DetectionResult],
+        georeference,
+        output_format: str,
+        crs: Optional[str],
+        work_dir: str
+) -> str:
+    """Пишет выгрузку OGR в work_dir; Shapefile (несколько файлов на слой) упаковывается в ZIP"""
+    _, extension = OGR_FORMATS[output_format]
+    output_path = os.path.join(work_dir, f"detections{extension}")
+    write_ogr_report(request, report_image_name, georeference, output_path, output_format, crs)
+    if output_format == "shp":
+        output_path = shutil.make_archive(output_path, "zip", output_path)
+    return output_path
+
+
+@app.post("/export/ogr-data-detect")
+async def export_ogr_data_detect(
+        request: Union[RunsExportRequest, List[DetectionResult]],
+        format: str = Query("gpkg", description="Формат: gpkg или shp"),
+        crs: Optional[str] = Query(None, description="Система координат результата, например EPSG:4326")
+):
+    """
+    Эндпоинт для выгрузки детекций в GeoPackage или Shapefile (ZIP) для ГИС.
+    Изображения с привязкой выгружаются в мировых координатах, остальные - в пикселях
+    """
+    results = await export_results(request)
+    if format not in OGR_FORMATS:
+        raise HTTPException(status_code=400, detail="Unsupported format")
+
+    georeference = await report_georeference()
+    work_dir = tempfile.mkdtemp(dir=data_dir)
+    try:
+        with span("export_ogr"):
+            output_path = await scheduler.run_io(write_ogr_archive, results, georeference, format, crs, work_dir)
+    except RuntimeError as e:
+        shutil.rmtree(work_dir, True)
+        raise HTTPException(status_code=400, detail=f"Export failed: {str(e)}")
+
+    file_name = report_file_name('zip' if format == 'shp' else format)
+    return FileResponse(
+        path=output_path,
+        media_type='application/zip' if format == 'shp' else 'application/geopackage+sqlite3',
+        headers={'Filename': file_name, 'Content-Disposition': f'attachment; filename="{file_name}"'},
+        background=BackgroundTask(shutil.rmtree, work_dir, True)
+    )
+
+
+@app.get("/detect/settings")
+async def get_detect_settings():
+    """
+    Текущие настройки детекции и модели, для которых доступна автоматическая нарезка
+    (в config.json задан масштаб обучения train_gsd_m)
+    """
+    return {
+        "settings": await scheduler.run_io(current_detect_settings),
+        "auto_slice_models": [
+            model_type for model_type, model_config in model_registry.models_config.items()
+            if model_config.get('train_gsd_m')
+        ]
+    }
 
 
 @app.post("/detect/settings")
 async def update_detect_settings(request: DetectionSettingsRequest):
-    print(request.settings)
-    detect_settings.settings['model_type'] = request.settings['modelType']
-    detect_settings.settings['confidence_threshold'] = float(request.settings['detectionLimit'])
-    detect_settings.settings['slice_size'] = int(request.settings['detectionSlice'])
-    detect_settings.settings['overlap_ratio'] = float(request.settings['detectionOverlap'])
-    detect_settings.settings['georeference'] = bool(request.settings['georeference'])
-    detect_settings.settings['pixel_size'] = float(request.settings['pixelSize'])
-    load_model()
+    logger.info("Detect settings update: %s", request.settings)
+    if request.settings['modelType'] not in model_registry.models_config:
+        raise HTTPException(status_code=400, detail=f"Unknown model type: {request.settings['modelType']}")
+    settings = await scheduler.run_io(current_detect_settings)
+    settings['model_type'] = request.settings['modelType']
+    settings['confidence_threshold'] = float(request.settings['detectionLimit'])
+    settings['slice_size'] = int(request.settings['detectionSlice'])
+    settings['overlap_ratio'] = float(request.settings['detectionOverlap'])
+    settings['batch_size'] = int(request.settings.get('batchSize', settings['batch_size']))
+    settings['skip_empty_slices'] = bool(request.settings.get('skipEmptySlices', settings['skip_empty_slices']))
+    settings['georeference'] = bool(request.settings['georeference'])
+    settings['pixel_size'] = float(request.settings['pixelSize'])
+    settings['auto_slice'] = bool(request.settings.get('autoSlice', settings['auto_slice']))
+    settings['incremental'] = bool(request.settings.get('incremental', settings['incremental']))
+    # Настройки сохраняются в каталог: следующий запрос в любой процесс сервера получит их
+    await scheduler.run_io(save_detect_settings, settings)
+
+    # Порог применяется фильтром после инференса, перезагрузка не нужна;
+    # при смене модели она лишь подгружается в реестр, если была выгружена
+    if not model_registry.is_loaded(settings['model_type']):
+        await scheduler.run_io(model_registry.get, settings['model_type'])
 
 
 # Эндпоинт для проверки здоровья сервера
 @app.get("/health")
-async def health_check():
-    """Проверка состояния сервера"""
+async def health_check(response: Response):
+    """
+    Проверка состояния сервера. Пока модели загружаются и прогреваются (или загрузка
+    не удалась), отвечает 503, чтобы балансировщик не направлял запросы на этот экземпляр.
+    Отвечает только по состоянию в памяти процесса; размеры хранилищ - в /metrics
+    """
+    readiness = model_registry.readiness()
+    ready = readiness["state"] == "ready"
+    settings = await scheduler.run_io(current_detect_settings)
+    if not ready:
+        response.status_code = 503
     return {
-        "status": "healthy",
-        "gpu_available": torch.cuda.is_available(),
-        "model_loaded": detection_model is not None
+        "status": "healthy" if ready else readiness["state"],
+        "ready": ready,
+        "readiness": readiness,
+        "gpu_available": readiness["device"].startswith("cuda") if readiness["device"] else None,
+        "model_loaded": model_registry.is_loaded(settings['model_type']),
+        "models": model_registry.loaded(),
+        "cache": detection_cache.stats(),
+        "scheduler": scheduler.stats(),
+        "slice_filter": {
+            "enabled": settings['skip_empty_slices'],
+            **slice_filter_stats.stats()
+        }
     }
 
+
+@app.get("/metrics")
+async def metrics():
+    """Метрики сервера в текстовом формате Prometheus"""
+    # Часть показателей считается запросами к каталогу и хранилищам, поэтому вне цикла событий
+    content = await scheduler.run_io(REGISTRY.render)
+    return Response(content=content, media_type="text/plain; version=0.0.4; charset=utf-8")
+
 # if __name__ == "__main__":
 #     import uvicorn
 #     uvicorn.run(
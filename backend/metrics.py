@@ -0,0 +1,249 @@
+import bisect
+import logging
+import resource
+import sys
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import AsyncIterator, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин гистограмм длительности, секунды
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def _labels_key(labels: Optional[dict]) -> Labels:
+    return tuple(sorted((labels or {}).items()))
+
+
+def _format_labels(labels: Labels, extra: Optional[Tuple[str, str]] = None) -> str:
+    items = list(labels) + ([extra] if extra else [])
+    if not items:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in items) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help = help_text
+        self._values: Dict[Labels, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = _labels_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(key)} {_format_value(value)}")
+        return lines
+
+
+class Gauge:
+    """Значение задается вручную (set) или вычисляется при каждом запросе метрик (callback)"""
+
+    def __init__(self, name: str, help_text: str, callback: Optional[Callable[[], Dict[Labels, float]]] = None):
+        self.name = name
+        self.help = help_text
+        self.callback = callback
+        self._values: Dict[Labels, float] = {}
+        self._lock = threading.Lock()
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[_labels_key(labels)] = value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        if self.callback is not None:
+            try:
+                values = self.callback()
+            except Exception as e:
+                logger.warning("Metric %s callback failed: %s", self.name, e)
+                values = {}
+        else:
+            with self._lock:
+                values = dict(self._values)
+        for key, value in sorted(values.items()):
+            if value is not None:
+                lines.append(f"{self.name}{_format_labels(key)} {_format_value(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, buckets: Iterable[float] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(sorted(buckets))
+        # Метки -> (счетчики по корзинам, сумма, количество)
+        self._series: Dict[Labels, list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = _labels_key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * len(self.buckets), 0.0, 0]
+            if index < len(self.buckets):
+                series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, (counts, total, count) in sorted(self._series.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    lines.append(f"{self.name}_bucket{_format_labels(key, ('le', _format_value(bound)))} {cumulative}")
+                lines.append(f"{self.name}_bucket{_format_labels(key, ('le', '+Inf'))} {count}")
+                lines.append(f"{self.name}_sum{_format_labels(key)} {_format_value(total)}")
+                lines.append(f"{self.name}_count{_format_labels(key)} {count}")
+        return lines
+
+
+class RateMeter:
+    """Скорость событий (в секунду) за последние window секунд"""
+
+    def __init__(self, window: float = 60.0):
+        self.window = window
+        self._events = deque()
+        self._lock = threading.Lock()
+
+    def add(self, amount: float = 1):
+        now = time.monotonic()
+        with self._lock:
+            self._events.append((now, amount))
+            self._trim(now)
+
+    def _trim(self, now: float):
+        while self._events and self._events[0][0] < now - self.window:
+            self._events.popleft()
+
+    def rate(self) -> float:
+        now = time.monotonic()
+        with self._lock:
+            self._trim(now)
+            return sum(amount for _, amount in self._events) / self.window
+
+
+class MetricsRegistry:
+    def __init__(self, prefix: str = "detection_api_"):
+        self.prefix = prefix
+        self._metrics = []
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, help_text: str) -> Counter:
+        return self._add(Counter(self.prefix + name, help_text))
+
+    def gauge(self, name: str, help_text: str, callback=None) -> Gauge:
+        return self._add(Gauge(self.prefix + name, help_text, callback))
+
+    def histogram(self, name: str, help_text: str, buckets: Iterable[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._add(Histogram(self.prefix + name, help_text, buckets))
+
+    def render(self) -> str:
+        """Текстовый формат экспозиции Prometheus"""
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+STAGE_SECONDS = REGISTRY.histogram("stage_seconds", "Duration of processing stages")
+MODEL_BATCH_SECONDS = REGISTRY.histogram("model_batch_seconds", "Duration of one model forward pass over a slice batch")
+MODEL_LOAD_SECONDS = REGISTRY.gauge("model_load_seconds", "Time the last load of a model took")
+SLICES_TOTAL = REGISTRY.counter("slices_total", "Slices passed through the model")
+IMAGES_TOTAL = REGISTRY.counter("images_total", "Images processed by detection")
+
+SLICES_RATE = RateMeter()
+IMAGES_RATE = RateMeter()
+
+REGISTRY.gauge(
+    "slices_per_second", "Slices passed through the model per second over the last minute",
+    lambda: {(): SLICES_RATE.rate()}
+)
+REGISTRY.gauge(
+    "images_per_second", "Images processed per second over the last minute",
+    lambda: {(): IMAGES_RATE.rate()}
+)
+
+
+def _memory_high_water() -> Dict[Labels, float]:
+    # На Linux ru_maxrss в килобайтах
+    values = {(("kind", "rss"),): resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024}
+    # torch не импортируется ради метрики: до загрузки модели его может еще не быть
+    torch = sys.modules.get("torch")
+    if torch is not None and torch.cuda.is_available():
+        values[(("kind", "cuda"),)] = torch.cuda.max_memory_allocated()
+    return values
+
+
+REGISTRY.gauge("memory_high_water_bytes", "Peak process RSS and peak CUDA allocation", _memory_high_water)
+
+
+def record_batch(slice_count: int, seconds: float):
+    MODEL_BATCH_SECONDS.observe(seconds)
+    SLICES_TOTAL.inc(slice_count)
+    SLICES_RATE.add(slice_count)
+
+
+def record_image(status: str):
+    IMAGES_TOTAL.inc(status=status)
+    if status == "ok":
+        IMAGES_RATE.add()
+
+
+def record_stage(stage: str, seconds: float, timings: Optional[dict] = None):
+    """
+    Учитывает длительность этапа: гистограмма stage_seconds, журнал на уровне DEBUG
+    и, если передан словарь timings, накопление в timings[stage]
+    """
+    STAGE_SECONDS.observe(seconds, stage=stage)
+    if timings is not None:
+        timings[stage] = round(timings.get(stage, 0.0) + seconds, 6)
+    logger.debug("%s took %.3fs", stage, seconds)
+
+
+@contextmanager
+def span(stage: str, timings: Optional[dict] = None):
+    """Замеряет длительность блока как этап stage (см. record_stage)"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - start, timings)
+
+
+def timed_iter(stage: str, iterator: Iterable) -> Iterator:
+    """Итератор потокового ответа, замеряющий полное время его отдачи"""
+    with span(stage):
+        yield from iterator
+
+
+async def timed_aiter(stage: str, iterator: AsyncIterator) -> AsyncIterator:
+    with span(stage):
+        async for chunk in iterator:
+            yield chunk
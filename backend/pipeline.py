@@ -0,0 +1,346 @@
+"""
+Конвейер детекции без веб-приложения: конфигурация, хранилища, из которых детекция
+берет готовые результаты и в которые их сохраняет, и детекция пакета изображений.
+
+Его используют API (main.py) и процессы-обработчики (worker.py). Настройки детекции
+передаются в каждый вызов явно, поэтому задачи с разными настройками в одном процессе
+друг на друга не влияют.
+"""
+import logging
+import os
+import time
+from typing import List, Optional
+
+from osgeo import gdal
+
+from cache import DetectionCache, file_content_hash
+from catalog import Catalog
+from configfile import config_path, load_config
+from decoded import DecodedImageStore
+from geo import GeoReference, georeference_detections, ground_sample_distance
+from geotiles import GeoTileStore, TilePlan
+from inference import detect_images_batched, detections_from_raw
+from metrics import record_image, record_stage, span
+from raster import read_raster_info, set_decoded_store
+from registry import ModelRegistry
+from scheduler import PRIORITY_INTERACTIVE
+from slicefilter import SliceFilter, SliceFilterStats, slices_summary
+from slicing import SlicePlan, auto_plan, fixed_plan
+
+gdal.UseExceptions()
+
+# config.json лежит в корне проекта; путь можно переопределить переменной окружения
+CONFIG_PATH = config_path()
+config = load_config(CONFIG_PATH)
+
+
+def config_relative_path(path: str) -> str:
+    """
+    Путь из config.json: относительные пути считаются от папки config.json,
+    так что хранилища не зависят от папки, из которой запущен сервер
+    """
+    return os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(CONFIG_PATH)), path))
+
+
+# Папка данных: каталог, кэши и хранилища общие для всех процессов сервера
+data_dir = config_relative_path(config.get('storage', {}).get('data_dir', 'backend/data'))
+os.makedirs(data_dir, exist_ok=True)
+
+# Настройки детекции по умолчанию; измененные через /detect/settings API хранит в каталоге,
+# обработчик получает настройки вместе с каждой задачей
+DEFAULT_SETTINGS = {
+    "model_type": "visible",
+    "confidence_threshold": 0.5,
+    "slice_size": 512,
+    "overlap_ratio": 0.3,
+    "batch_size": 8,
+    "skip_empty_slices": False,
+    "georeference": False,
+    "pixel_size": 5.0,
+    "auto_slice": False,
+    "incremental": config.get('geo_tiles', {}).get('enabled', False)
+}
+
+logging.basicConfig(
+    level=config.get('logging', {}).get('level', 'INFO'),
+    format='%(asctime)s %(levelname)s %(name)s: %(message)s'
+)
+logger = logging.getLogger("detection_api")
+logger.info("Data directory: %s", data_dir)
+
+# Реестр одновременно загруженных моделей
+model_registry = ModelRegistry(
+    config['models'],
+    memory_budget_mb=config.get('inference', {}).get('memory_budget_mb', 4096),
+    confidence_floor=config.get('inference', {}).get('confidence_floor', 0.05),
+    batch_size=DEFAULT_SETTINGS['batch_size'],
+    warmup_size=DEFAULT_SETTINGS['slice_size'],
+    exports_dir=config.get('inference', {}).get('exports_dir')
+)
+
+# Кэш результатов детекции по содержимому изображений
+detection_cache = DetectionCache(
+    config_relative_path(config.get('cache', {}).get('dir', 'backend/cache')),
+    memory_items=config.get('cache', {}).get('memory_items', 256),
+    max_disk_mb=config.get('cache', {}).get('max_disk_mb', 2048)
+)
+
+# Предварительный фильтр пустых фрагментов (включается настройкой skip_empty_slices)
+slice_filter = SliceFilter(**config.get('slice_filter', {}))
+slice_filter_stats = SliceFilterStats()
+
+# Каталог загрузок и сохраненных результатов детекции
+catalog = Catalog(
+    os.path.join(data_dir, "catalog.sqlite3"),
+    ttl_hours=config.get('storage', {}).get('ttl_hours', 72)
+)
+
+# Изображения, декодируемые целиком (PNG, JPEG), декодируются один раз в общий файл,
+# отображаемый в память: его читают нарезка, обработчики и пул отрисовки
+decoded_config = config.get('decoded', {})
+decoded_store = None
+if decoded_config.get('enabled', True):
+    decoded_store = DecodedImageStore(
+        os.path.join(data_dir, "decoded"),
+        max_disk_mb=decoded_config.get('max_disk_mb', 4096),
+        mapped_items=decoded_config.get('mapped_items', 16)
+    )
+    set_decoded_store(decoded_store)
+
+# Детекции повторных съемок по тайлам географической сетки (настройка incremental)
+geo_tiles_config = {key: value for key, value in config.get('geo_tiles', {}).items() if key != 'enabled'}
+geo_tile_store = GeoTileStore(os.path.join(data_dir, "geotiles.sqlite3"), **geo_tiles_config)
+
+
+def detect_objects_batch(
+        image_paths: List[str],
+        settings: dict,
+        model_type: Optional[str] = None,
+        confidence_threshold: Optional[float] = None,
+        timings: Optional[dict] = None,
+        priority: int = PRIORITY_INTERACTIVE
+) -> List[tuple]:
+    """
+    Выполняет детекцию на всех изображениях сразу, фрагменты собираются в общие пакеты.
+    settings - настройки детекции (как DEFAULT_SETTINGS), модель и порог по умолчанию берутся из них.
+    Изображения, уже обработанные той же моделью с теми же параметрами нарезки,
+    берутся из кэша; порог применяется к сырым детекциям после кэша.
+    Возвращает (путь, результат для ответа, ошибка) по каждому изображению;
+    успешные результаты сохраняются в каталог как запуски детекции.
+    Если передан словарь timings, в него складываются длительности этапов.
+    priority - приоритет фрагментов в очереди модели (фоновые задачи - PRIORITY_BULK).
+    С настройкой incremental геопривязанные растры сравниваются по тайлам с прошлыми
+    съемками тех же участков: модель считает только изменившиеся тайлы, детекции
+    остальных переносятся из хранилища тайлов. Тайлы хранятся отдельно для каждого
+    набора параметров нарезки и фильтра, так что после смены настроек тайлы
+    накапливаются заново.
+    """
+    if model_type is None:
+        model_type = settings["model_type"]
+    if confidence_threshold is None:
+        confidence_threshold = settings["confidence_threshold"]
+    active_filter = slice_filter if settings.get("skip_empty_slices") else None
+
+    acquire_start = time.perf_counter()
+    with model_registry.use(model_type) as model_entry:
+        record_stage("model_acquire", time.perf_counter() - acquire_start, timings)
+        detection_model = model_entry.detection_model
+        cache_keys = {}
+        tile_keys = {}
+        slice_plans = {}
+        content_hashes = {}
+        raw_detections = {}
+        errors = {}
+        with span("cache_lookup", timings):
+            for image_path in image_paths:
+                try:
+                    content_hashes[image_path] = file_content_hash(image_path)
+                    plan = slice_plans[image_path] = image_slice_plan(image_path, model_type, settings)
+                    # Все параметры, от которых зависят сырые детекции
+                    detection_params = dict(
+                        backend=model_entry.backend,
+                        slice_size=plan.slice_size,
+                        overlap_ratio=plan.overlap_ratio,
+                        confidence_floor=model_registry.confidence_floor,
+                        slice_filter=active_filter.params() if active_filter is not None else None,
+                        # Без пересчета ключ совпадает с ключами до автоматической нарезки
+                        **({"resample": plan.resample} if plan.resample != 1.0 else {})
+                    )
+                    cache_keys[image_path] = DetectionCache.make_key(
+                        content_hashes[image_path], model_entry.weights_key, **detection_params
+                    )
+                    # Тайлы, посчитанные с другими параметрами или весами, не смешиваются с новыми
+                    tile_keys[image_path] = DetectionCache.make_key(
+                        "geo_tiles", model_entry.weights_key, **detection_params
+                    )
+                except FileNotFoundError:
+                    errors[image_path] = FileNotFoundError(f"Image not found: {image_path}")
+                    continue
+                raw = detection_cache.get(cache_keys[image_path])
+                if raw is not None:
+                    raw_detections[image_path] = raw
+
+        misses = [path for path in dict.fromkeys(image_paths) if path not in raw_detections and path not in errors]
+        tile_plans = {}
+        if misses and settings.get("incremental"):
+            with span("geo_tiles", timings):
+                for image_path in misses:
+                    plan = image_tile_plan(image_path, tile_keys[image_path])
+                    if plan is not None:
+                        tile_plans[image_path] = plan
+        if misses:
+            # Растры, у которых не изменился ни один тайл, модель не считает вовсе
+            to_detect = [path for path in misses if path not in tile_plans or tile_plans[path].recomputed]
+            detected = [(path, None, None) for path in misses if path not in to_detect]
+            if to_detect:
+                detected += detect_images_batched(
+                    model_entry.batcher, to_detect,
+                    slice_size=settings["slice_size"],
+                    overlap_ratio=settings["overlap_ratio"],
+                    slice_filter=active_filter, timings=timings, priority=priority, slice_plans=slice_plans,
+                    regions={path: plan.regions() for path, plan in tile_plans.items() if plan.reused}
+                )
+            for image_path, raw, error in detected:
+                if error is not None:
+                    errors[image_path] = error
+                    continue
+                plan = tile_plans.get(image_path)
+                if plan is not None:
+                    raw = geo_tile_store.combine(plan, raw, detection_model.is_obb)
+                    try:
+                        geo_tile_store.save(plan, raw, image_path)
+                    except Exception as e:
+                        logger.warning("Failed to store geo tiles for %s: %s", image_path, e)
+                raw_detections[image_path] = raw
+                if active_filter is not None:
+                    slice_filter_stats.record(raw.slice_count, raw.skipped, model_entry.batcher.seconds_per_slice)
+                # Результат с перенесенными тайлами зависит от прошлых съемок, а не только
+                # от содержимого файла, поэтому в кэш детекций не попадает
+                if plan is not None and plan.reused:
+                    continue
+                try:
+                    detection_cache.put(cache_keys[image_path], raw)
+                except OSError as e:
+                    logger.warning("Failed to cache detections for %s: %s", image_path, e)
+
+        results = []
+        with span("merge", timings):
+            for image_path in image_paths:
+                if image_path in errors:
+                    results.append((image_path, None, errors[image_path]))
+                    record_image("error")
+                    continue
+                try:
+                    raw = raw_detections[image_path]
+                    detections = detections_from_raw(
+                        raw,
+                        detection_model.category_mapping,
+                        detection_model.is_obb,
+                        confidence_threshold
+                    )
+                    slices = None
+                    if active_filter is not None:
+                        slices = slices_summary(raw.slice_count, raw.skipped, model_entry.batcher.seconds_per_slice)
+                    slice_plan = {**slice_plans[image_path].to_dict(), "slices": raw.slice_count}
+                    result = process_detection_formatting(image_path, detections, settings, slices, slice_plan)
+                    if image_path in tile_plans:
+                        result["geo_tiles"] = tile_plans[image_path].to_dict()
+                    results.append((image_path, result, None))
+                    record_image("ok")
+                except Exception as e:
+                    results.append((image_path, None, e))
+                    record_image("error")
+
+    with span("catalog", timings):
+        catalog.touch(list(content_hashes))
+        for image_path, result, error in results:
+            if error is None:
+                result["run_id"] = catalog.add_run(
+                    image_path, content_hashes[image_path], model_type, confidence_threshold, result
+                )
+    return results
+
+
+def process_detection_formatting(
+        image_path: str,
+        detections: List[dict],
+        settings: dict,
+        slices: Optional[dict] = None,
+        slice_plan: Optional[dict] = None
+) -> dict:
+    """
+    Форматирует результаты детекции для JSON ответа. При включенной привязке
+    к детекциям добавляется контур в мировых координатах (world_polygon)
+    """
+    result = {
+        "image_path": image_path,
+        "detections": detections
+    }
+    if slices is not None:
+        result["slices"] = slices
+    if slice_plan is not None:
+        result["slice_plan"] = slice_plan
+    if settings["georeference"]:
+        reference = image_georeference(image_path, settings)
+        if reference is not None:
+            target = config.get('georeference', {}).get('output_crs')
+            georeference_detections(detections, reference, target)
+            result["crs"] = reference.crs(target)
+    return result
+
+
+def image_raster_info(image_path: str) -> Optional[dict]:
+    """Размер и геопривязка растра из каталога или из файла; None, если GDAL его не читает"""
+    upload = catalog.get_upload(image_path)
+    if upload is not None and upload["width"] is not None:
+        return upload
+    try:
+        return read_raster_info(image_path)
+    except RuntimeError:
+        return None
+
+
+def image_slice_plan(image_path: str, model_type: str, settings: dict) -> SlicePlan:
+    """
+    Нарезка изображения: из настроек или, в автоматическом режиме, по размеру пикселя
+    растра (или pixel_size из настроек, в сантиметрах) и масштабу обучения модели
+    """
+    if not settings.get("auto_slice"):
+        return fixed_plan(settings["slice_size"], settings["overlap_ratio"])
+    info = image_raster_info(image_path)
+    gsd = ground_sample_distance(info["geotransform"], info["projection"]) if info is not None else None
+    gsd_source = "raster" if gsd is not None else None
+    if gsd is None and settings.get("pixel_size"):
+        gsd, gsd_source = settings["pixel_size"] / 100, "pixel_size"
+    return auto_plan(
+        gsd, gsd_source, model_registry.models_config[model_type], settings["slice_size"], settings["overlap_ratio"],
+        **config.get('slicing', {})
+    )
+
+
+def image_tile_plan(image_path: str, model_key: str) -> Optional[TilePlan]:
+    """
+    Тайлы геопривязанного растра с решением, какие из них пересчитывать;
+    None для изображений без системы координат или если растр не удалось разбить
+    """
+    info = image_raster_info(image_path)
+    if info is None or info["geotransform"] is None or not info["projection"]:
+        return None
+    try:
+        return geo_tile_store.plan(image_path, GeoReference(info["geotransform"], info["projection"]), model_key)
+    except Exception as e:
+        logger.warning("Geo tile planning failed for %s, detecting the whole image: %s", image_path, e)
+        return None
+
+
+def image_georeference(image_path: str, settings: dict) -> Optional[GeoReference]:
+    """
+    Привязка изображения: геотрансформация растра из каталога или из файла; для изображений
+    без нее при включенной настройке georeference - условная по размеру пикселя
+    """
+    info = image_raster_info(image_path)
+    if info is not None and info["geotransform"] is not None:
+        return GeoReference(info["geotransform"], info["projection"])
+    if settings["georeference"]:
+        return GeoReference.from_pixel_size(settings["pixel_size"])
+    return None
@@ -0,0 +1,233 @@
+from typing import Optional, Tuple
+
+import numpy as np
+
+
+# Порог совпадения рамок на границах фрагментов (IOS, как в get_sliced_prediction SAHI)
+MATCH_THRESHOLD = 0.5
+
+
+class MergedDetections:
+    """
+    Итог постобработки изображения в виде массивов:
+    boxes (N, 4) xyxy, scores (N,), classes (N,) и, для OBB-моделей, rboxes (N, 5) [cx, cy, w, h, angle]
+    """
+
+    __slots__ = ("boxes", "scores", "classes", "rboxes")
+
+    def __init__(self, boxes: np.ndarray, scores: np.ndarray, classes: np.ndarray, rboxes: Optional[np.ndarray]):
+        self.boxes = boxes
+        self.scores = scores
+        self.classes = classes
+        self.rboxes = rboxes
+
+    def __len__(self) -> int:
+        return len(self.scores)
+
+
+def points_to_xywhr(points: np.ndarray) -> np.ndarray:
+    """
+    Вершины повернутых рамок (N, 8) в порядке ultralytics xyxyxyxy -> (N, 5) [cx, cy, w, h, angle].
+    Угол в радианах в диапазоне [-pi/2, pi/2).
+    """
+    corners = points.reshape(-1, 4, 2).astype(np.float64)
+    center = corners.mean(axis=1)
+    side_w = corners[:, 1] - corners[:, 2]
+    side_h = corners[:, 0] - corners[:, 1]
+    width = np.hypot(side_w[:, 0], side_w[:, 1])
+    height = np.hypot(side_h[:, 0], side_h[:, 1])
+    angle = np.arctan2(side_w[:, 1], side_w[:, 0])
+    angle = (angle + np.pi / 2) % np.pi - np.pi / 2
+    return np.column_stack([center, width, height, angle]).astype(np.float32)
+
+
+def _polygon_area(polygons: np.ndarray) -> np.ndarray:
+    """Площадь многоугольников (..., K, 2) по формуле шнурования"""
+    x = polygons[..., 0]
+    y = polygons[..., 1]
+    return 0.5 * np.abs(np.sum(x * np.roll(y, -1, axis=-1) - np.roll(x, -1, axis=-1) * y, axis=-1))
+
+
+def _counter_clockwise(quads: np.ndarray) -> np.ndarray:
+    """Приводит выпуклые четырехугольники (M, 4, 2) к обходу против часовой стрелки"""
+    x = quads[..., 0]
+    y = quads[..., 1]
+    signed = np.sum(x * np.roll(y, -1, axis=-1) - np.roll(x, -1, axis=-1) * y, axis=-1)
+    return np.where((signed < 0)[:, None, None], quads[:, ::-1], quads)
+
+
+def _cross(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    return a[..., 0] * b[..., 1] - a[..., 1] * b[..., 0]
+
+
+def _inside(points: np.ndarray, quads: np.ndarray) -> np.ndarray:
+    """Лежат ли точки (M, P, 2) внутри выпуклых четырехугольников (M, 4, 2) с обходом против часовой"""
+    edges = np.roll(quads, -1, axis=1) - quads
+    relative = points[:, :, None, :] - quads[:, None, :, :]
+    return np.all(_cross(edges[:, None], relative) >= -1e-6, axis=2)
+
+
+def quad_intersection_area(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """
+    Площадь пересечения пар выпуклых четырехугольников a[i] и b[i], (M, 4, 2) -> (M,).
+
+    Вершины пересечения - это вершины одного четырехугольника внутри другого и точки
+    пересечения ребер (не больше 24 кандидатов на пару). Кандидаты сортируются по углу
+    вокруг их центра, а неподходящие заменяются первой вершиной, что не меняет площадь.
+    """
+    a = _counter_clockwise(a.astype(np.float64))
+    b = _counter_clockwise(b.astype(np.float64))
+    count = len(a)
+
+    # Точки пересечения каждого ребра a с каждым ребром b
+    p = a[:, :, None, :]
+    r = (np.roll(a, -1, axis=1) - a)[:, :, None, :]
+    q = b[:, None, :, :]
+    s = (np.roll(b, -1, axis=1) - b)[:, None, :, :]
+    denominator = _cross(r, s)
+    parallel = np.abs(denominator) < 1e-9
+    denominator = np.where(parallel, 1.0, denominator)
+    t = _cross(q - p, s) / denominator
+    u = _cross(q - p, r) / denominator
+    crossing_valid = ~parallel & (t >= 0) & (t <= 1) & (u >= 0) & (u <= 1)
+    crossings = (p + t[..., None] * r).reshape(count, 16, 2)
+
+    candidates = np.concatenate([a, b, crossings], axis=1)
+    valid = np.concatenate([
+        _inside(a, b),
+        _inside(b, a),
+        crossing_valid.reshape(count, 16)
+    ], axis=1)
+
+    valid_count = valid.sum(axis=1)
+    weights = valid[..., None]
+    center = (candidates * weights).sum(axis=1) / np.maximum(valid_count, 1)[:, None]
+    angles = np.arctan2(candidates[..., 1] - center[:, None, 1], candidates[..., 0] - center[:, None, 0])
+    angles = np.where(valid, angles, np.inf)
+    order = np.argsort(angles, axis=1)
+    polygon = np.take_along_axis(candidates, order[..., None], axis=1)
+    polygon_valid = np.take_along_axis(valid, order, axis=1)
+    polygon = np.where(polygon_valid[..., None], polygon, polygon[:, :1])
+
+    area = _polygon_area(polygon)
+    return np.where(valid_count >= 3, area, 0.0)
+
+
+def candidate_pairs(boxes: np.ndarray, classes: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Пары (i, j), i < j, одного класса с пересекающимися описанными рамками xyxy.
+
+    Рамки сортируются по x1, и для каждой берутся только следующие за ней рамки с x1 < ее x2,
+    поэтому число проверяемых пар растет с плотностью объектов, а не квадратично.
+    """
+    count = len(boxes)
+    if count < 2:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty
+    order = np.argsort(boxes[:, 0], kind="stable")
+    x1_sorted = boxes[order, 0]
+    ends = np.searchsorted(x1_sorted, boxes[order, 2], side="left")
+    starts = np.arange(1, count + 1)
+    lengths = np.maximum(ends - starts, 0)
+    first = np.repeat(np.arange(count), lengths)
+    offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    second = np.repeat(starts, lengths) + offsets
+    i = order[first]
+    j = order[second]
+    keep = (
+        (boxes[i, 1] < boxes[j, 3]) & (boxes[j, 1] < boxes[i, 3])
+        & (boxes[i, 0] < boxes[j, 2]) & (boxes[j, 0] < boxes[i, 2])
+        & (classes[i] == classes[j])
+    )
+    return i[keep], j[keep]
+
+
+def _intersection_over_smaller(
+        boxes: np.ndarray,
+        corners: Optional[np.ndarray],
+        i: np.ndarray,
+        j: np.ndarray
+) -> np.ndarray:
+    """IOS для пар: по повернутым рамкам, если они есть, иначе по xyxy"""
+    if corners is not None:
+        intersection = quad_intersection_area(corners[i], corners[j])
+        areas = _polygon_area(corners.astype(np.float64))
+    else:
+        width = np.minimum(boxes[i, 2], boxes[j, 2]) - np.maximum(boxes[i, 0], boxes[j, 0])
+        height = np.minimum(boxes[i, 3], boxes[j, 3]) - np.maximum(boxes[i, 1], boxes[j, 1])
+        intersection = np.clip(width, 0, None) * np.clip(height, 0, None)
+        areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    smaller = np.minimum(areas[i], areas[j])
+    return intersection / np.maximum(smaller, 1e-9)
+
+
+def _greedy_groups(scores: np.ndarray, i: np.ndarray, j: np.ndarray):
+    """
+    Жадный проход по убыванию уверенности: каждая оставленная рамка забирает
+    еще не занятых соседей. Возвращает индексы оставленных рамок и их группы.
+    """
+    count = len(scores)
+    # Соседи в виде CSR, чтобы не строить матрицу N x N
+    sources = np.concatenate([i, j])
+    targets = np.concatenate([j, i])
+    order = np.argsort(sources, kind="stable")
+    sources = sources[order]
+    targets = targets[order]
+    bounds = np.searchsorted(sources, np.arange(count + 1))
+
+    taken = np.zeros(count, dtype=bool)
+    kept = []
+    groups = []
+    for index in np.argsort(-scores, kind="stable"):
+        if taken[index]:
+            continue
+        neighbours = targets[bounds[index]:bounds[index + 1]]
+        neighbours = neighbours[~taken[neighbours]]
+        taken[index] = True
+        taken[neighbours] = True
+        kept.append(index)
+        groups.append(neighbours)
+    return np.array(kept, dtype=np.int64), groups
+
+
+def merge_detections(
+        boxes: np.ndarray,
+        points: Optional[np.ndarray],
+        confidence_threshold: float = 0.0,
+        match_threshold: float = MATCH_THRESHOLD
+) -> MergedDetections:
+    """
+    Фильтрует детекции по порогу и объединяет дубликаты на границах фрагментов.
+
+    boxes (N, 6) [x1, y1, x2, y2, conf, cls], points (N, 8) для OBB-моделей или None.
+    Повернутые рамки подавляются (NMS) по IOS их пересечения, сохраняя угол; обычные
+    объединяются (NMM) в описанную рамку группы, как GreedyNMM в SAHI. Все вычисления,
+    кроме жадного прохода по уже найденным парам, выполняются на целых массивах.
+    """
+    selected = boxes[:, 4] >= confidence_threshold
+    boxes = boxes[selected]
+    corners = None
+    if points is not None:
+        points = points[selected]
+        corners = points.reshape(-1, 4, 2)
+
+    xyxy = boxes[:, :4].astype(np.float32)
+    scores = boxes[:, 4].astype(np.float32)
+    classes = boxes[:, 5].astype(np.int64)
+
+    i, j = candidate_pairs(xyxy, classes)
+    matched = _intersection_over_smaller(xyxy, corners, i, j) >= match_threshold
+    kept, groups = _greedy_groups(scores, i[matched], j[matched])
+
+    if corners is not None:
+        return MergedDetections(xyxy[kept], scores[kept], classes[kept], points_to_xywhr(points[kept]))
+
+    merged = xyxy[kept].copy()
+    if groups:
+        rows = np.repeat(np.arange(len(groups)), [len(group) for group in groups])
+        members = np.concatenate(groups)
+        np.minimum.at(merged[:, 0], rows, xyxy[members, 0])
+        np.minimum.at(merged[:, 1], rows, xyxy[members, 1])
+        np.maximum.at(merged[:, 2], rows, xyxy[members, 2])
+        np.maximum.at(merged[:, 3], rows, xyxy[members, 3])
+    return MergedDetections(merged, scores[kept], classes[kept], None)
@@ -0,0 +1,222 @@
+import os
+from typing import List, Optional, Tuple
+
+import numpy as np
+from osgeo import gdal
+from PIL import Image
+
+from decoded import DecodedImageStore
+
+gdal.UseExceptions()
+
+# Растры, которые читаются окнами через GDAL, а не декодируются целиком
+GDAL_EXTENSIONS = ('.tif', '.tiff')
+
+# Максимальная сторона уменьшенной копии для полноразмерного прохода модели
+OVERVIEW_MAX_SIDE = 1280
+
+# Хранилище декодированных изображений процесса (set_decoded_store); без него
+# каждый ArrayImageSource декодирует изображение заново в свою память
+_decoded_store: Optional[DecodedImageStore] = None
+
+
+def set_decoded_store(store: Optional[DecodedImageStore]):
+    global _decoded_store
+    _decoded_store = store
+
+
+def resize_image(array: np.ndarray, size: Tuple[int, int]) -> np.ndarray:
+    """RGB-фрагмент -> размер (ширина, высота): уменьшение усреднением, увеличение билинейное"""
+    height, width = array.shape[:2]
+    if (width, height) == size:
+        return array
+    resample = Image.BOX if size[0] < width else Image.BILINEAR
+    return np.asarray(Image.fromarray(array).resize(size, resample))
+
+
+class ArrayImageSource:
+    """
+    Обычное изображение (PNG/JPEG), декодированное целиком. С decoded_store массив -
+    общий файл, отображенный в память, и фрагменты read - его представления без копирования
+    """
+
+    def __init__(self, image_path: str, decoded_store: Optional[DecodedImageStore] = None):
+        if decoded_store is not None:
+            self.array, self.mask = decoded_store.open(image_path)
+            self.height, self.width = self.array.shape[:2]
+            return
+        with Image.open(image_path) as image:
+            # Прозрачные пиксели считаются отсутствием данных
+            self.mask = None
+            if image.mode in ("RGBA", "LA", "PA") or "transparency" in image.info:
+                self.mask = np.asarray(image.convert("RGBA").getchannel("A")) > 0
+            self.array = np.asarray(image.convert("RGB"))
+        self.height, self.width = self.array.shape[:2]
+
+    def read(self, x1: int, y1: int, x2: int, y2: int, out_size: Optional[Tuple[int, int]] = None) -> np.ndarray:
+        if out_size is not None:
+            return resize_image(self.array[y1:y2, x1:x2], out_size)
+        return self.array[y1:y2, x1:x2]
+
+    def read_mask(self, x1: int, y1: int, x2: int, y2: int) -> Optional[np.ndarray]:
+        """Маска пикселей с данными или None, если данные есть везде"""
+        if self.mask is None:
+            return None
+        return self.mask[y1:y2, x1:x2]
+
+    def read_overview(self, max_side: int = OVERVIEW_MAX_SIDE) -> Tuple[np.ndarray, float]:
+        # Изображение уже в памяти, отдаем его без уменьшения
+        return self.array, 1.0
+
+    def read_overview_mask(self, max_side: int = OVERVIEW_MAX_SIDE) -> Optional[np.ndarray]:
+        return self.mask
+
+    def close(self):
+        self.array = None
+        self.mask = None
+
+
+class GdalWindowSource:
+    """
+    Растр, читаемый окнами через GDAL ReadAsArray.
+
+    Растр никогда не декодируется целиком: каждый фрагмент читается отдельным окном,
+    а уменьшенная копия берется из внутренних обзоров (overviews), если они есть.
+    """
+
+    def __init__(self, image_path: str):
+        self.dataset = gdal.Open(image_path, gdal.GA_ReadOnly)
+        self.width = self.dataset.RasterXSize
+        self.height = self.dataset.RasterYSize
+        bands_count = self.dataset.RasterCount
+        # Одноканальный растр дублируется в три канала, у RGBA отбрасывается альфа
+        self.band_list = [1, 2, 3] if bands_count >= 3 else [1]
+        self.block_size = self.dataset.GetRasterBand(1).GetBlockSize()
+        # Маска nodata/альфа-канала GDAL, если в растре есть пиксели без данных
+        self.has_mask = self.dataset.GetRasterBand(1).GetMaskFlags() != gdal.GMF_ALL_VALID
+
+        # Не-8-битные растры линейно приводятся к 0..255 по приблизительному min/max
+        self.scales = None
+        if self.dataset.GetRasterBand(1).DataType != gdal.GDT_Byte:
+            self.scales = []
+            for band_index in self.band_list:
+                band_min, band_max = self.dataset.GetRasterBand(band_index).ComputeRasterMinMax(True)
+                self.scales.append((band_min, max(band_max - band_min, 1e-6)))
+
+    def _to_rgb(self, array: np.ndarray) -> np.ndarray:
+        if array.ndim == 2:
+            array = array[None]
+        if self.scales is not None:
+            channels = [
+                np.clip((channel.astype(np.float32) - band_min) * (255.0 / band_range), 0, 255)
+                for channel, (band_min, band_range) in zip(array, self.scales)
+            ]
+            array = np.stack(channels).astype(np.uint8)
+        if array.shape[0] == 1:
+            array = np.repeat(array, 3, axis=0)
+        return np.moveaxis(array, 0, -1)
+
+    def read(self, x1: int, y1: int, x2: int, y2: int, out_size: Optional[Tuple[int, int]] = None) -> np.ndarray:
+        """Окно растра; с out_size (ширина, высота) GDAL пересчитывает его при чтении, используя обзоры"""
+        if out_size is None:
+            array = self.dataset.ReadAsArray(x1, y1, x2 - x1, y2 - y1, band_list=self.band_list)
+        else:
+            array = self.dataset.ReadAsArray(
+                x1, y1, x2 - x1, y2 - y1,
+                buf_xsize=out_size[0],
+                buf_ysize=out_size[1],
+                band_list=self.band_list,
+                resample_alg=gdal.GRIORA_Average if out_size[0] < x2 - x1 else gdal.GRIORA_Bilinear
+            )
+        return self._to_rgb(array)
+
+    def read_mask(self, x1: int, y1: int, x2: int, y2: int) -> Optional[np.ndarray]:
+        """Маска пикселей с данными или None, если данные есть везде"""
+        if not self.has_mask:
+            return None
+        mask_band = self.dataset.GetRasterBand(1).GetMaskBand()
+        return mask_band.ReadAsArray(x1, y1, x2 - x1, y2 - y1) > 0
+
+    def _overview_size(self, max_side: int) -> Optional[Tuple[int, int]]:
+        factor = max(self.width, self.height) / max_side
+        if factor <= 1:
+            return None
+        return max(1, int(round(self.width / factor))), max(1, int(round(self.height / factor)))
+
+    def read_overview(self, max_side: int = OVERVIEW_MAX_SIDE) -> Tuple[np.ndarray, float]:
+        """Читает весь растр с уменьшением; GDAL сам выбирает подходящий уровень обзоров"""
+        size = self._overview_size(max_side)
+        if size is None:
+            return self.read(0, 0, self.width, self.height), 1.0
+        buf_width, buf_height = size
+        array = self.dataset.ReadAsArray(
+            0, 0, self.width, self.height,
+            buf_xsize=buf_width,
+            buf_ysize=buf_height,
+            band_list=self.band_list,
+            resample_alg=gdal.GRIORA_Average
+        )
+        return self._to_rgb(array), self.width / buf_width
+
+    def read_overview_mask(self, max_side: int = OVERVIEW_MAX_SIDE) -> Optional[np.ndarray]:
+        """Маска в разрешении read_overview"""
+        if not self.has_mask:
+            return None
+        size = self._overview_size(max_side)
+        if size is None:
+            return self.read_mask(0, 0, self.width, self.height)
+        mask_band = self.dataset.GetRasterBand(1).GetMaskBand()
+        return mask_band.ReadAsArray(0, 0, self.width, self.height, buf_xsize=size[0], buf_ysize=size[1]) > 0
+
+    def close(self):
+        self.dataset = None
+
+
+def open_image_source(image_path: str):
+    """Открывает изображение для нарезки: TIFF читается окнами, остальное декодируется"""
+    if not os.path.exists(image_path):
+        raise FileNotFoundError(f"Image not found: {image_path}")
+    if image_path.lower().endswith(GDAL_EXTENSIONS):
+        return GdalWindowSource(image_path)
+    return ArrayImageSource(image_path, _decoded_store)
+
+
+def read_raster_info(image_path: str) -> dict:
+    """Размер, число каналов и геопривязка растра (у PNG/JPEG без world-файла геопривязки нет)"""
+    dataset = gdal.Open(image_path, gdal.GA_ReadOnly)
+    geotransform = dataset.GetGeoTransform(can_return_null=True)
+    info = {
+        "width": dataset.RasterXSize,
+        "height": dataset.RasterYSize,
+        "bands": dataset.RasterCount,
+        "geotransform": list(geotransform) if geotransform is not None else None,
+        "projection": dataset.GetProjection() or None
+    }
+    dataset = None
+    return info
+
+
+def byte_rgb_options(dataset) -> dict:
+    """
+    Параметры gdal.Translate для 8-битной копии растра: первые три канала (или один),
+    палитра раскрывается в RGB, не-8-битные каналы растягиваются по min/max
+    """
+    band = dataset.GetRasterBand(1)
+    options = {}
+    if band.GetRasterColorTable() is not None:
+        options["rgbExpand"] = "rgb"
+    else:
+        options["bandList"] = [1, 2, 3] if dataset.RasterCount >= 3 else [1]
+    if band.DataType != gdal.GDT_Byte:
+        options["outputType"] = gdal.GDT_Byte
+        options["scaleParams"] = [[]]
+    return options
+
+
+def order_slices_by_blocks(slice_bboxes: List[List[int]], block_size: List[int]) -> List[List[int]]:
+    """Упорядочивает фрагменты по строкам блоков растра, чтобы соседние чтения попадали в кэш GDAL"""
+    block_width, block_height = block_size
+    return sorted(
+        slice_bboxes,
+        key=lambda bbox: (bbox[1] // max(block_height, 1), bbox[0] // max(block_width, 1), bbox[1], bbox[0])
+    )
@@ -0,0 +1,270 @@
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from backends import BACKENDS, exported_model_path, tune_runtime
+from inference import SliceBatcher, run_model_batch
+from metrics import MODEL_LOAD_SECONDS
+
+logger = logging.getLogger(__name__)
+
+
+class ModelEntry:
+    """Загруженная модель со своим пакетным движком"""
+
+    def __init__(
+            self,
+            model_config: dict,
+            detection_model,
+            batcher: SliceBatcher,
+            size_bytes: int,
+            backend: str = "torch",
+            weights_version: Optional[str] = None
+    ):
+        self.config = model_config
+        self.type = model_config['type']
+        self.name = model_config['name']
+        self.filename = model_config['filename']
+        # Размер и время изменения весов на момент загрузки: веса, замененные под тем же
+        # именем, дают другие ключи кэша детекций
+        self.weights_version = weights_version
+        # Фактический бэкенд: при ошибке экспорта или загрузки - torch
+        self.backend = backend
+        self.detection_model = detection_model
+        self.batcher = batcher
+        self.size_bytes = size_bytes
+        self.loaded_at = time.time()
+        self.last_used = self.loaded_at
+        # Сколько запросов сейчас используют модель; такие модели не выгружаются
+        self.users = 0
+
+    @property
+    def weights_key(self) -> str:
+        """Веса модели для ключей кэша: имя файла и версия загруженных весов"""
+        if self.weights_version is None:
+            return self.filename
+        return f"{self.filename}:{self.weights_version}"
+
+    def to_dict(self) -> dict:
+        return {
+            "type": self.type,
+            "name": self.name,
+            "filename": self.filename,
+            "backend": self.backend,
+            "device": str(self.detection_model.device),
+            "size_mb": round(self.size_bytes / 2 ** 20, 1),
+            "users": self.users,
+            "last_used": self.last_used
+        }
+
+
+def _model_size_bytes(detection_model, model_path: str) -> int:
+    """Оценка занимаемой памяти по весам модели"""
+    try:
+        return sum(p.numel() * p.element_size() for p in detection_model.model.model.parameters())
+    except Exception:
+        if os.path.isdir(model_path):
+            return sum(entry.stat().st_size for entry in os.scandir(model_path) if entry.is_file())
+        return os.path.getsize(model_path)
+
+
+class ModelRegistry:
+    """
+    Реестр одновременно загруженных моделей из config.json.
+
+    Модели загружаются один раз с минимальным порогом уверенности confidence_floor,
+    а порог конкретного запроса применяется после инференса фильтром, поэтому смена
+    порога не требует перезагрузки. Если суммарный размер моделей превышает
+    memory_budget_mb, выгружаются давно не использованные модели без активных запросов.
+
+    Бэкенд задается в записи модели: "backend" (torch, onnx или openvino), "half"
+    (fp16: для torch - на GPU, для onnx/openvino - при экспорте) и "threads" (потоки
+    ONNX Runtime / OpenVINO). Экспорт кэшируется в exports_dir; если бэкенд недоступен,
+    модель загружается в torch.
+    """
+
+    def __init__(
+            self,
+            models_config: List[dict],
+            models_dir: str = "models",
+            memory_budget_mb: float = 4096,
+            confidence_floor: float = 0.05,
+            batch_size: int = 8,
+            warmup_size: int = 512,
+            exports_dir: Optional[str] = None
+    ):
+        self.models_config = {model['type']: model for model in models_config}
+        for model_config in models_config:
+            if model_config.get('backend', 'torch') not in BACKENDS:
+                raise ValueError(f"Unknown inference backend for {model_config['type']}: {model_config['backend']}")
+        self.models_dir = models_dir
+        self.exports_dir = exports_dir or os.path.join(models_dir, "exports")
+        self.memory_budget = memory_budget_mb * 2 ** 20
+        self.confidence_floor = confidence_floor
+        self.batch_size = batch_size
+        self.warmup_size = warmup_size
+        # Устройство определяется при первой загрузке модели (импорт torch - секунды)
+        self.device: Optional[str] = None
+        # Готовность к работе: starting -> warming -> ready или failed
+        self.state = "starting"
+        self.state_error: Optional[str] = None
+        self._entries: "OrderedDict[str, ModelEntry]" = OrderedDict()
+        self._lock = threading.RLock()
+        # Отдельная блокировка на загрузку каждого типа, чтобы не грузить одну модель дважды
+        self._load_locks: Dict[str, threading.Lock] = {
+            model_type: threading.Lock() for model_type in self.models_config
+        }
+        # Модели одного устройства считают по очереди: одна блокировка на устройство
+        self._device_locks: Dict[str, threading.Lock] = {}
+
+    def device_lock(self, device: str) -> threading.Lock:
+        with self._lock:
+            return self._device_locks.setdefault(str(device), threading.Lock())
+
+    def resolve_device(self) -> str:
+        if self.device is None:
+            import torch
+            self.device = "cuda:0" if torch.cuda.is_available() else "cpu"
+        return self.device
+
+    def model_path(self, model_type: str) -> str:
+        return os.path.join(self.models_dir, self.models_config[model_type]['filename'])
+
+    def loaded(self) -> List[dict]:
+        with self._lock:
+            return [entry.to_dict() for entry in self._entries.values()]
+
+    def is_loaded(self, model_type: str) -> bool:
+        with self._lock:
+            return model_type in self._entries
+
+    def set_batch_size(self, batch_size: int):
+        with self._lock:
+            self.batch_size = batch_size
+            for entry in self._entries.values():
+                entry.batcher.batch_size = batch_size
+
+    def load_detection_model(self, model_type: str, backend: str):
+        """Загружает и прогревает модель в заданном бэкенде (без регистрации в реестре)"""
+        model_config = self.models_config[model_type]
+        half = bool(model_config.get('half', False))
+        # torch, sahi и ultralytics импортируются при первой загрузке, а не при старте сервера
+        from sahi import AutoDetectionModel
+        model_path = exported_model_path(
+            self.model_path(model_type), backend, self.exports_dir, self.warmup_size, half=half
+        )
+        detection_model = AutoDetectionModel.from_pretrained(
+            model_type="ultralytics",
+            model_path=model_path,
+            confidence_threshold=self.confidence_floor,
+            device=self.resolve_device()
+        )
+        if backend == "torch" and half and self.device.startswith("cuda"):
+            detection_model.model.overrides["half"] = True
+        # Прогрев: первый проход выделяет память и компилирует ядра
+        # (для onnx/openvino - еще и создает сессию среды выполнения)
+        warmup = np.zeros((self.warmup_size, self.warmup_size, 3), dtype=np.uint8)
+        run_model_batch(detection_model, [warmup])
+        tune_runtime(detection_model, backend, model_config.get('threads'))
+        return detection_model
+
+    def _load(self, model_type: str) -> ModelEntry:
+        model_config = self.models_config[model_type]
+        backend = model_config.get('backend', 'torch')
+        start = time.time()
+        # Версия снимается до загрузки: если веса заменят позже, загруженная модель останется старой
+        stat = os.stat(self.model_path(model_type))
+        weights_version = f"{stat.st_size}:{stat.st_mtime_ns}"
+        try:
+            detection_model = self.load_detection_model(model_type, backend)
+        except Exception as e:
+            if backend == "torch":
+                raise
+            logger.warning("Model %s: %s backend failed (%s), falling back to torch", model_type, backend, e)
+            backend = "torch"
+            detection_model = self.load_detection_model(model_type, backend)
+        batcher = SliceBatcher(detection_model, self.batch_size, device_lock=self.device_lock(self.device))
+        entry = ModelEntry(
+            model_config, detection_model, batcher,
+            _model_size_bytes(detection_model, detection_model.model_path), backend, weights_version
+        )
+        load_seconds = time.time() - start
+        MODEL_LOAD_SECONDS.set(load_seconds, model=model_type)
+        logger.info("Model %s loaded on %s (%s) in %.1fs", model_type, detection_model.device, backend, load_seconds)
+        return entry
+
+    def _evict(self, keep: str):
+        """Выгружает самые давно использованные простаивающие модели, пока не уложимся в бюджет"""
+        total = sum(entry.size_bytes for entry in self._entries.values())
+        for model_type in list(self._entries.keys()):
+            if total <= self.memory_budget:
+                break
+            entry = self._entries[model_type]
+            if model_type == keep or entry.users > 0:
+                continue
+            del self._entries[model_type]
+            entry.batcher.stop()
+            total -= entry.size_bytes
+            logger.info("Model %s unloaded (memory budget)", model_type)
+        if self.device is not None and self.device.startswith("cuda"):
+            import torch
+            torch.cuda.empty_cache()
+
+    def get(self, model_type: str) -> ModelEntry:
+        """Возвращает загруженную модель, при необходимости загружая ее"""
+        if model_type not in self.models_config:
+            raise KeyError(f"Unknown model type: {model_type}")
+        with self._lock:
+            entry = self._entries.get(model_type)
+            if entry is not None:
+                self._entries.move_to_end(model_type)
+                return entry
+        with self._load_locks[model_type]:
+            with self._lock:
+                entry = self._entries.get(model_type)
+                if entry is not None:
+                    return entry
+            entry = self._load(model_type)
+            with self._lock:
+                self._entries[model_type] = entry
+                self._evict(keep=model_type)
+            return entry
+
+    @contextmanager
+    def use(self, model_type: str):
+        """Держит модель загруженной на время запроса"""
+        while True:
+            entry = self.get(model_type)
+            with self._lock:
+                # Модель могли выгрузить между get и захватом
+                if self._entries.get(model_type) is entry:
+                    entry.users += 1
+                    entry.last_used = time.time()
+                    break
+        try:
+            yield entry
+        finally:
+            with self._lock:
+                entry.users -= 1
+
+    def warm_up(self, model_types: Optional[List[str]] = None):
+        """Загружает и прогревает модели (по умолчанию все из конфигурации); ход - в readiness()"""
+        self.state = "warming"
+        try:
+            for model_type in model_types or list(self.models_config.keys()):
+                self.get(model_type)
+        except Exception as e:
+            self.state = "failed"
+            self.state_error = str(e)
+            raise
+        self.state = "ready"
+        self.state_error = None
+
+    def readiness(self) -> dict:
+        return {"state": self.state, "device": self.device, "error": self.state_error}
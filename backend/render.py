@@ -0,0 +1,68 @@
+import io
+import math
+import os
+from typing import List, Optional, Tuple
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+
+def rbox_corners(rbox: List[float]) -> List[Tuple[float, float]]:
+    """Вершины повернутой рамки [cx, cy, w, h, угол в радианах]"""
+    cx, cy, w, h, angle = rbox
+    cos, sin = math.cos(angle), math.sin(angle)
+    half_w = (w / 2 * cos, w / 2 * sin)
+    half_h = (-h / 2 * sin, h / 2 * cos)
+    return [
+        (cx + half_w[0] + half_h[0], cy + half_w[1] + half_h[1]),
+        (cx + half_w[0] - half_h[0], cy + half_w[1] - half_h[1]),
+        (cx - half_w[0] - half_h[0], cy - half_w[1] - half_h[1]),
+        (cx - half_w[0] + half_h[0], cy - half_w[1] + half_h[1])
+    ]
+
+
+def draw_detections(image: Image.Image, detections: List[dict]) -> Image.Image:
+    """Рисует bounding boxes и подписи на изображении"""
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGB')
+    draw = ImageDraw.Draw(image)
+    font = ImageFont.load_default()
+    color = 'red'
+
+    for detection in detections:
+        x, y, w, h = detection['bbox']
+
+        # Рисуем повернутую рамку, если она есть, иначе прямоугольник
+        if detection.get('rbox'):
+            draw.polygon(rbox_corners(detection['rbox']), outline=color, width=2)
+        else:
+            draw.rectangle([x, y, x + w, y + h], outline=color, width=2)
+
+        # Добавляем подпись
+        label = f"{detection['type']} {detection['confidence']:.2f}"
+        text_bbox = draw.textbbox((x, y + h), label, font=font)
+        draw.rectangle(text_bbox, fill=color)
+        draw.text((x, y + h), label, fill='white', font=font)
+    return image
+
+
+def render_annotated_image(
+        image_path: str,
+        detections: List[dict],
+        decoded_path: Optional[str] = None
+) -> Tuple[str, bytes]:
+    """
+    Размечает изображение и возвращает (имя файла, закодированные байты).
+    Выполняется в пуле процессов, поэтому модуль не тянет тяжелых зависимостей.
+    decoded_path - файл .npy, в который изображение уже декодировано для детекции
+    (DecodedImageStore): пиксели берутся из него, а исходный файл открывается только ради формата.
+    """
+    with Image.open(image_path) as image:
+        image_format = image.format or 'PNG'
+        # Прозрачность в декодированном RGB не сохраняется, такие изображения декодируются заново
+        if decoded_path is not None and image.mode not in ('RGBA', 'LA', 'PA'):
+            image = Image.fromarray(np.load(decoded_path, mmap_mode='r'))
+        annotated = draw_detections(image, detections)
+        buffer = io.BytesIO()
+        annotated.save(buffer, format=image_format)
+    return os.path.basename(image_path), buffer.getvalue()
@@ -0,0 +1,113 @@
+import asyncio
+import functools
+import math
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+
+# Приоритеты фрагментов в очереди модели: меньше - раньше
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 1
+
+
+class SchedulerBusy(Exception):
+    """Очередь интерактивных запросов заполнена; retry_after - через сколько секунд повторить"""
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class InferenceScheduler:
+    """
+    Раздельные пулы потоков вместо общего пула по умолчанию.
+
+    Интерактивные запросы (/detect) и фоновые задачи выполняются в своих пулах,
+    а их фрагменты попадают в общую очередь модели с разным приоритетом, так что
+    модель сначала обрабатывает интерактивные фрагменты. Чтение и запись файлов,
+    тайлы и отчеты идут в пул ввода-вывода и не занимают потоки инференса.
+    Если интерактивных запросов больше max_pending, новые отклоняются (429).
+    """
+
+    def __init__(
+            self,
+            interactive_threads: int = 4,
+            bulk_threads: int = 4,
+            io_threads: int = 8,
+            max_pending: int = 16
+    ):
+        self.interactive_pool = ThreadPoolExecutor(interactive_threads, thread_name_prefix="inference")
+        self.bulk_pool = ThreadPoolExecutor(bulk_threads, thread_name_prefix="bulk")
+        self.io_pool = ThreadPoolExecutor(io_threads, thread_name_prefix="io")
+        self.interactive_threads = interactive_threads
+        self.max_pending = max_pending
+        self.pending = 0
+        self.rejected = 0
+        # Скользящее среднее длительности интерактивного запроса
+        self.seconds_per_request = 0.0
+        self._lock = threading.Lock()
+
+    def retry_after(self) -> int:
+        """Оценка времени до освобождения места в очереди, секунды"""
+        with self._lock:
+            waves = self.pending / self.interactive_threads
+            return max(1, math.ceil(waves * self.seconds_per_request))
+
+    def _admit(self):
+        with self._lock:
+            if self.pending >= self.max_pending:
+                self.rejected += 1
+                busy = True
+            else:
+                self.pending += 1
+                busy = False
+        if busy:
+            raise SchedulerBusy(
+                f"Inference queue is full ({self.max_pending} requests)",
+                self.retry_after()
+            )
+
+    def _done(self, seconds: float):
+        with self._lock:
+            self.pending -= 1
+            if self.seconds_per_request:
+                self.seconds_per_request = 0.9 * self.seconds_per_request + 0.1 * seconds
+            else:
+                self.seconds_per_request = seconds
+
+    async def run_interactive(self, fn: Callable, *args, **kwargs):
+        """Выполняет детекцию интерактивного запроса; SchedulerBusy, если очередь заполнена"""
+        self._admit()
+        start = time.perf_counter()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                self.interactive_pool, functools.partial(fn, *args, **kwargs)
+            )
+        finally:
+            self._done(time.perf_counter() - start)
+
+    async def run_bulk(self, fn: Callable, *args, **kwargs):
+        """Выполняет детекцию фоновой задачи (ограничение - очередь задач JobManager)"""
+        return await asyncio.get_running_loop().run_in_executor(
+            self.bulk_pool, functools.partial(fn, *args, **kwargs)
+        )
+
+    async def run_io(self, fn: Callable, *args, **kwargs):
+        """Выполняет блокирующую операцию с файлами"""
+        return await asyncio.get_running_loop().run_in_executor(
+            self.io_pool, functools.partial(fn, *args, **kwargs)
+        )
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "pending": self.pending,
+                "max_pending": self.max_pending,
+                "rejected": self.rejected,
+                "seconds_per_request": round(self.seconds_per_request, 3)
+            }
+
+    def shutdown(self):
+        for pool in (self.interactive_pool, self.bulk_pool, self.io_pool):
+            pool.shutdown(wait=False, cancel_futures=True)
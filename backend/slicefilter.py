@@ -0,0 +1,123 @@
+import threading
+from typing import Optional
+
+import numpy as np
+
+
+# Причины пропуска фрагмента (0 - фрагмент обрабатывается)
+SKIP_NODATA = 1
+SKIP_UNIFORM = 2
+SKIP_LOW_ENTROPY = 3
+# Фрагмент целиком в тайлах, не изменившихся с прошлой съемки (geotiles)
+SKIP_UNCHANGED = 4
+
+SKIP_REASONS = {
+    SKIP_NODATA: "nodata",
+    SKIP_UNIFORM: "uniform",
+    SKIP_LOW_ENTROPY: "low_entropy",
+    SKIP_UNCHANGED: "unchanged"
+}
+
+
+class SliceFilter:
+    """
+    Дешевая оценка фрагмента до инференса.
+
+    Фрагмент пропускается, если в нем почти нет данных (маска nodata/альфа-канала GDAL),
+    если он однороден (малое стандартное отклонение яркости) или если гистограмма
+    яркости почти вырождена (малая энтропия): пустые поля, вода, поля без данных.
+    При use_overview оценка делается по уменьшенной копии растра, поэтому
+    пропущенные фрагменты не читаются в полном разрешении.
+    """
+
+    def __init__(
+            self,
+            min_valid_fraction: float = 0.05,
+            min_std: float = 4.0,
+            min_entropy: float = 2.0,
+            use_overview: bool = True,
+            sample_step: int = 4
+    ):
+        self.min_valid_fraction = min_valid_fraction
+        self.min_std = min_std
+        self.min_entropy = min_entropy
+        self.use_overview = use_overview
+        # Шаг прореживания пикселей при оценке фрагмента полного разрешения
+        self.sample_step = sample_step
+
+    def params(self) -> dict:
+        """Параметры, влияющие на результат детекции (для ключа кэша)"""
+        return {
+            "min_valid_fraction": self.min_valid_fraction,
+            "min_std": self.min_std,
+            "min_entropy": self.min_entropy,
+            "use_overview": self.use_overview
+        }
+
+    def classify(self, image: np.ndarray, mask: Optional[np.ndarray] = None, step: Optional[int] = None) -> int:
+        """Причина пропуска фрагмента (SKIP_*) или 0, если фрагмент нужно обработать"""
+        if step is None:
+            step = self.sample_step
+        image = image[::step, ::step]
+        if image.size == 0:
+            return SKIP_NODATA
+        gray = image.mean(axis=2) if image.ndim == 3 else image.astype(np.float32)
+
+        if mask is not None:
+            mask = mask[::step, ::step]
+            if mask.mean() < self.min_valid_fraction:
+                return SKIP_NODATA
+            values = gray[mask]
+        else:
+            values = gray.ravel()
+
+        if values.std() < self.min_std:
+            return SKIP_UNIFORM
+
+        histogram = np.bincount(values.astype(np.uint8), minlength=256)
+        probabilities = histogram[histogram > 0] / values.size
+        entropy = -np.sum(probabilities * np.log2(probabilities))
+        if entropy < self.min_entropy:
+            return SKIP_LOW_ENTROPY
+        return 0
+
+
+class SliceFilterStats:
+    """Накопительная статистика пропуска фрагментов за время работы сервера"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.slices = 0
+        self.skipped = {reason: 0 for reason in SKIP_REASONS.values()}
+        self.seconds_saved = 0.0
+
+    def record(self, slice_count: int, skipped: np.ndarray, seconds_per_slice: float):
+        with self._lock:
+            self.slices += slice_count
+            for code, count in zip(*np.unique(skipped[:, 4], return_counts=True)):
+                self.skipped[SKIP_REASONS[int(code)]] += int(count)
+            self.seconds_saved += len(skipped) * seconds_per_slice
+
+    def stats(self) -> dict:
+        with self._lock:
+            skipped = sum(self.skipped.values())
+            return {
+                "slices": self.slices,
+                "skipped": skipped,
+                "skipped_by_reason": dict(self.skipped),
+                "skip_rate": round(skipped / self.slices, 3) if self.slices else None,
+                "estimated_seconds_saved": round(self.seconds_saved, 1)
+            }
+
+
+def slices_summary(slice_count: int, skipped: np.ndarray, seconds_per_slice: float) -> dict:
+    """Сводка по фрагментам изображения для ответа API"""
+    return {
+        "total": slice_count,
+        "skipped": len(skipped),
+        "skipped_slices": [
+            {"bbox": row[:4], "reason": SKIP_REASONS[row[4]]}
+            for row in skipped.tolist()
+        ],
+        "estimated_seconds_saved": round(len(skipped) * seconds_per_slice, 3)
+    }
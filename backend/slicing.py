@@ -0,0 +1,103 @@
+from typing import Optional
+
+# Отклонение масштаба изображения от масштаба обучения, при котором фрагменты не пересчитываются
+SCALE_TOLERANCE = 0.15
+
+# Пределы перекрытия, подобранного по размеру объектов
+MIN_OVERLAP = 0.05
+MAX_OVERLAP = 0.5
+
+
+class SlicePlan:
+    """
+    Нарезка одного изображения: размер фрагмента и перекрытие в пикселях изображения,
+    resample - сколько пикселей изображения приходится на пиксель входа модели
+    (больше 1 - фрагмент уменьшается, меньше 1 - увеличивается).
+    gsd - размер пикселя изображения на местности (м), gsd_source - откуда он взят.
+    fallback - почему автоматическая нарезка заменена нарезкой из настроек
+    """
+
+    __slots__ = ("mode", "slice_size", "overlap_ratio", "resample", "gsd", "gsd_source", "fallback")
+
+    def __init__(
+            self,
+            mode: str,
+            slice_size: int,
+            overlap_ratio: float,
+            resample: float = 1.0,
+            gsd: Optional[float] = None,
+            gsd_source: Optional[str] = None,
+            fallback: Optional[str] = None
+    ):
+        self.mode = mode
+        self.slice_size = slice_size
+        self.overlap_ratio = overlap_ratio
+        self.resample = resample
+        self.gsd = gsd
+        self.gsd_source = gsd_source
+        self.fallback = fallback
+
+    def to_dict(self) -> dict:
+        return {
+            "mode": self.mode,
+            "slice_size": self.slice_size,
+            "overlap_ratio": self.overlap_ratio,
+            "resample": self.resample,
+            "gsd": self.gsd,
+            "gsd_source": self.gsd_source,
+            "fallback": self.fallback
+        }
+
+
+def fixed_plan(slice_size: int, overlap_ratio: float) -> SlicePlan:
+    """Нарезка из настроек без учета масштаба изображения"""
+    return SlicePlan("fixed", slice_size, overlap_ratio)
+
+
+def auto_plan(
+        gsd: Optional[float],
+        gsd_source: Optional[str],
+        model_config: dict,
+        default_slice_size: int,
+        default_overlap: float,
+        max_upsample: float = 2.0,
+        max_downsample: float = 8.0
+) -> SlicePlan:
+    """
+    Нарезка по размеру пикселя изображения и масштабу обучения модели.
+
+    Фрагмент после пересчета совпадает с входом модели (input_size) и объекты на нем
+    имеют тот же размер в пикселях, что при обучении (train_gsd_m): снимки крупнее
+    масштаба обучения режутся на меньшее число фрагментов с уменьшением, мелкие -
+    увеличиваются не больше чем в max_upsample раз. Перекрытие - минимальное, при котором
+    самый крупный объект (max_object_m) целиком попадает хотя бы в один фрагмент;
+    вместе с наибольшим допустимым фрагментом это дает наименьшее число фрагментов.
+    Параметры модели задаются в ее записи config.json по данным обучения; без масштаба
+    обучения или без размера пикселя нарезка берется из настроек (mode fixed), а причина
+    записывается в fallback.
+    """
+    train_gsd = model_config.get('train_gsd_m')
+    if not train_gsd or not gsd:
+        plan = fixed_plan(default_slice_size, default_overlap)
+        plan.gsd, plan.gsd_source = gsd, gsd_source
+        plan.fallback = "model_scale_unknown" if not train_gsd else "gsd_unknown"
+        return plan
+    input_size = int(model_config.get('input_size') or default_slice_size)
+    max_object = model_config.get('max_object_m')
+
+    resample = min(max(train_gsd / gsd, 1.0 / max_upsample), max_downsample)
+    resample = 1.0 if abs(resample - 1.0) <= SCALE_TOLERANCE else round(resample, 4)
+
+    overlap_ratio = default_overlap
+    if max_object:
+        object_pixels = max_object / (gsd * resample)
+        overlap_ratio = min(max(object_pixels / input_size, MIN_OVERLAP), MAX_OVERLAP)
+
+    return SlicePlan(
+        "auto",
+        slice_size=max(1, int(round(input_size * resample))),
+        overlap_ratio=round(overlap_ratio, 3),
+        resample=resample,
+        gsd=gsd,
+        gsd_source=gsd_source
+    )
@@ -0,0 +1,129 @@
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Sequence
+
+import numpy as np
+
+# Размер ячейки сетки индекса в пикселях изображения
+DEFAULT_CELL_SIZE = 512
+
+
+class DetectionIndex:
+    """
+    Равномерная сетка над рамками детекций одного изображения.
+
+    Каждая ячейка хранит номера детекций, рамки которых ее пересекают (формат CSR:
+    номера всех ячеек подряд и смещения начала каждой ячейки). Запрос по области
+    просматривает только ячейки этой области, а фильтры по классу и уверенности
+    применяются к массивам numpy без обхода списка детекций.
+    Номера детекций - их позиции в исходном списке результата.
+    """
+
+    def __init__(self, detections: List[dict], cell_size: int = DEFAULT_CELL_SIZE):
+        self.cell_size = cell_size
+        self.count = len(detections)
+        boxes = np.array([detection["bbox"] for detection in detections], dtype=np.float64).reshape(-1, 4)
+        self.x1, self.y1 = boxes[:, 0], boxes[:, 1]
+        self.x2, self.y2 = boxes[:, 0] + boxes[:, 2], boxes[:, 1] + boxes[:, 3]
+        self.confidence = np.array([detection["confidence"] for detection in detections], dtype=np.float64)
+        self.type_names, self.type_codes = np.unique(
+            np.array([detection["type"] for detection in detections], dtype=object).astype(str),
+            return_inverse=True
+        )
+        self._build_grid()
+
+    def _cell_range(self, start: np.ndarray, end: np.ndarray, cells: Optional[int] = None):
+        first = np.maximum(np.floor(start / self.cell_size), 0).astype(np.int64)
+        last = np.maximum(np.floor(end / self.cell_size), first).astype(np.int64)
+        if cells is not None:
+            last = np.minimum(last, cells - 1)
+        return first, last
+
+    def _build_grid(self):
+        col0, col1 = self._cell_range(self.x1, self.x2)
+        row0, row1 = self._cell_range(self.y1, self.y2)
+        self.columns = int(col1.max()) + 1 if self.count else 0
+        self.rows = int(row1.max()) + 1 if self.count else 0
+
+        # Каждая детекция раскладывается на все покрытые ею ячейки
+        widths = col1 - col0 + 1
+        covered = widths * (row1 - row0 + 1)
+        ids = np.repeat(np.arange(self.count), covered)
+        starts = np.cumsum(covered) - covered
+        local = np.arange(len(ids)) - np.repeat(starts, covered)
+        width = np.repeat(widths, covered)
+        cells = (np.repeat(row0, covered) + local // width) * self.columns + np.repeat(col0, covered) + local % width
+
+        order = np.argsort(cells, kind="stable")
+        self._cell_ids = ids[order]
+        self._cell_offsets = np.searchsorted(cells[order], np.arange(self.columns * self.rows + 1))
+
+    def _candidates(self, bbox: Sequence[float]) -> np.ndarray:
+        x1, y1, x2, y2 = bbox
+        if self.count == 0:
+            return np.zeros(0, dtype=np.int64)
+        # Рамки левее и выше начала координат лежат в крайних ячейках: запрос туда
+        # же прижимается к ним, а не отбрасывается
+        (col0,), (col1,) = self._cell_range(np.array([x1]), np.array([x2]), self.columns)
+        (row0,), (row1,) = self._cell_range(np.array([y1]), np.array([y2]), self.rows)
+        if col0 >= self.columns or row0 >= self.rows:
+            return np.zeros(0, dtype=np.int64)
+        # Ячейки одной строки сетки лежат подряд, поэтому строка - один срез
+        parts = [
+            self._cell_ids[self._cell_offsets[row * self.columns + col0]:self._cell_offsets[row * self.columns + col1 + 1]]
+            for row in range(row0, row1 + 1)
+        ]
+        candidates = np.unique(np.concatenate(parts))
+        # Ячейки грубее запроса: оставляем только действительно пересекающиеся рамки
+        hit = (
+                (self.x1[candidates] <= x2) & (self.x2[candidates] >= x1) &
+                (self.y1[candidates] <= y2) & (self.y2[candidates] >= y1)
+        )
+        return candidates[hit]
+
+    def query(
+            self,
+            bbox: Optional[Sequence[float]] = None,
+            types: Optional[Sequence[str]] = None,
+            min_confidence: Optional[float] = None
+    ) -> np.ndarray:
+        """
+        Номера детекций (по возрастанию), рамки которых пересекают bbox = [x1, y1, x2, y2],
+        с классом из types и уверенностью не ниже min_confidence; None - без ограничения
+        """
+        ids = self._candidates(bbox) if bbox is not None else np.arange(self.count)
+        if types is not None:
+            codes = np.flatnonzero(np.isin(self.type_names, list(types)))
+            ids = ids[np.isin(self.type_codes[ids], codes)]
+        if min_confidence is not None:
+            ids = ids[self.confidence[ids] >= min_confidence]
+        return ids
+
+    def type_counts(self) -> Dict[str, int]:
+        """Число детекций каждого класса - для фильтров интерфейса"""
+        counts = np.bincount(self.type_codes, minlength=len(self.type_names))
+        return {name: int(count) for name, count in zip(self.type_names.tolist(), counts.tolist())}
+
+
+class DetectionIndexCache:
+    """LRU индексов по id запуска детекции: результат запуска не меняется, индекс строится один раз"""
+
+    def __init__(self, max_items: int = 32):
+        self.max_items = max_items
+        self._items: "OrderedDict[int, DetectionIndex]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, run_id: int, build: Callable[[], DetectionIndex]) -> DetectionIndex:
+        with self._lock:
+            index = self._items.get(run_id)
+            if index is not None:
+                self._items.move_to_end(run_id)
+                return index
+        # Построение вне блокировки: параллельные запросы других изображений не ждут
+        index = build()
+        with self._lock:
+            self._items[run_id] = index
+            self._items.move_to_end(run_id)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+        return index
@@ -0,0 +1,214 @@
+import io
+import math
+import os
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, Optional
+
+import numpy as np
+from osgeo import gdal
+from PIL import Image
+
+from raster import byte_rgb_options
+
+gdal.UseExceptions()
+
+# Размер тайла и блока COG-копии
+TILE_SIZE = 256
+
+# Максимальная сторона обзорного изображения (подложка просмотрщика и миниатюра)
+PREVIEW_MAX_SIDE = 1024
+
+WEBP_QUALITY = 80
+
+
+class TileSource:
+    """
+    Пирамида тайлов одного изображения поверх его 8-битной COG-копии.
+
+    Уровень max_zoom - исходное разрешение, каждый следующий уровень вниз уменьшен вдвое,
+    уровень 0 помещается в один тайл. Уменьшенные уровни читаются из внутренних обзоров COG,
+    поэтому тайл любого уровня - это чтение одного-двух блоков.
+    """
+
+    def __init__(self, cog_path: str):
+        self.cog_path = cog_path
+        dataset = gdal.Open(cog_path, gdal.GA_ReadOnly)
+        self.width = dataset.RasterXSize
+        self.height = dataset.RasterYSize
+        self.band_list = [1, 2, 3] if dataset.RasterCount >= 3 else [1]
+        dataset = None
+        self.max_zoom = max(0, math.ceil(math.log2(max(self.width, self.height) / TILE_SIZE)))
+        # Датасет GDAL нельзя использовать из нескольких потоков, у каждого потока свой
+        self._local = threading.local()
+
+    def _dataset(self):
+        dataset = getattr(self._local, "dataset", None)
+        if dataset is None:
+            dataset = gdal.Open(self.cog_path, gdal.GA_ReadOnly)
+            self._local.dataset = dataset
+        return dataset
+
+    def info(self) -> dict:
+        return {
+            "width": self.width,
+            "height": self.height,
+            "tile_size": TILE_SIZE,
+            "max_zoom": self.max_zoom
+        }
+
+    def _read(self, x: int, y: int, width: int, height: int, buf_width: int, buf_height: int) -> bytes:
+        array = self._dataset().ReadAsArray(
+            x, y, width, height,
+            buf_xsize=buf_width,
+            buf_ysize=buf_height,
+            band_list=self.band_list,
+            resample_alg=gdal.GRIORA_Average
+        )
+        if array.ndim == 3:
+            array = np.moveaxis(array, 0, -1)
+        buffer = io.BytesIO()
+        Image.fromarray(np.ascontiguousarray(array)).save(buffer, format="WEBP", quality=WEBP_QUALITY)
+        return buffer.getvalue()
+
+    def read_tile(self, z: int, x: int, y: int) -> Optional[bytes]:
+        """Тайл WebP уровня z; крайние тайлы меньше TILE_SIZE. None, если тайла нет"""
+        if not 0 <= z <= self.max_zoom or x < 0 or y < 0:
+            return None
+        factor = 2 ** (self.max_zoom - z)
+        span = TILE_SIZE * factor
+        x0, y0 = x * span, y * span
+        if x0 >= self.width or y0 >= self.height:
+            return None
+        width = min(span, self.width - x0)
+        height = min(span, self.height - y0)
+        return self._read(
+            x0, y0, width, height,
+            max(1, math.ceil(width / factor)),
+            max(1, math.ceil(height / factor))
+        )
+
+    def read_preview(self, max_side: int = PREVIEW_MAX_SIDE) -> bytes:
+        """Все изображение, уменьшенное до max_side по большей стороне"""
+        factor = max(1.0, max(self.width, self.height) / max_side)
+        return self._read(
+            0, 0, self.width, self.height,
+            max(1, int(round(self.width / factor))),
+            max(1, int(round(self.height / factor)))
+        )
+
+
+def build_preview_cog(image_path: str, cog_path: str):
+    """
+    Строит 8-битную копию изображения для просмотра в формате COG: тайлы TILE_SIZE
+    и внутренние обзоры. Не-8-битные растры растягиваются по min/max, палитра раскрывается в RGB.
+    """
+    source = gdal.Open(image_path, gdal.GA_ReadOnly)
+    options = gdal.TranslateOptions(
+        format="COG",
+        creationOptions=[
+            f"BLOCKSIZE={TILE_SIZE}",
+            "COMPRESS=JPEG",
+            "QUALITY=90",
+            "OVERVIEW_RESAMPLING=AVERAGE",
+            "NUM_THREADS=ALL_CPUS"
+        ],
+        **byte_rgb_options(source)
+    )
+    tmp_path = f"{cog_path}.{threading.get_ident()}.tmp"
+    gdal.Translate(tmp_path, source, options=options)
+    source = None
+    os.replace(tmp_path, cog_path)
+
+
+class TileStore:
+    """
+    Пирамиды тайлов загруженных изображений, адресуемые хешем содержимого (image_id).
+
+    COG-копия строится один раз на изображение (при загрузке в фоне или при первом запросе),
+    а закодированные тайлы держатся в LRU в памяти. Так как image_id - хеш содержимого,
+    тайл по заданному адресу никогда не меняется и может кэшироваться браузером бессрочно.
+    resolve(image_id) находит путь изображения, зарегистрированного другим процессом.
+    """
+
+    def __init__(
+            self,
+            tiles_dir: str,
+            memory_tiles: int = 1024,
+            resolve: Optional[Callable[[str], Optional[str]]] = None
+    ):
+        self.tiles_dir = tiles_dir
+        self.memory_tiles = memory_tiles
+        self.resolve = resolve
+        os.makedirs(tiles_dir, exist_ok=True)
+        self._images: Dict[str, str] = {}
+        self._sources: Dict[str, TileSource] = {}
+        self._build_locks: Dict[str, threading.Lock] = {}
+        self._tiles: "OrderedDict[tuple, bytes]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def register(self, image_id: str, image_path: str):
+        with self._lock:
+            self._images[image_id] = image_path
+            self._build_locks.setdefault(image_id, threading.Lock())
+
+    def forget(self, image_id: str):
+        """Удаляет пирамиду изображения (COG-копию и тайлы в памяти)"""
+        with self._lock:
+            self._images.pop(image_id, None)
+            self._sources.pop(image_id, None)
+            for key in [key for key in self._tiles if key[0] == image_id]:
+                del self._tiles[key]
+        try:
+            os.remove(os.path.join(self.tiles_dir, f"{image_id}.tif"))
+        except FileNotFoundError:
+            pass
+
+    def source(self, image_id: str) -> TileSource:
+        """Пирамида изображения; при первом обращении строит COG-копию. KeyError, если id неизвестен"""
+        with self._lock:
+            source = self._sources.get(image_id)
+            if source is not None:
+                return source
+            image_path = self._images.get(image_id)
+        if image_path is None:
+            image_path = self.resolve(image_id) if self.resolve is not None else None
+            if image_path is None:
+                raise KeyError(image_id)
+            self.register(image_id, image_path)
+        with self._lock:
+            build_lock = self._build_locks[image_id]
+        with build_lock:
+            with self._lock:
+                source = self._sources.get(image_id)
+                if source is not None:
+                    return source
+            cog_path = os.path.join(self.tiles_dir, f"{image_id}.tif")
+            if not os.path.exists(cog_path):
+                build_preview_cog(image_path, cog_path)
+            source = TileSource(cog_path)
+            with self._lock:
+                self._sources[image_id] = source
+            return source
+
+    def _cached(self, key: tuple, render) -> Optional[bytes]:
+        with self._lock:
+            content = self._tiles.get(key)
+            if content is not None:
+                self._tiles.move_to_end(key)
+                return content
+        content = render()
+        if content is not None:
+            with self._lock:
+                self._tiles[key] = content
+                while len(self._tiles) > self.memory_tiles:
+                    self._tiles.popitem(last=False)
+        return content
+
+    def tile(self, image_id: str, z: int, x: int, y: int) -> Optional[bytes]:
+        source = self.source(image_id)
+        return self._cached((image_id, z, x, y), lambda: source.read_tile(z, x, y))
+
+    def preview(self, image_id: str) -> bytes:
+        source = self.source(image_id)
+        return self._cached((image_id, "preview"), source.read_preview)
@@ -0,0 +1,211 @@
+import hashlib
+import os
+import threading
+import uuid
+from typing import Iterable, List, Optional, Tuple
+
+from python_multipart import MultipartParser
+from python_multipart.exceptions import MultipartParseError
+from python_multipart.multipart import parse_options_header
+
+from cache import remember_file_hash
+
+
+class UploadTooLarge(Exception):
+    """Загружаемый файл или запрос больше допустимого размера"""
+
+
+class UploadWriter:
+    """
+    Один загружаемый файл: блоки пишутся во временный файл хранилища, SHA-256 считается
+    по ходу записи. commit переименовывает файл по хешу, abort удаляет недописанный
+    """
+
+    def __init__(self, store: "UploadStore", filename: str):
+        self.store = store
+        self.filename = filename
+        self.tmp_path = os.path.join(store.upload_dir, f".{uuid.uuid4()}.part")
+        self.digest = hashlib.sha256()
+        self.size = 0
+        self.file = open(self.tmp_path, "wb")
+
+    def write(self, chunk: bytes):
+        self.size += len(chunk)
+        if self.store.max_size_bytes is not None and self.size > self.store.max_size_bytes:
+            raise UploadTooLarge(
+                f"File {self.filename} exceeds maximum upload size of {self.store.max_size_bytes // 2 ** 20} MB"
+            )
+        self.digest.update(chunk)
+        self.file.write(chunk)
+
+    def commit(self) -> Tuple[str, str, bool]:
+        """Возвращает (путь, хеш, был ли файл уже загружен)"""
+        self.file.close()
+        content_hash = self.digest.hexdigest()
+        final_path = self.store.final_path(content_hash, os.path.splitext(self.filename)[1])
+        try:
+            with self.store.lock:
+                duplicate = os.path.exists(final_path)
+                if not duplicate:
+                    os.replace(self.tmp_path, final_path)
+        finally:
+            self.abort()
+        remember_file_hash(final_path, content_hash)
+        return final_path, content_hash, duplicate
+
+    def abort(self):
+        self.file.close()
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+
+class MultipartUploadReader:
+    """
+    Разбирает тело multipart/form-data по мере получения и пишет файлы поля field
+    прямо в хранилище: тело запроса не копируется во временный файл сервера,
+    и запись прекращается, как только файл превысил допустимый размер.
+
+    Блокирующие методы feed/finish/abort вызываются из пула потоков. Результат по каждому
+    файлу - словарь с filename и upload_path, content_hash, duplicate или error
+    """
+
+    def __init__(
+            self,
+            store: "UploadStore",
+            content_type: Optional[str],
+            field: str = "files",
+            suffixes: Optional[Iterable[str]] = None,
+            unsupported_message: str = "Unsupported file type"
+    ):
+        media_type, options = parse_options_header(content_type or "")
+        boundary = options.get(b"boundary")
+        if media_type != b"multipart/form-data" or not boundary:
+            raise ValueError("Expected multipart/form-data request body")
+        self.store = store
+        self.field = field
+        self.suffixes = tuple(suffix.lower() for suffix in suffixes) if suffixes else None
+        self.unsupported_message = unsupported_message
+        self.results: List[dict] = []
+        self._writer: Optional[UploadWriter] = None
+        self._headers = {}
+        self._header_field = b""
+        self._header_value = b""
+        self.parser = MultipartParser(boundary, callbacks={
+            "on_part_begin": self._on_part_begin,
+            "on_header_field": self._on_header_field,
+            "on_header_value": self._on_header_value,
+            "on_header_end": self._on_header_end,
+            "on_headers_finished": self._on_headers_finished,
+            "on_part_data": self._on_part_data,
+            "on_part_end": self._on_part_end
+        })
+
+    def _on_part_begin(self):
+        self._headers = {}
+
+    def _on_header_field(self, data: bytes, start: int, end: int):
+        self._header_field += data[start:end]
+
+    def _on_header_value(self, data: bytes, start: int, end: int):
+        self._header_value += data[start:end]
+
+    def _on_header_end(self):
+        self._headers[self._header_field.lower()] = self._header_value
+        self._header_field = b""
+        self._header_value = b""
+
+    def _on_headers_finished(self):
+        _, options = parse_options_header(self._headers.get(b"content-disposition", b""))
+        filename = options.get(b"filename")
+        # Остальные поля формы и пустые поля выбора файла пропускаются
+        if options.get(b"name", b"").decode() != self.field or not filename:
+            return
+        filename = os.path.basename(filename.decode("utf-8", "replace"))
+        if self.suffixes is not None and not filename.lower().endswith(self.suffixes):
+            self.results.append({"filename": filename, "error": self.unsupported_message})
+            return
+        self._writer = UploadWriter(self.store, filename)
+
+    def _on_part_data(self, data: bytes, start: int, end: int):
+        if self._writer is not None:
+            self._writer.write(data[start:end])
+
+    def _on_part_end(self):
+        if self._writer is None:
+            return
+        writer, self._writer = self._writer, None
+        upload_path, content_hash, duplicate = writer.commit()
+        self.results.append({
+            "filename": writer.filename,
+            "upload_path": upload_path,
+            "content_hash": content_hash,
+            "duplicate": duplicate
+        })
+
+    def feed(self, chunk: bytes):
+        try:
+            self.parser.write(chunk)
+        except MultipartParseError as e:
+            raise ValueError(f"Malformed multipart body: {e}")
+
+    def finish(self):
+        try:
+            self.parser.finalize()
+        except MultipartParseError as e:
+            raise ValueError(f"Malformed multipart body: {e}")
+        if self._writer is not None:
+            raise ValueError(f"Request body ended in the middle of file {self._writer.filename}")
+
+    def abort(self):
+        """Удаляет недописанный файл, если разбор прерван"""
+        if self._writer is not None:
+            self._writer.abort()
+            self._writer = None
+
+
+class UploadStore:
+    """
+    Хранилище загруженных файлов, адресуемое содержимым.
+
+    Файлы пишутся на диск блоками прямо из тела запроса (MultipartUploadReader),
+    SHA-256 считается по ходу записи, поэтому файл никогда не держится в памяти целиком
+    и не копируется повторно. Имя сохраненного файла - хеш содержимого, так что повторная
+    загрузка того же файла стоит одного прохода хеширования и не занимает места на диске.
+    Хеш сразу передается в кэш детекций.
+
+    max_size_mb ограничивает каждый файл (запись прекращается на пределе),
+    max_request_mb - объявленный Content-Length запроса (он отклоняется до чтения тела).
+    """
+
+    def __init__(
+            self,
+            upload_dir: str,
+            max_size_mb: Optional[float] = None,
+            max_request_mb: Optional[float] = None,
+            chunk_size: int = 2 ** 20
+    ):
+        self.upload_dir = upload_dir
+        self.max_size_bytes = max_size_mb * 2 ** 20 if max_size_mb else None
+        self.max_request_bytes = max_request_mb * 2 ** 20 if max_request_mb else None
+        self.chunk_size = chunk_size
+        os.makedirs(upload_dir, exist_ok=True)
+        self.lock = threading.Lock()
+
+    def final_path(self, content_hash: str, extension: str) -> str:
+        return os.path.join(self.upload_dir, f"{content_hash}{extension.lower()}")
+
+    def check_request_size(self, content_length: Optional[str]):
+        """Отклоняет запрос по заголовку Content-Length, не читая тело"""
+        if self.max_request_bytes is None or not content_length:
+            return
+        try:
+            size = int(content_length)
+        except ValueError:
+            return
+        if size > self.max_request_bytes:
+            raise UploadTooLarge(
+                f"Request exceeds maximum upload size of {self.max_request_bytes // 2 ** 20} MB"
+            )
+
+    def reader(self, content_type: Optional[str], **kwargs) -> MultipartUploadReader:
+        return MultipartUploadReader(self, content_type, **kwargs)
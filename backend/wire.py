@@ -0,0 +1,79 @@
+import base64
+import importlib.util
+import json
+from typing import List
+
+import numpy as np
+
+# Кодировки результатов: json - список объектов, columnar - столбцы в JSON (base64),
+# msgpack - те же столбцы с байтами без base64 (нужен пакет msgpack)
+ENCODINGS = ("json", "columnar", "msgpack")
+
+MSGPACK_MEDIA_TYPE = "application/x-msgpack"
+
+
+def _column(values, dtype: str, shape: tuple, binary: bool) -> dict:
+    """Типизированный массив little endian: {dtype, shape, data}; в браузере - TypedArray над data"""
+    array = np.ascontiguousarray(np.asarray(values, dtype=dtype).reshape(shape))
+    data = array.tobytes()
+    return {
+        "dtype": array.dtype.name,
+        "shape": list(array.shape),
+        "data": data if binary else base64.b64encode(data).decode("ascii")
+    }
+
+
+def columnar_detections(detections: List[dict], binary: bool = False) -> dict:
+    """
+    Детекции по столбцам: классы - словарь имен и коды, рамки и уверенность - float32,
+    мировые координаты - float64, verified - int8 (-1 - не размечен). Необязательные
+    столбцы (rbox, world_polygon, index) есть, только если они есть у детекций.
+    """
+    count = len(detections)
+    type_names, type_codes = np.unique(
+        np.array([detection["type"] for detection in detections], dtype=object).astype(str),
+        return_inverse=True
+    )
+    columns = {
+        "count": count,
+        "types": type_names.tolist(),
+        "type": _column(type_codes, "<u2", (count,), binary),
+        "bbox": _column([detection["bbox"] for detection in detections], "<f4", (count, 4), binary),
+        "confidence": _column([detection["confidence"] for detection in detections], "<f4", (count,), binary),
+        "verified": _column(
+            [-1 if detection.get("verified") is None else int(bool(detection["verified"])) for detection in detections],
+            "<i1", (count,), binary
+        )
+    }
+    if any("rbox" in detection for detection in detections):
+        nan = [float("nan")] * 5
+        columns["rbox"] = _column(
+            [detection.get("rbox", nan) for detection in detections], "<f4", (count, 5), binary
+        )
+    if any("world_polygon" in detection for detection in detections):
+        nan = [[float("nan")] * 2] * 4
+        columns["world_polygon"] = _column(
+            [detection.get("world_polygon", nan) for detection in detections], "<f8", (count, 4, 2), binary
+        )
+    if any("index" in detection for detection in detections):
+        columns["index"] = _column([detection["index"] for detection in detections], "<u4", (count,), binary)
+    return columns
+
+
+def encode_result(result: dict, binary: bool = False) -> dict:
+    """Результат изображения с детекциями в столбцах (поле columns вместо detections)"""
+    encoded = {key: value for key, value in result.items() if key != "detections"}
+    encoded["columns"] = columnar_detections(result["detections"], binary)
+    return encoded
+
+
+def msgpack_available() -> bool:
+    return importlib.util.find_spec("msgpack") is not None
+
+
+def dumps(payload: dict, encoding: str) -> bytes:
+    """Тело ответа в кодировке columnar или msgpack"""
+    if encoding == "msgpack":
+        import msgpack
+        return msgpack.packb(payload, use_bin_type=True)
+    return json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
@@ -0,0 +1,139 @@
+"""
+Процесс-обработчик фоновой детекции.
+
+Берет изображения фоновых задач из очереди брокера (config.json: workers.mode = "broker")
+пакетами одной модели и параметров, считает их тем же конвейером, что и API
+(pipeline.py: кэш детекций, каталог запусков, общее хранилище загрузок), и возвращает
+результаты через брокер. Веб-приложение обработчик не загружает. Обработчиков может быть несколько на машине и на разных машинах
+с общим хранилищем данных; их можно запускать и останавливать во время выполнения
+задач: по SIGTERM/SIGINT обработчик досчитывает текущий пакет, а задачи пропавшего
+обработчика возвращаются в очередь по истечении аренды.
+
+Запуск из папки backend:
+    python worker.py --batch 4 --threads 4 --models visible
+"""
+import argparse
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+import uuid
+from typing import List
+
+# Папка моделей считается от папки backend
+os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+import pipeline  # noqa: E402
+from broker import TaskBroker  # noqa: E402
+from scheduler import PRIORITY_BULK  # noqa: E402
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Background detection worker")
+    parser.add_argument("--worker-id", help="Worker name (default: host-pid-random)")
+    parser.add_argument("--models", help="Comma separated model types to serve (default: all)")
+    parser.add_argument("--batch", type=int, default=4, help="Images claimed at once and batched together")
+    parser.add_argument("--threads", type=int, help="CPU threads for inference in this worker")
+    parser.add_argument("--idle-sleep", type=float, default=0.5, help="Seconds to wait when the queue is empty")
+    return parser.parse_args(argv)
+
+
+class Heartbeat(threading.Thread):
+    """Продлевает аренду выданных задач, пока обработчик их считает"""
+
+    def __init__(self, broker, worker_id: str, models):
+        super().__init__(daemon=True, name="heartbeat")
+        self.broker = broker
+        self.worker_id = worker_id
+        self.models = models
+        self.task_ids: List[int] = []
+        self.interval = broker.lease_seconds / 3
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.broker.heartbeat(self.worker_id, list(self.task_ids), self.models)
+            except Exception as e:
+                pipeline.logger.warning("Heartbeat failed: %s", e)
+
+
+def run_tasks(broker, worker_id: str, tasks: List[dict]):
+    """Считает пакет задач одной группы и отправляет результаты в брокер"""
+    options = tasks[0]["options"]
+    timings = {} if options.get("include_timings") else None
+    # Настройки нарезки берутся из задачи и действуют только на этот пакет
+    results = pipeline.detect_objects_batch(
+        [task["image_path"] for task in tasks],
+        options["settings"],
+        tasks[0]["model_type"],
+        options.get("confidence_threshold"),
+        timings,
+        PRIORITY_BULK
+    )
+    for task, (image_path, result, error) in zip(tasks, results):
+        if error is None:
+            if timings is not None:
+                result["timings"] = timings
+            broker.complete(task["id"], worker_id, result)
+        elif isinstance(error, FileNotFoundError):
+            broker.fail(task["id"], worker_id, f"File not found: {image_path}")
+        else:
+            broker.fail(task["id"], worker_id, f"Detection failed for {image_path}: {str(error)}")
+
+
+def main_loop(args) -> int:
+    worker_id = args.worker_id or f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+    models = args.models.split(",") if args.models else None
+    config = pipeline.config.get('workers', {})
+    broker = TaskBroker(
+        os.path.join(pipeline.data_dir, config.get('broker_db', 'broker.sqlite3')),
+        lease_seconds=config.get('lease_seconds', 60),
+        max_attempts=config.get('max_attempts', 3)
+    )
+    if args.threads:
+        # torch читает число потоков при импорте, а импортируется он при загрузке модели
+        os.environ.setdefault("OMP_NUM_THREADS", str(args.threads))
+        for model_config in pipeline.model_registry.models_config.values():
+            model_config['threads'] = args.threads
+
+    stopping = threading.Event()
+
+    def stop(signum, frame):
+        pipeline.logger.info("Worker %s stopping after the current batch", worker_id)
+        stopping.set()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    pipeline.model_registry.warm_up(models)
+    broker.heartbeat(worker_id, [], models)
+    heartbeat = Heartbeat(broker, worker_id, models)
+    heartbeat.start()
+    pipeline.logger.info("Worker %s ready, models: %s", worker_id, models or "all")
+
+    while not stopping.is_set():
+        tasks = broker.claim(worker_id, args.batch, models)
+        if not tasks:
+            stopping.wait(args.idle_sleep)
+            continue
+        heartbeat.task_ids = [task["id"] for task in tasks]
+        start = time.perf_counter()
+        try:
+            run_tasks(broker, worker_id, tasks)
+        except Exception as e:
+            pipeline.logger.exception("Batch failed: %s", e)
+            for task in tasks:
+                broker.fail(task["id"], worker_id, str(e))
+        finally:
+            heartbeat.task_ids = []
+        pipeline.logger.info("Processed %d images in %.2fs", len(tasks), time.perf_counter() - start)
+
+    heartbeat.stopped.set()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_loop(parse_args()))
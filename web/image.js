@@ -8,6 +8,10 @@ class ImageViewer {
         this.annotationContainer.setAttribute('visibility', 'true');
 
         this.recalcAnnotations = function () {};
+        // Вызывается после того, как видимая область перестала меняться
+        this.viewportChanged = function () {};
+        this.viewportTimer = null;
+        this.viewportKey = '';
 
 
         this.scale = 1;
@@ -21,6 +25,12 @@ class ImageViewer {
         this.containerWidth = 0;
         this.containerHeight = 0;
 
+        // Тайлы большого изображения поверх уменьшенной подложки
+        this.tileSource = null;
+        this.tileLayer = null;
+        this.tiles = new Map();
+        this.tileFrame = null;
+
         this.init();
     }
 
@@ -53,12 +63,46 @@ class ImageViewer {
         }
     }
 
+    setViewportChangeCallback(callback) {
+        if (typeof callback === 'function') {
+            this.viewportChanged = callback;
+        }
+    }
+
+    // Откладывает уведомление об изменении видимой области до конца прокрутки или масштабирования
+    scheduleViewportChange() {
+        clearTimeout(this.viewportTimer);
+        this.viewportTimer = setTimeout(() => {
+            this.viewportTimer = null;
+            // Перерисовка разметки тоже вызывает updateTransform, сам вид при этом не меняется
+            const key = [this.scale, this.posX, this.posY, this.containerWidth, this.containerHeight].join();
+            if (key === this.viewportKey) return;
+            this.viewportKey = key;
+            this.viewportChanged();
+        }, 250);
+    }
+
+    // Видимая область [x1, y1, x2, y2] в пикселях исходного изображения или null
+    visibleImageRect() {
+        const img = document.getElementById('zoomImage');
+        if (!img || !img.width || !this.naturalWidth) return null;
+        const toImageX = sx => ((sx - this.posX) / this.scale - img.offsetLeft) * this.naturalWidth / img.width;
+        const toImageY = sy => ((sy - this.posY) / this.scale - img.offsetTop) * this.naturalHeight / img.height;
+        return [
+            Math.max(0, Math.floor(toImageX(0))),
+            Math.max(0, Math.floor(toImageY(0))),
+            Math.min(this.naturalWidth, Math.ceil(toImageX(this.containerWidth))),
+            Math.min(this.naturalHeight, Math.ceil(toImageY(this.containerHeight)))
+        ];
+    }
+
     updateContainerSize() {
         // Получаем размеры контейнера
         const rect = this.container.getBoundingClientRect();
         this.containerWidth = rect.width;
         this.containerHeight = rect.height;
         this.recalcAnnotations();
+        this.scheduleTileUpdate();
     }
 
     handleWheel(e) {
@@ -119,6 +163,94 @@ class ImageViewer {
             annotation.style.height = `${parseFloat(annotation.getAttribute('height')) * this.scale}px`;
             annotation.style.width = `${parseFloat(annotation.getAttribute('width')) * this.scale}px`;
         });
+
+        this.scheduleTileUpdate();
+        this.scheduleViewportChange();
+    }
+
+    // Источник тайлов {id, width, height, tile_size, max_zoom} или null для обычного изображения
+    setTileSource(source) {
+        this.tileSource = source;
+        this.tiles.clear();
+        if (this.tileLayer) {
+            this.tileLayer.remove();
+            this.tileLayer = null;
+        }
+        const img = document.getElementById('zoomImage');
+        if (source && img) {
+            this.tileLayer = document.createElement('div');
+            this.tileLayer.className = 'tile-layer';
+            // Слой тайлов лежит над подложкой, но под разметкой
+            img.insertAdjacentElement('afterend', this.tileLayer);
+        }
+        this.scheduleTileUpdate();
+    }
+
+    scheduleTileUpdate() {
+        if (!this.tileSource || this.tileFrame !== null) return;
+        this.tileFrame = requestAnimationFrame(() => {
+            this.tileFrame = null;
+            this.updateTiles();
+        });
+    }
+
+    // Подгружает тайлы видимой области на уровне, соответствующем текущему масштабу
+    updateTiles() {
+        const source = this.tileSource;
+        const img = document.getElementById('zoomImage');
+        if (!source || !this.tileLayer || !img || !img.width || !img.naturalWidth) return;
+
+        // Слой тайлов повторяет прямоугольник подложки
+        this.tileLayer.style.left = `${img.offsetLeft}px`;
+        this.tileLayer.style.top = `${img.offsetTop}px`;
+        this.tileLayer.style.width = `${img.width}px`;
+        this.tileLayer.style.height = `${img.height}px`;
+
+        // Сколько экранных пикселей приходится на пиксель исходного изображения
+        const density = this.scale * img.width / source.width * (window.devicePixelRatio || 1);
+        const z = Math.max(0, Math.min(source.max_zoom, source.max_zoom + Math.ceil(Math.log2(density))));
+        const factor = 2 ** (source.max_zoom - z);
+
+        const needed = new Set();
+        // Пока подложка не грубее нужного уровня, тайлы не нужны
+        if (factor < source.width / img.naturalWidth) {
+            const span = source.tile_size * factor;
+
+            // Видимая область контейнера в координатах изображения
+            const toImageX = sx => ((sx - this.posX) / this.scale - img.offsetLeft) * source.width / img.width;
+            const toImageY = sy => ((sy - this.posY) / this.scale - img.offsetTop) * source.height / img.height;
+            const tx0 = Math.max(0, Math.floor(toImageX(0) / span));
+            const ty0 = Math.max(0, Math.floor(toImageY(0) / span));
+            const tx1 = Math.min(Math.ceil(source.width / span) - 1, Math.floor(toImageX(this.containerWidth) / span));
+            const ty1 = Math.min(Math.ceil(source.height / span) - 1, Math.floor(toImageY(this.containerHeight) / span));
+
+            for (let ty = ty0; ty <= ty1; ty++) {
+                for (let tx = tx0; tx <= tx1; tx++) {
+                    const key = `${z}/${tx}/${ty}`;
+                    needed.add(key);
+                    if (this.tiles.has(key)) continue;
+
+                    const tile = document.createElement('img');
+                    tile.className = 'tile';
+                    tile.draggable = false;
+                    tile.style.left = `${tx * span / source.width * 100}%`;
+                    tile.style.top = `${ty * span / source.height * 100}%`;
+                    tile.style.width = `${Math.min(span, source.width - tx * span) / source.width * 100}%`;
+                    tile.style.height = `${Math.min(span, source.height - ty * span) / source.height * 100}%`;
+                    tile.src = `server/tiles/${source.id}/${key}.webp`;
+                    this.tileLayer.appendChild(tile);
+                    this.tiles.set(key, tile);
+                }
+            }
+        }
+
+        // Тайлы других уровней и вне видимой области убираем
+        for (const [key, tile] of this.tiles) {
+            if (!needed.has(key)) {
+                tile.remove();
+                this.tiles.delete(key);
+            }
+        }
     }
 
     setNaturalSize(width, height) {
@@ -258,6 +390,20 @@ class ImageViewer {
         this.updateTransform();
     }
 
+    // Разметка строится в виде без масштаба и сдвига (как после resetView), текущий вид сохраняется
+    drawAtBaseView(draw) {
+        const view = [this.scale, this.posX, this.posY];
+        this.scale = 1;
+        this.posX = 0;
+        this.posY = 0;
+        try {
+            draw();
+        } finally {
+            [this.scale, this.posX, this.posY] = view;
+            this.updateTransform();
+        }
+    }
+
     focusOnBBox(bbox) {
         // bbox = [x, y, width, height] в координатах исходного изображения
         this.recalcAnnotations();
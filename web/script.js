@@ -5,10 +5,21 @@ let detectedObjects = {};
 let settings = {
     modelType: 'visible',
     detectionLimit: 0.5,
+    skipEmptySlices: false,
+    autoSlice: false,
+    incremental: false,
     georeference: false,
     pixelSize: 5.0
 };
 
+// Фильтр списка объектов: класс и минимальная уверенность
+let objectFilter = {type: '', minConfidence: 0};
+
+// Изображениям с большим числом объектов сервер отдает только объекты видимой области
+const VIEWPORT_QUERY_MIN_OBJECTS = 500;
+const VIEWPORT_QUERY_LIMIT = 1000;
+let viewportQuerySeq = 0;
+
 // Кэш для DOM элементов
 let domCache = {};
 
@@ -21,11 +32,16 @@ document.addEventListener('DOMContentLoaded', function() {
 
     // Настройка элементов интерфейса
     initializeUI();
+    loadServerSettings();
 
     viewer.setAnnotationRecalcCallback(function() {
         updateDetectedObjectsList();
     });
 
+    viewer.setViewportChangeCallback(function() {
+        refreshViewportObjects();
+    });
+
 //    // Загрузка сохраненных данных (если есть)
 //    loadSavedData();
 });
@@ -46,6 +62,8 @@ function initializeDomCache() {
         detectionSliceValue: document.getElementById('detectionSliceValue'),
         detectionOverlap: document.getElementById('detectionOverlap'),
         detectionOverlapValue: document.getElementById('detectionOverlapValue'),
+        batchSize: document.getElementById('batchSize'),
+        batchSizeValue: document.getElementById('batchSizeValue'),
         imagePreview: document.getElementById('imagePreview'),
 //        currentImageName: document.getElementById('currentImageName'),
         detectedObjects: document.getElementById('detectedObjects'),
@@ -87,6 +105,9 @@ function initializeUI() {
     domCache.detectionOverlap.addEventListener('input', function() {
         domCache.detectionOverlapValue.textContent = this.value;
     });
+    domCache.batchSize.addEventListener('input', function() {
+        domCache.batchSizeValue.textContent = this.value;
+    });
 
     domCache.detectionLimitValue.textContent = domCache.detectionLimit.value;
 
@@ -189,32 +210,28 @@ async function uploadToServer(fileList) {
     return res;
 }
 
-// `fileList` - это массив файлов, полученных из input
-async function convertTiffToPng(file) {
-    const formData = new FormData();
-    formData.append('files', file);
-
-    console.log("formData", formData);
-
-    res = {'result': null, 'error': null};
+// Загрузка TIFF: изображение остается на сервере и просматривается по тайлам
+async function uploadTiff(file) {
+    const uploadResult = await uploadToServer([file]);
+    if (uploadResult['error'] !== null) {
+        return uploadResult;
+    }
+    const uploaded = uploadResult['result']['results'][0];
+    if (!uploaded) {
+        return {'result': null, 'error': 'error upload'};
+    }
     try {
-        const response = await fetch('/server/convert/tiff-to-png?save_georeference=false', {
-            method: 'POST',
-            body: formData // Content-Type устанавливается автоматически как multipart/form-data
-        });
-        if (response.ok) {
-            let imageBlob = await response.blob();
-            result = {
-                blob: imageBlob,
-                path: response.headers.get('Filepath')
-            }
-            res['result'] = result;
+        // Первый запрос дожидается построения пирамиды тайлов
+        const response = await fetch(`server/tiles/${uploaded['content_hash']}/info`);
+        if (!response.ok) {
+            return {'result': null, 'error': 'error upload'};
         }
+        uploaded['tiles'] = {id: uploaded['content_hash'], ...(await response.json())};
+        return {'result': uploaded, 'error': null};
     } catch (error) {
         console.error('Сетевая ошибка:', error);
-        res['error'] = 'error network';
+        return {'result': null, 'error': 'error network'};
     }
-    return res;
 }
 
 function removeExtension(filename) {
@@ -271,39 +288,43 @@ async function handleFileUpload(event) {
             }
 
             if (file.type === 'image/tiff') {
-                convertResult = await convertTiffToPng(file);
-                if (convertResult['error'] === 'error upload') {
+                const uploadResult = await uploadTiff(file);
+                if (uploadResult['error'] === 'error upload') {
                     showNotification(
-                        'Не удалось конвертировать TIFF в PNG. Проверьте формат файла.',
+                        'Не удалось загрузить TIFF. Проверьте формат файла.',
                         'error'
                     );
                     folderStats.skipped++;
                     continue;
-                } else if (convertResult['error'] === 'error network') {
+                } else if (uploadResult['error'] === 'error network') {
                     showNotification(
-                        'Сетевая ошибка при конвертации TIFF в PNG. Попробуйте позже.',
+                        'Сетевая ошибка при загрузке TIFF. Попробуйте позже.',
                         'warning'
                     );
                     folderStats.skipped++;
                     continue;
-                } else {
-                    if (convertResult['result'] !== (null || undefined)) {
-                        console.log('Изображение успешно конвертировано!', convertResult['result']);
-                        file = convertResult['result']['blob'];
-                        if (file.name === (null || undefined)) {
-                            file.name = filePath
-                        }
-                        images.push({
-                            "original_filename": filePath,
-                            "uploaded_path": convertResult['result']['path']
-                        })
-                    }
                 }
 
+                // Полноразмерный растр в браузер не передается: подложка и тайлы приходят с сервера
+                const uploaded = uploadResult['result'];
+                images.push(uploaded);
+                successfulImages.push({
+                    id: Date.now() + i + Math.random(),
+                    name: uploaded['original_filename'],
+                    url: `server/tiles/${uploaded['tiles']['id']}/preview.webp`,
+                    tiles: uploaded['tiles'],
+                    analyzed: null,
+                    path: filePath,
+                    size: file.size,
+                    type: file.type,
+                    isBlobUrl: false,
+                    loadMethod: 'tiles'
+                });
+                processedFiles.add(filePath);
+                folderStats.images++;
+                continue;
             }
-            else {
-                imageForServer.push(file)
-            }
+            imageForServer.push(file);
 
             processedFiles.add(filePath);
             folderStats.images++;
@@ -478,6 +499,18 @@ function removeImage(index) {
 }
 
 // Функция для показа уведомлений
+// Список ошибок для уведомления, текст ошибок экранируется
+function errorListHtml(errors) {
+    const list = document.createElement('ul');
+    list.className = 'mb-0 mt-2';
+    errors.forEach(error => {
+        const item = document.createElement('li');
+        item.textContent = error;
+        list.appendChild(item);
+    });
+    return list.outerHTML;
+}
+
 function showNotification(message, type = 'info') {
     // Удаляем предыдущие уведомления
     const existingAlerts = document.querySelectorAll('.alert');
@@ -613,6 +646,7 @@ function selectImage(index) {
 //        domCache.imagePreview.innerHTML = "";
 //        viewer.loadImage(image.url, image.name);
     }
+    viewer.setTileSource(image.tiles || null);
 
     // Обновляем название текущего изображения
 //    domCache.currentImageName.textContent = image.name;
@@ -632,9 +666,13 @@ function selectImage(index) {
     });
 }
 
-// Обновление списка распознанных объектов
-function updateDetectedObjectsList() {
-    viewer.resetView();
+// Обновление списка распознанных объектов.
+// viewportEntries - уже отобранные объекты [{obj, index}]: вид при этом не сбрасывается
+function updateDetectedObjectsList(viewportEntries = null, summary = '') {
+    const keepView = viewportEntries !== null;
+    if (!keepView) {
+        viewer.resetView();
+    }
     if (currentImageIndex === -1) return;
     const imageId = uploadedImages[currentImageIndex].id;
     console.log('imageId', imageId);
@@ -656,6 +694,17 @@ function updateDetectedObjectsList() {
 
     viewer.clearAnnotations();
 
+    let entries = viewportEntries;
+    if (!keepView) {
+        if (useViewportQuery(detectedObjects[imageId])) {
+            // Список перерисуется по ответу сервера
+            queryViewportObjects(imageId);
+            return;
+        }
+        entries = filterLocalDetections(detectedObjects[imageId]['detections']);
+        updateTypeFilterOptions(detectedObjects[imageId]['detections'].map(obj => obj.type));
+    }
+
     if (document.getElementById('button-visible')) {
         document.getElementById('button-visible').hidden = false;
         document.getElementById('button-checked').hidden = false;
@@ -677,7 +726,8 @@ function updateDetectedObjectsList() {
     }
 
     let html = '';
-    detectedObjects[imageId]['detections'].forEach((obj, index) => {
+    const rectangles = [];
+    entries.forEach(({obj, index}) => {
         const checked = obj.verified ? 'checked' : '';
         html += `
             <div class="object-item fade-in" id="object-${index}" data-index="${index}">
@@ -699,9 +749,19 @@ function updateDetectedObjectsList() {
             </div>
         `;
 
-        viewer.addRectangle(obj.bbox[0], obj.bbox[1], obj.bbox[2], obj.bbox[3], `${index + 1}. ${obj.type} ${(obj.confidence * 100).toFixed(1)}`, index, color);
+        rectangles.push([obj.bbox[0], obj.bbox[1], obj.bbox[2], obj.bbox[3], `${index + 1}. ${obj.type} ${(obj.confidence * 100).toFixed(1)}`, index, color]);
     });
 
+    const drawRectangles = () => rectangles.forEach(args => viewer.addRectangle(...args));
+    if (keepView) {
+        viewer.drawAtBaseView(drawRectangles);
+    } else {
+        drawRectangles();
+    }
+
+    if (summary) {
+        html += `<div class="text-muted small mt-2">${summary}</div>`;
+    }
     domCache.detectedObjects.innerHTML = html;
 
     var objects = document.querySelectorAll('.object-item');
@@ -832,221 +892,468 @@ function updateDetectedObjectsList() {
     domCache.exportBtn.hidden = false;
 }
 
-// Анализ изображений
-async function analyzeImages() {
-    if (uploadedImages.length === 0) {
-        alert('Пожалуйста, загрузите изображения для анализа.');
+// Объекты, подходящие под фильтр, с номерами в полном результате
+function filterLocalDetections(detections) {
+    return detections
+        .map((obj, index) => ({obj, index}))
+        .filter(({obj}) => (!objectFilter.type || obj.type === objectFilter.type)
+            && obj.confidence >= objectFilter.minConfidence);
+}
+
+function imageContentHash(result) {
+    const uploaded = images.find(img => img.uploaded_path === result['image_path']);
+    return uploaded ? uploaded['content_hash'] : null;
+}
+
+// Запрашивать объекты видимой области у сервера вместо обхода всего результата
+function useViewportQuery(result) {
+    return result['run_id'] != null
+        && result['detections'].length > VIEWPORT_QUERY_MIN_OBJECTS
+        && imageContentHash(result) !== null;
+}
+
+// Объекты видимой области с фильтрами, отобранные пространственным индексом на сервере
+async function queryViewportObjects(imageId) {
+    const result = detectedObjects[imageId];
+    const seq = ++viewportQuerySeq;
+    const params = new URLSearchParams({run_id: result['run_id'], limit: VIEWPORT_QUERY_LIMIT});
+    const rect = viewer.visibleImageRect();
+    if (rect) {
+        params.set('bbox', rect.join(','));
+    }
+    if (objectFilter.type) {
+        params.set('type', objectFilter.type);
+    }
+    if (objectFilter.minConfidence > 0) {
+        params.set('min_conf', objectFilter.minConfidence);
+    }
+    let entries;
+    let summary = '';
+    try {
+        const response = await fetch(`server/detections/${imageContentHash(result)}?${params}`);
+        if (!response.ok) {
+            throw new Error(`Ошибка сервера: ${response.status}`);
+        }
+        const page = await response.json();
+        entries = page['detections'].map(obj => ({obj: result['detections'][obj['index']], index: obj['index']}));
+        summary = `Показано ${entries.length} из ${page['total']} в видимой области`;
+        updateTypeFilterOptions(Object.keys(page['types']));
+    } catch (error) {
+        console.error('Ошибка запроса объектов:', error);
+        entries = filterLocalDetections(result['detections']).slice(0, VIEWPORT_QUERY_LIMIT);
+    }
+    // Пока шел запрос, вид или изображение могли смениться
+    if (seq !== viewportQuerySeq || currentImageIndex === -1 || uploadedImages[currentImageIndex].id !== imageId) {
         return;
     }
+    updateDetectedObjectsList(entries, summary);
+}
 
-    // Показываем индикатор загрузки
-    const analyzeBtn = domCache.analyzeBtn;
-    const originalText = analyzeBtn.innerHTML;
-    analyzeBtn.innerHTML = '<i class="fas fa-spinner fa-spin me-1"></i> Поиск...';
-    analyzeBtn.disabled = true;
-    domCache.paramsBtn.disabled = true;
-    console.log('uploadedImages', uploadedImages);
-    imagePaths = images.map(image => image.uploaded_path);
-    console.log('imagePaths', imagePaths);
-    // Подготавливаем данные для отправки
-    const requestData = {
-        image_paths: imagePaths
-    };
+// Вызывается просмотрщиком после прокрутки и масштабирования
+function refreshViewportObjects() {
+    if (currentImageIndex === -1 || !document.getElementById('annotationContainer')) return;
+    const imageId = uploadedImages[currentImageIndex].id;
+    if (detectedObjects[imageId] && useViewportQuery(detectedObjects[imageId])) {
+        queryViewportObjects(imageId);
+    }
+}
 
-    // Отправляем POST запрос на эндпоинт /detect
-    const response = await fetch('server/detect', {
-        method: 'POST',
-        headers: {'Content-Type': 'application/json'},
-        body: JSON.stringify(requestData)
-    });
+// Применение фильтра без сброса текущего вида
+function applyObjectFilter() {
+    if (currentImageIndex === -1) return;
+    const imageId = uploadedImages[currentImageIndex].id;
+    const result = detectedObjects[imageId];
+    if (!result || result['detections'].length === 0) return;
+    if (useViewportQuery(result)) {
+        queryViewportObjects(imageId);
+    } else {
+        updateDetectedObjectsList(filterLocalDetections(result['detections']));
+    }
+}
 
-    const result_detect = await response.json();
-    console.log('response detect', result_detect);
+// Список классов в фильтре; выбранный класс сохраняется
+function updateTypeFilterOptions(types) {
+    const select = document.getElementById('filter-type');
+    if (!select) return;
+    const names = [...new Set(types)].sort();
+    if (objectFilter.type && !names.includes(objectFilter.type)) {
+        names.push(objectFilter.type);
+    }
+    const current = Array.from(select.options).slice(1).map(option => option.value);
+    if (current.join('\n') === names.join('\n')) return;
+    select.innerHTML = '<option value="">Все классы</option>'
+        + names.map(name => `<option value="${name}">${name}</option>`).join('');
+    select.value = objectFilter.type;
+}
 
-    if (result_detect['errors'] !== null) {
-        console.log('errors', result_detect['errors']);
-        showNotification('Ошибка при анализе изображений.', 'error');
-        return;
+// Применение результата детекции одного изображения
+function applyDetectionResult(result) {
+    const imagePath = images.find(img => img.uploaded_path === result['image_path']);
+    if (!imagePath) return null;
+    let image = uploadedImages.find(img => img.name === imagePath['original_filename']);
+    if (image) {
+        image.analyzed = false;
+        detectedObjects[image.id] = result;
     }
+    return image;
+}
 
-    if (result_detect['results'] !== (null || undefined)) {
-        for (let i = 0; i < result_detect['results'].length; i++) {
-            console.log('image_path', i, result_detect['results'][i]['image_path']);
-            const imagePath = images.find(img => img.uploaded_path === result_detect['results'][i]['image_path']);
-            let image = uploadedImages.find(img => img.name === imagePath['original_filename']);
-            if (image) {
-                image.analyzed = false;
-                detectedObjects[image.id] = result_detect['results'][i];
-            }
+// Типизированные массивы столбцов ответа с encoding=columnar
+const COLUMN_ARRAYS = {
+    float32: Float32Array,
+    float64: Float64Array,
+    uint16: Uint16Array,
+    uint32: Uint32Array,
+    int8: Int8Array
+};
+
+function decodeColumn(column) {
+    const binary = atob(column['data']);
+    const bytes = new Uint8Array(binary.length);
+    for (let i = 0; i < binary.length; i++) {
+        bytes[i] = binary.charCodeAt(i);
+    }
+    return new COLUMN_ARRAYS[column['dtype']](bytes.buffer);
+}
+
+// Результат в столбцах (поле columns) -> обычный список детекций
+function decodeColumnarResult(result) {
+    const columns = result['columns'];
+    if (!columns) return result;
+    const type = decodeColumn(columns['type']);
+    const bbox = decodeColumn(columns['bbox']);
+    const confidence = decodeColumn(columns['confidence']);
+    const verified = decodeColumn(columns['verified']);
+    const rbox = columns['rbox'] ? decodeColumn(columns['rbox']) : null;
+    const world = columns['world_polygon'] ? decodeColumn(columns['world_polygon']) : null;
+    const index = columns['index'] ? decodeColumn(columns['index']) : null;
+    const detections = [];
+    for (let i = 0; i < columns['count']; i++) {
+        const detection = {
+            type: columns['types'][type[i]],
+            bbox: Array.from(bbox.subarray(i * 4, i * 4 + 4)),
+            confidence: confidence[i],
+            verified: verified[i] < 0 ? null : verified[i] === 1
+        };
+        if (rbox && !Number.isNaN(rbox[i * 5])) {
+            detection.rbox = Array.from(rbox.subarray(i * 5, i * 5 + 5));
+        }
+        if (world && !Number.isNaN(world[i * 8])) {
+            detection.world_polygon = [0, 1, 2, 3].map(k => [world[i * 8 + k * 2], world[i * 8 + k * 2 + 1]]);
         }
+        if (index) {
+            detection.index = index[i];
+        }
+        detections.push(detection);
     }
+    const decoded = {...result, detections: detections};
+    delete decoded['columns'];
+    return decoded;
+}
 
-    // Обновляем интерфейс
-    updateImageList();
-    if (currentImageIndex >= 0) {
-        console.log(domCache.imagePreview, domCache.imagePreview.parentElement, domCache.imagePreview.parentElement.style);
-//        console.log('wh container', `${domCache.imagePreview.parentElement.style.width}px`, `${domCache.imagePreview.parentElement.style.height}px`);
-        if (!(document.getElementById('annotationContainer'))) {
-            viewer.imageWrapper.appendChild(viewer.annotationContainer);
+// Чтение потока результатов задачи детекции (NDJSON), onEvent вызывается для каждой строки.
+// Детекции приходят в столбцах и раскладываются обратно в объекты
+async function streamDetectJob(jobId, onEvent) {
+    const response = await fetch(`server/jobs/${jobId}/results?encoding=columnar`);
+    if (!response.ok) {
+        throw new Error(`Ошибка сервера: ${response.status}`);
+    }
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    while (true) {
+        const {value, done} = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, {stream: true});
+        let newline;
+        while ((newline = buffer.indexOf('\n')) !== -1) {
+            const line = buffer.slice(0, newline).trim();
+            buffer = buffer.slice(newline + 1);
+            if (line) {
+                const event = JSON.parse(line);
+                if (event['result']) {
+                    event['result'] = decodeColumnarResult(event['result']);
+                }
+                onEvent(event);
+            }
         }
+    }
+}
 
-        updateDetectedObjectsList();
+// Отображение найденных объектов для текущего изображения
+function showDetectedView() {
+    if (!(document.getElementById('annotationContainer'))) {
+        viewer.imageWrapper.appendChild(viewer.annotationContainer);
+    }
 
-        if (!(document.getElementById('button-bar-detected'))) {
-            let bar = document.createElement('div');
-            bar.id = 'button-bar-detected';
-            bar.className = 'd-flex';
-            domCache.detectedObjects.parentNode.insertBefore(bar, domCache.detectedObjects);
-        }
+    if (!(document.getElementById('filter-bar-detected'))) {
+        let bar = document.createElement('div');
+        bar.id = 'filter-bar-detected';
+        bar.className = 'd-flex mb-2';
+        bar.innerHTML = `
+            <select id="filter-type" class="form-select form-select-sm me-2">
+                <option value="">Все классы</option>
+            </select>
+            <input id="filter-confidence" type="number" class="form-control form-control-sm" min="0" max="100" step="5" value="0" title="Минимальная уверенность, %">
+        `;
+        domCache.detectedObjects.parentNode.insertBefore(bar, domCache.detectedObjects);
+        document.getElementById('filter-type').addEventListener('change', function(e) {
+            objectFilter.type = e.target.value;
+            applyObjectFilter();
+        });
+        document.getElementById('filter-confidence').addEventListener('change', function(e) {
+            const percent = Math.max(0, Math.min(100, parseFloat(e.target.value) || 0));
+            objectFilter.minConfidence = percent / 100;
+            applyObjectFilter();
+        });
+    }
 
-        if (!(document.getElementById('button-checked'))) {
-            let button = document.createElement('button');
-            button.className = 'btn btn-accent me-2';
-            button.setAttribute('type', 'button');
-            button.setAttribute('checked', 'false');
-            button.id = 'button-checked';
-            button.innerHTML = `Выделить все`;
-            button.addEventListener('click', function() {
-                const checked = button.getAttribute('checked');
-                if (checked === 'true') {
-                    button.innerHTML = `Выделить все`;
-                    button.setAttribute('checked', 'false');
-                    document.querySelectorAll('.object-checkbox').forEach(checkbox => {
-                        if (checkbox.checked) {
-                            checkbox.click();
-                        }
-                        checkbox.setAttribute('checked', 'false');
-                    });
-                } else {
-                    button.innerHTML = `Сбросить`;
-                    button.setAttribute('checked', 'true');
-                    document.querySelectorAll('.object-checkbox').forEach(checkbox => {
-                        if (!checkbox.checked) {
-                            checkbox.click();
-                        }
-                        checkbox.setAttribute('checked', 'true');
-                    });
-                }
+    updateDetectedObjectsList();
 
-            });
-            document.getElementById('button-bar-detected').insertAdjacentElement('afterbegin', button);
-        }
+    if (!(document.getElementById('button-bar-detected'))) {
+        let bar = document.createElement('div');
+        bar.id = 'button-bar-detected';
+        bar.className = 'd-flex';
+        domCache.detectedObjects.parentNode.insertBefore(bar, domCache.detectedObjects);
+    }
 
-        if (!(document.getElementById('button-visible'))) {
-            let button = document.createElement('button');
-            button.className = 'btn btn-accent me-2';
-            button.setAttribute('type', 'button');
-            button.setAttribute('visibility', 'true');
-            button.id = 'button-visible';
-            button.innerHTML = `Скрыть все`;
-            button.addEventListener('click', function() {
-                const visibility = button.getAttribute('visibility');
-                if (visibility === 'true') {
-                    button.innerHTML = `Показать все`;
-                    button.setAttribute('visibility', 'false');
-                    document.querySelectorAll('.toggle-visible').forEach(button_visible => {
-                        const index = button_visible.getAttribute('data-index');
-                        let rect = document.getElementById(`rect_${index}`);
-                        let label = document.getElementById(`label_${index}`);
-                        rect.style.display = 'none';
-                        label.style.display = 'none';
-                        button_visible.setAttribute('visibility', 'false');
-                        button_visible.innerHTML = `<svg xmlns="http://www.w3.org/2000/svg" width="16" height="16" fill="currentColor" class="bi bi-eye-slash" viewBox="0 0 16 16">
-                            <path d="M13.359 11.238C15.06 9.72 16 8 16 8s-3-5.5-8-5.5a7.028 7.028 0 0 0-2.79.588l.77.771A5.944 5.944 0 0 1 8 3.5c2.12 0 3.879 1.168 5.168 2.457A13.134 13.134 0 0 1 14.828 8c-.058.087-.122.183-.195.288-.335.48-.83 1.12-1.465 1.755-.165.165-.337.328-.517.486l.708.709z"/>
-                            <path d="M11.297 9.176a3.5 3.5 0 0 0-4.474-4.474l.823.823a2.5 2.5 0 0 1 2.829 2.829l.822.822zm-2.943 1.299.822.822a3.5 3.5 0 0 1-4.474-4.474l.823.823a2.5 2.5 0 0 0 2.829 2.829z"/>
-                            <path d="M3.35 5.47c-.18.16-.353.322-.518.487A13.134 13.134 0 0 0 1.172 8l.195.288c.335.48.83 1.12 1.465 1.755C4.121 11.332 5.881 12.5 8 12.5c.716 0 1.39-.133 2.02-.36l.77.772A7.029 7.029 0 0 1 8 13.5C3 13.5 0 8 0 8s.939-1.721 2.641-3.238l.708.709zm10.296 8.884-12-12 .708-.708 12 12-.708.708z"/>
-                        </svg>`;
-                    });
-                } else {
-                    button.innerHTML = `Скрыть все`;
-                    button.setAttribute('visibility', 'true');
-                    document.querySelectorAll('.toggle-visible').forEach(button_visible => {
-                        const index = button_visible.getAttribute('data-index');
-                        let rect = document.getElementById(`rect_${index}`);
-                        let label = document.getElementById(`label_${index}`);
-                        document.getElementById(`annotationContainer`).style.display = 'flex';
-                        rect.style.display = 'flex';
-                        label.style.display = 'flex';
-                        button_visible.setAttribute('visibility', 'true');
-                        button_visible.innerHTML = `<svg xmlns="http://www.w3.org/2000/svg" width="16" height="16" fill="currentColor" class="bi bi-eye" viewBox="0 0 16 16">
-                            <path d="M16 8s-3-5.5-8-5.5S0 8 0 8s3 5.5 8 5.5S16 8 16 8zM1.173 8a13.133 13.133 0 0 1 1.66-2.043C4.12 4.668 5.88 3.5 8 3.5c2.12 0 3.879 1.168 5.168 2.457A13.133 13.133 0 0 1 14.828 8c-.058.087-.122.183-.195.288-.335.48-.83 1.12-1.465 1.755C11.879 11.332 10.119 12.5 8 12.5c-2.12 0-3.879-1.168-5.168-2.457A13.134 13.134 0 0 1 1.172 8z"/>
-                            <path d="M8 5.5a2.5 2.5 0 1 0 0 5 2.5 2.5 0 0 0 0-5zM4.5 8a3.5 3.5 0 1 1 7 0 3.5 3.5 0 0 1-7 0z"/>
-                        </svg>`;
-                    });
-                }
+    if (!(document.getElementById('button-checked'))) {
+        let button = document.createElement('button');
+        button.className = 'btn btn-accent me-2';
+        button.setAttribute('type', 'button');
+        button.setAttribute('checked', 'false');
+        button.id = 'button-checked';
+        button.innerHTML = `Выделить все`;
+        button.addEventListener('click', function() {
+            const checked = button.getAttribute('checked');
+            if (checked === 'true') {
+                button.innerHTML = `Выделить все`;
+                button.setAttribute('checked', 'false');
+                document.querySelectorAll('.object-checkbox').forEach(checkbox => {
+                    if (checkbox.checked) {
+                        checkbox.click();
+                    }
+                    checkbox.setAttribute('checked', 'false');
+                });
+            } else {
+                button.innerHTML = `Сбросить`;
+                button.setAttribute('checked', 'true');
+                document.querySelectorAll('.object-checkbox').forEach(checkbox => {
+                    if (!checkbox.checked) {
+                        checkbox.click();
+                    }
+                    checkbox.setAttribute('checked', 'true');
+                });
+            }
 
-            });
+        });
+        document.getElementById('button-bar-detected').insertAdjacentElement('afterbegin', button);
+    }
+
+    if (!(document.getElementById('button-visible'))) {
+        let button = document.createElement('button');
+        button.className = 'btn btn-accent me-2';
+        button.setAttribute('type', 'button');
+        button.setAttribute('visibility', 'true');
+        button.id = 'button-visible';
+        button.innerHTML = `Скрыть все`;
+        button.addEventListener('click', function() {
+            const visibility = button.getAttribute('visibility');
+            if (visibility === 'true') {
+                button.innerHTML = `Показать все`;
+                button.setAttribute('visibility', 'false');
+                document.querySelectorAll('.toggle-visible').forEach(button_visible => {
+                    const index = button_visible.getAttribute('data-index');
+                    let rect = document.getElementById(`rect_${index}`);
+                    let label = document.getElementById(`label_${index}`);
+                    rect.style.display = 'none';
+                    label.style.display = 'none';
+                    button_visible.setAttribute('visibility', 'false');
+                    button_visible.innerHTML = `<svg xmlns="http://www.w3.org/2000/svg" width="16" height="16" fill="currentColor" class="bi bi-eye-slash" viewBox="0 0 16 16">
+                        <path d="M13.359 11.238C15.06 9.72 16 8 16 8s-3-5.5-8-5.5a7.028 7.028 0 0 0-2.79.588l.77.771A5.944 5.944 0 0 1 8 3.5c2.12 0 3.879 1.168 5.168 2.457A13.134 13.134 0 0 1 14.828 8c-.058.087-.122.183-.195.288-.335.48-.83 1.12-1.465 1.755-.165.165-.337.328-.517.486l.708.709z"/>
+                        <path d="M11.297 9.176a3.5 3.5 0 0 0-4.474-4.474l.823.823a2.5 2.5 0 0 1 2.829 2.829l.822.822zm-2.943 1.299.822.822a3.5 3.5 0 0 1-4.474-4.474l.823.823a2.5 2.5 0 0 0 2.829 2.829z"/>
+                        <path d="M3.35 5.47c-.18.16-.353.322-.518.487A13.134 13.134 0 0 0 1.172 8l.195.288c.335.48.83 1.12 1.465 1.755C4.121 11.332 5.881 12.5 8 12.5c.716 0 1.39-.133 2.02-.36l.77.772A7.029 7.029 0 0 1 8 13.5C3 13.5 0 8 0 8s.939-1.721 2.641-3.238l.708.709zm10.296 8.884-12-12 .708-.708 12 12-.708.708z"/>
+                    </svg>`;
+                });
+            } else {
+                button.innerHTML = `Скрыть все`;
+                button.setAttribute('visibility', 'true');
+                document.querySelectorAll('.toggle-visible').forEach(button_visible => {
+                    const index = button_visible.getAttribute('data-index');
+                    let rect = document.getElementById(`rect_${index}`);
+                    let label = document.getElementById(`label_${index}`);
+                    document.getElementById(`annotationContainer`).style.display = 'flex';
+                    rect.style.display = 'flex';
+                    label.style.display = 'flex';
+                    button_visible.setAttribute('visibility', 'true');
+                    button_visible.innerHTML = `<svg xmlns="http://www.w3.org/2000/svg" width="16" height="16" fill="currentColor" class="bi bi-eye" viewBox="0 0 16 16">
+                        <path d="M16 8s-3-5.5-8-5.5S0 8 0 8s3 5.5 8 5.5S16 8 16 8zM1.173 8a13.133 13.133 0 0 1 1.66-2.043C4.12 4.668 5.88 3.5 8 3.5c2.12 0 3.879 1.168 5.168 2.457A13.133 13.133 0 0 1 14.828 8c-.058.087-.122.183-.195.288-.335.48-.83 1.12-1.465 1.755C11.879 11.332 10.119 12.5 8 12.5c-2.12 0-3.879-1.168-5.168-2.457A13.134 13.134 0 0 1 1.172 8z"/>
+                        <path d="M8 5.5a2.5 2.5 0 1 0 0 5 2.5 2.5 0 0 0 0-5zM4.5 8a3.5 3.5 0 1 1 7 0 3.5 3.5 0 0 1-7 0z"/>
+                    </svg>`;
+                });
+            }
+
+        });
 //            domCache.detectedObjects.parentNode.insertBefore(button, domCache.detectedObjects);
-            document.getElementById('button-bar-detected').insertAdjacentElement('beforeend', button);
-        }
+        document.getElementById('button-bar-detected').insertAdjacentElement('beforeend', button);
+    }
 
-        if (!(document.getElementById('button-confirm'))) {
-            let button = document.createElement('button');
-            button.className = 'btn btn-accent me-2';
-            button.setAttribute('type', 'button');
-            button.id = 'button-confirm';
-            button.innerHTML = `ОК`;
-            button.addEventListener('click', function() {
-                var detectObjects = domCache.detectedObjects.children;
-                const imageId = detectObjects[0].children[0].getAttribute('data-image');
-                let verifiedObjects = 0;
-                if (detectedObjects[imageId]) {
-                    detectedObjects[imageId]['detections'].forEach(obj => {
-                        if (obj.verified) {
-                            verifiedObjects++;
-                        }
-                    });
-                    var image = domCache.imageList.querySelector('.image-item.active');
-                    const data_index = image.getAttribute('data-index');
-                    uploadedImages[data_index].analyzed = true;
-                    var badge = image.querySelector('.thumbnail-badge');
-                    if (detectObjects.length === 0 || verifiedObjects === 0) {
-                        badge.classList.replace('bg-secondary', 'bg-danger');
-                        badge.innerText = '✕';
-                    } else {
-                        badge.classList.replace('bg-secondary', 'bg-success');
-                        badge.innerText = '✓';
+    if (!(document.getElementById('button-confirm'))) {
+        let button = document.createElement('button');
+        button.className = 'btn btn-accent me-2';
+        button.setAttribute('type', 'button');
+        button.id = 'button-confirm';
+        button.innerHTML = `ОК`;
+        button.addEventListener('click', function() {
+            var detectObjects = domCache.detectedObjects.children;
+            // В списке могут быть не все объекты (фильтр, видимая область)
+            const imageId = uploadedImages[currentImageIndex].id;
+            let verifiedObjects = 0;
+            if (detectedObjects[imageId]) {
+                detectedObjects[imageId]['detections'].forEach(obj => {
+                    if (obj.verified) {
+                        verifiedObjects++;
                     }
-                } else {
-                    var image = domCache.imageList.querySelector('.image-item.active');
-                    const data_index = image.getAttribute('data-index');
-                    uploadedImages[data_index].analyzed = true;
-                    var badge = image.querySelector('.thumbnail-badge');
+                });
+                var image = domCache.imageList.querySelector('.image-item.active');
+                const data_index = image.getAttribute('data-index');
+                uploadedImages[data_index].analyzed = true;
+                var badge = image.querySelector('.thumbnail-badge');
+                if (detectObjects.length === 0 || verifiedObjects === 0) {
                     badge.classList.replace('bg-secondary', 'bg-danger');
                     badge.innerText = '✕';
+                } else {
+                    badge.classList.replace('bg-secondary', 'bg-success');
+                    badge.innerText = '✓';
                 }
-            });
+            } else {
+                var image = domCache.imageList.querySelector('.image-item.active');
+                const data_index = image.getAttribute('data-index');
+                uploadedImages[data_index].analyzed = true;
+                var badge = image.querySelector('.thumbnail-badge');
+                badge.classList.replace('bg-secondary', 'bg-danger');
+                badge.innerText = '✕';
+            }
+        });
 //            domCache.detectedObjects.parentNode.after(domCache.detectedObjects, button);
-            domCache.detectedObjects.parentNode.insertAdjacentElement('beforeend', button);
+        domCache.detectedObjects.parentNode.insertAdjacentElement('beforeend', button);
+    }
+
+    const rect = domCache.imagePreview.parentElement.getBoundingClientRect();
+    document.getElementById('annotationContainer').style.height = `${rect.height}px`;
+    document.getElementById('annotationContainer').style.width = `${rect.width}px`;
+}
+
+// Анализ изображений
+async function analyzeImages() {
+    if (uploadedImages.length === 0) {
+        alert('Пожалуйста, загрузите изображения для анализа.');
+        return;
+    }
+
+    // Показываем индикатор загрузки
+    const analyzeBtn = domCache.analyzeBtn;
+    const originalText = analyzeBtn.innerHTML;
+    analyzeBtn.innerHTML = '<i class="fas fa-spinner fa-spin me-1"></i> Поиск...';
+    analyzeBtn.disabled = true;
+    domCache.paramsBtn.disabled = true;
+    console.log('uploadedImages', uploadedImages);
+    imagePaths = images.map(image => image.uploaded_path);
+    console.log('imagePaths', imagePaths);
+    // Подготавливаем данные для отправки
+    const requestData = {
+        image_paths: imagePaths,
+        model_type: settings.modelType,
+        confidence_threshold: settings.detectionLimit
+    };
+
+    const errors = [];
+    // Сколько фрагментов пропущено фильтром пустых фрагментов
+    const sliceStats = {total: 0, skipped: 0};
+    try {
+        // Ставим детекцию в очередь, результаты приходят по мере готовности
+        const response = await fetch('server/jobs/detect', {
+            method: 'POST',
+            headers: {'Content-Type': 'application/json'},
+            body: JSON.stringify(requestData)
+        });
+        if (!response.ok) {
+            const errorData = await response.json();
+            throw new Error(errorData.detail || `Ошибка сервера: ${response.status}`);
         }
+        const job = await response.json();
+
+        let processed = 0;
+        await streamDetectJob(job['job_id'], event => {
+            if (event['event'] === 'result') {
+                const slices = event['result']['slices'];
+                if (slices) {
+                    sliceStats.total += slices['total'];
+                    sliceStats.skipped += slices['skipped'];
+                }
+                const image = applyDetectionResult(event['result']);
+                updateImageList();
+                if (currentImageIndex >= 0 && image === uploadedImages[currentImageIndex]) {
+                    showDetectedView();
+                }
+                processed++;
+            } else if (event['event'] === 'error') {
+                const image = images.find(img => img.uploaded_path === event['image_path']);
+                errors.push(`${image ? image['original_filename'] : event['image_path']}: ${event['error']}`);
+                processed++;
+            }
+            analyzeBtn.innerHTML = `<i class="fas fa-spinner fa-spin me-1"></i> Поиск... ${processed}/${job['total']}`;
+        });
+    } catch (error) {
+        console.error('Ошибка при анализе:', error);
+        errors.push(error.message);
+    }
 
-        const rect = domCache.imagePreview.parentElement.getBoundingClientRect();
-        document.getElementById('annotationContainer').style.height = `${rect.height}px`;
-        document.getElementById('annotationContainer').style.width = `${rect.width}px`;
+    // Обновляем интерфейс
+    updateImageList();
+    if (currentImageIndex >= 0) {
+        showDetectedView();
     }
 
     // Восстанавливаем кнопку
     analyzeBtn.innerHTML = originalText;
     analyzeBtn.disabled = false;
 
-    // Показываем уведомление об успехе
-    showNotification('Анализ завершен!', 'success');
+    // Показываем уведомление о результате
+    if (errors.length !== 0) {
+        showNotification(`Анализ завершен с ошибками (${errors.length}).${errorListHtml(errors)}`, 'warning');
+    } else if (sliceStats.skipped > 0) {
+        showNotification(`Анализ завершен! Пропущено пустых фрагментов: ${sliceStats.skipped} из ${sliceStats.total}.`, 'success');
+    } else {
+        showNotification('Анализ завершен!', 'success');
+    }
 
     domCache.uploadBtn.disabled = true;
     domCache.analyzeBtn.disabled = false;
     domCache.exportBtn.disabled = false;
 }
 
-async function exportImages() {
-    var requestData = [];
-    Object.keys(detectedObjects).forEach(imageId => {
-        result = {}
-        const objects = detectedObjects[imageId];
+// Тело запроса выгрузки. Результаты, сохраненные на сервере, передаются по id запуска
+// с номерами отмеченных объектов, остальные - целиком с отмеченными объектами
+function exportRequestData() {
+    const results = Object.values(detectedObjects);
+    if (results.length > 0 && results.every(result => result['run_id'] != null)) {
+        return {
+            runs: results.map(result => ({
+                run_id: result['run_id'],
+                verified: result['detections'].flatMap((obj, index) => obj.verified ? [index] : [])
+            })),
+            verified_only: true
+        };
+    }
+    return results.map(result => ({
+        image_path: result['image_path'],
+        detections: result['detections'].filter(obj => obj.verified)
+    }));
+}
 
-        result['image_path'] = objects['image_path'];
-        result['detections'] = objects['detections'].filter(obj => obj.verified);
-        requestData.push(result);
-    });
+async function exportImages() {
+    const requestData = exportRequestData();
 
     res = {'result': null, 'error': null};
     try {
@@ -1097,9 +1404,10 @@ async function exportImages() {
         document.body.removeChild(a);
 
         // Показываем успешный статус
-        const filesAdded = response.headers.get('X-Files-Added');
-        const successMessage = filesAdded
-        ? `Архив успешно создан! Добавлено файлов: ${filesAdded}`
+        // Изображения, которые не удалось отрисовать, перечислены в errors.txt архива
+        const filesRequested = response.headers.get('X-Files-Requested');
+        const successMessage = filesRequested
+        ? `Архив успешно создан! Запрошено изображений: ${filesRequested}`
         : 'Архив успешно создан и скачан!';
 
     } catch (error) {
@@ -1114,22 +1422,15 @@ async function exportImages() {
 }
 
 
-async function exportXLSX() {
-    var requestData = [];
-    Object.keys(detectedObjects).forEach(imageId => {
-        result = {}
-        const objects = detectedObjects[imageId];
-
-        result['image_path'] = objects['image_path'];
-        result['detections'] = objects['detections'].filter(obj => obj.verified);
-        requestData.push(result);
-    });
+// Выгрузка таблицы проверенных объектов; формат задается эндпоинтом
+async function exportReport(endpoint, defaultFilename) {
+    const requestData = exportRequestData();
 
     res = {'result': null, 'error': null};
     try {
         console.log('requestData', JSON.stringify(requestData));
         // Отправляем POST запрос на эндпоинт /detect
-        const response = await fetch('server/export/xlsx-data-detect', {
+        const response = await fetch(endpoint, {
             method: 'POST',
             headers: {'Content-Type': 'application/json'},
             body: JSON.stringify(requestData)
@@ -1156,7 +1457,7 @@ async function exportXLSX() {
 
         // Получаем имя файла из заголовков или используем стандартное
         const contentDisposition = response.headers.get('Content-Disposition');
-        let filename = 'detection_report.xlsx';
+        let filename = defaultFilename;
         if (response.headers.get('Filename')) {
             filename = response.headers.get('Filename');
         }
@@ -1177,9 +1478,10 @@ async function exportXLSX() {
         document.body.removeChild(a);
 
         // Показываем успешный статус
-        const filesAdded = response.headers.get('X-Files-Added');
-        const successMessage = filesAdded
-        ? `Архив успешно создан! Добавлено файлов: ${filesAdded}`
+        // Изображения, которые не удалось отрисовать, перечислены в errors.txt архива
+        const filesRequested = response.headers.get('X-Files-Requested');
+        const successMessage = filesRequested
+        ? `Архив успешно создан! Запрошено изображений: ${filesRequested}`
         : 'Архив успешно создан и скачан!';
 
     } catch (error) {
@@ -1193,6 +1495,26 @@ async function exportXLSX() {
     domCache.paramsBtn.disabled = true;
 }
 
+function exportXLSX() {
+    return exportReport('server/export/xlsx-data-detect', 'detection_report.xlsx');
+}
+
+function exportCSV() {
+    return exportReport('server/export/csv-data-detect', 'detection_report.csv');
+}
+
+function exportGeoJSON() {
+    return exportReport('server/export/geojson-data-detect', 'detection_report.geojson');
+}
+
+function exportGeoPackage() {
+    return exportReport('server/export/ogr-data-detect?format=gpkg', 'detection_report.gpkg');
+}
+
+function exportShapefile() {
+    return exportReport('server/export/ogr-data-detect?format=shp', 'detection_report.zip');
+}
+
 // Экспорт результатов
 function exportResults() {
     if (uploadedImages.length === 0) {
@@ -1227,8 +1549,28 @@ function exportResults() {
         <div class="export-item fade-in">
             <span class="badge bg-info">XLSX</span>
             <span>Таблица с данными объектов</span>
+            <button id="exportXLSX" class="btn btn-sm btn-outline-info ms-auto">Скачать</button>
+        </div>
+        <div class="export-item fade-in">
+            <span class="badge bg-info">CSV</span>
+            <span>Таблица с данными объектов</span>
             <button id="exportCSV" class="btn btn-sm btn-outline-info ms-auto">Скачать</button>
         </div>
+        <div class="export-item fade-in">
+            <span class="badge bg-warning">GeoJSON</span>
+            <span>Рамки объектов (с геопривязкой - в WGS 84)</span>
+            <button id="exportGeoJSON" class="btn btn-sm btn-outline-warning ms-auto">Скачать</button>
+        </div>
+        <div class="export-item fade-in">
+            <span class="badge bg-warning">GPKG</span>
+            <span>Слой объектов для ГИС (GeoPackage)</span>
+            <button id="exportGeoPackage" class="btn btn-sm btn-outline-warning ms-auto">Скачать</button>
+        </div>
+        <div class="export-item fade-in">
+            <span class="badge bg-warning">SHP</span>
+            <span>Слой объектов для ГИС (Shapefile, ZIP)</span>
+            <button id="exportShapefile" class="btn btn-sm btn-outline-warning ms-auto">Скачать</button>
+        </div>
     `;
 
     html += '</div>';
@@ -1237,7 +1579,31 @@ function exportResults() {
     // Назначаем обработчики напрямую через onclick
 //    document.getElementById('exportJSON').onclick = handleExportJSON;
     document.getElementById('exportImages').onclick = exportImages;
-    document.getElementById('exportCSV').onclick = exportXLSX;
+    document.getElementById('exportXLSX').onclick = exportXLSX;
+    document.getElementById('exportCSV').onclick = exportCSV;
+    document.getElementById('exportGeoJSON').onclick = exportGeoJSON;
+    document.getElementById('exportGeoPackage').onclick = exportGeoPackage;
+    document.getElementById('exportShapefile').onclick = exportShapefile;
+}
+
+// Автоматическая нарезка доступна, только если хотя бы для одной модели
+// на сервере задан масштаб обучения; иначе она совпадает с обычной нарезкой
+async function loadServerSettings() {
+    try {
+        const response = await fetch('server/detect/settings');
+        if (!response.ok) return;
+        const serverSettings = await response.json();
+        if (serverSettings['auto_slice_models'].length === 0) {
+            const autoSlice = document.getElementById('autoSlice');
+            autoSlice.checked = false;
+            autoSlice.disabled = true;
+            settings.autoSlice = false;
+            document.getElementById('autoSliceHint').textContent =
+                'Недоступно: ни для одной модели не задан масштаб обучения (train_gsd_m в config.json)';
+        }
+    } catch (error) {
+        console.error('Ошибка при загрузке настроек сервера:', error);
+    }
 }
 
 // Сохранение настроек
@@ -1247,6 +1613,10 @@ async function saveSettings() {
     settings.detectionLimit = parseFloat(document.getElementById('detectionLimit').value);
     settings.detectionSlice = parseInt(document.getElementById('detectionSlice').value, 10);
     settings.detectionOverlap = parseFloat(document.getElementById('detectionOverlap').value);
+    settings.batchSize = parseInt(document.getElementById('batchSize').value, 10);
+    settings.skipEmptySlices = document.getElementById('skipEmptySlices').checked;
+    settings.autoSlice = document.getElementById('autoSlice').checked;
+    settings.incremental = document.getElementById('incremental').checked;
     settings.georeference = document.getElementById('georeference').checked;
     settings.pixelSize = parseFloat(document.getElementById('pixelSize').value);
 
@@ -1286,5 +1656,12 @@ async function saveSettings() {
 function onImageLoad() {
     const img = document.getElementById('zoomImage');
     console.log('wh', img.naturalWidth, img.naturalHeight);
-    viewer.setNaturalSize(img.naturalWidth, img.naturalHeight);
+    // У тайлового изображения подложка уменьшена, разметка считается в исходных пикселях
+    const image = uploadedImages[currentImageIndex];
+    if (image && image.tiles) {
+        viewer.setNaturalSize(image.tiles.width, image.tiles.height);
+    } else {
+        viewer.setNaturalSize(img.naturalWidth, img.naturalHeight);
+    }
+    viewer.scheduleTileUpdate();
 }